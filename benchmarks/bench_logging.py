@@ -0,0 +1,66 @@
+"""
+Per call overhead of the logging on the hot paths.
+
+    python benchmarks/bench_logging.py [--calls 200000]
+
+Run from the repository root with mqtt_flow installed, or with
+PYTHONPATH=. set.
+
+Measures a disabled debug call formatted eagerly (f-string) and lazily
+(%-style), and a rate limited info call through the async handler, whose
+records are formatted and written by the listener thread.
+"""
+
+import argparse
+import time
+from mqtt_flow.utils.helpers import configure_logging, get_logger
+
+DEFAULT_CALLS = 200000
+
+TOPIC = "site/device/temperature"
+PAYLOAD = {"value": 21.5, "samples": [21.4, 21.5, 21.6]}
+
+
+def _ns_per_call(function, calls):
+    started = time.perf_counter()
+    for index in range(calls):
+        function(index)
+    return (time.perf_counter() - started) / calls * 1e9
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--calls", type=int, default=DEFAULT_CALLS)
+    args = parser.parse_args()
+
+    configure_logging(
+        {
+            "default_level": "INFO",
+            "async_handler": True,
+            "loggers": {"bench_rate_limited": {"rate_limit": 10}},
+        }
+    )
+    logger = get_logger("bench")
+    rate_limited_logger = get_logger("bench_rate_limited")
+
+    eager = _ns_per_call(
+        lambda index: logger.debug(f"Incoming {TOPIC} -> {PAYLOAD}"),
+        args.calls,
+    )
+    lazy = _ns_per_call(
+        lambda index: logger.debug("Incoming %s -> %s", TOPIC, PAYLOAD),
+        args.calls,
+    )
+    rate_limited = _ns_per_call(
+        lambda index: rate_limited_logger.info("Adding %s", TOPIC),
+        args.calls,
+    )
+
+    print(f"{args.calls} calls per case")
+    print(f"disabled debug, f-string: {eager:.0f} ns")
+    print(f"disabled debug, lazy: {lazy:.0f} ns")
+    print(f"rate limited info, async handler: {rate_limited:.0f} ns")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""
+Persisted messages per second with a slow disk sync.
+
+    python benchmarks/bench_persistence.py [--baseline 1e18739^]
+
+Run from the repository root with mqtt_flow installed, or with
+PYTHONPATH=. set.
+
+Producer threads append messages to the batch of a Persistence. The commits
+of the main persist queue sleep `--sync-delay` seconds to simulate the disk
+sync of an SD card. `--baseline` also runs the Persistence of a git
+revision, e.g. the one before the group commit writer thread.
+"""
+
+import argparse
+import importlib.util
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from mqtt_flow.peristence import persistence
+
+PERSISTENCE_PATH = "mqtt_flow/peristence/persistence.py"
+
+DEFAULT_PRODUCERS = 4
+DEFAULT_MESSAGES = 2000
+DEFAULT_BATCH_SIZE = 10
+DEFAULT_SYNC_DELAY = 0.005
+
+
+class SlowCommit:
+    """Persist queue connection whose commits take `delay` more seconds."""
+
+    def __init__(self, connection, delay):
+        self._connection = connection
+        self._delay = delay
+
+    def __enter__(self):
+        return self._connection.__enter__()
+
+    def __exit__(self, *exc_info):
+        result = self._connection.__exit__(*exc_info)
+        time.sleep(self._delay)
+        return result
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+
+def load_baseline(revision):
+    """Imports the persistence module of a git revision."""
+    source = subprocess.run(
+        ["git", "show", f"{revision}:{PERSISTENCE_PATH}"],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    module_name = "baseline_persistence"
+    spec = importlib.util.spec_from_loader(module_name, loader=None)
+    module = importlib.util.module_from_spec(spec)
+    exec(
+        compile(source, f"{revision}:{PERSISTENCE_PATH}", "exec"),
+        module.__dict__,
+    )
+    sys.modules[module_name] = module
+    return module
+
+
+def run(module, label, args):
+    path = tempfile.mkdtemp(prefix="bench_persistence_")
+    try:
+        store = module.Persistence(
+            {"name": "bench", "main_path": path, "batch_size": args.batch_size}
+        )
+        pqueue = store._main_pqueue
+        pqueue._putter = SlowCommit(pqueue._putter, args.sync_delay)
+
+        def produce():
+            for index in range(args.messages):
+                store.append_to_batch({"topic": "bench", "payload": index})
+
+        producers = [
+            threading.Thread(target=produce) for _ in range(args.producers)
+        ]
+        started = time.perf_counter()
+        for producer in producers:
+            producer.start()
+        for producer in producers:
+            producer.join()
+        produced = time.perf_counter() - started
+        # the baseline writes on the producer threads and has no flush
+        if hasattr(store, "flush"):
+            store.flush()
+        elapsed = time.perf_counter() - started
+
+        messages = args.producers * args.messages
+        print(
+            f"{label}: {messages / elapsed:.0f} persisted msg/s, producers "
+            f"done in {produced * 1000:.0f} ms, {pqueue.qsize()} rows"
+        )
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--producers", type=int, default=DEFAULT_PRODUCERS)
+    parser.add_argument("--messages", type=int, default=DEFAULT_MESSAGES)
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--sync-delay", type=float, default=DEFAULT_SYNC_DELAY)
+    parser.add_argument("--baseline", help="git revision to compare with")
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+    print(
+        f"{args.producers} producers x {args.messages} messages, batch size "
+        f"{args.batch_size}, {args.sync_delay * 1000:g} ms per commit"
+    )
+    if args.baseline:
+        run(load_baseline(args.baseline), args.baseline, args)
+    run(persistence, "current", args)
+    # the writer threads of the persistences are never stopped
+    sys.stdout.flush()
+    os._exit(0)
+
+
+if __name__ == "__main__":
+    main()
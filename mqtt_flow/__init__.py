@@ -1,6 +1,23 @@
-from mqtt_flow.core.mqtt_flow import MQTTFlow
-from mqtt_flow.config.loader import MQTTConfigLoader
-from mqtt_flow.mqtt_lib.mqtt_client import MQTTClient
+import importlib
 from mqtt_flow.utils.helpers import set_logger
 
-MQTTCustom = MQTTClient
+# paho, yaml and the flow internals are imported on first access only
+_LAZY_ATTRIBUTES = {
+    "MQTTFlow": ("mqtt_flow.core.mqtt_flow", "MQTTFlow"),
+    "MQTTConfigLoader": ("mqtt_flow.config.loader", "MQTTConfigLoader"),
+    "MQTTClient": ("mqtt_flow.mqtt_lib.mqtt_client", "MQTTClient"),
+    "MQTTCustom": ("mqtt_flow.mqtt_lib.mqtt_client", "MQTTClient"),
+    "FlowSupervisor": ("mqtt_flow.core.supervisor", "FlowSupervisor"),
+}
+
+__all__ = ["set_logger"] + list(_LAZY_ATTRIBUTES)
+
+
+def __getattr__(name):
+    if name not in _LAZY_ATTRIBUTES:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    module_name, attribute = _LAZY_ATTRIBUTES[name]
+    value = getattr(importlib.import_module(module_name), attribute)
+    globals()[name] = value
+    return value
@@ -0,0 +1,67 @@
+import argparse
+import os
+from mqtt_flow.config.loader import MQTTConfigLoader
+from mqtt_flow.core.supervisor import FlowSupervisor, wait_for_shutdown
+
+
+def main(argv=None):
+    """
+    Runs a flow from its YAML config until SIGINT or SIGTERM, in this
+    process or across worker processes (see FlowSupervisor).
+    """
+    parser = argparse.ArgumentParser(
+        prog="mqtt-flow",
+        description="Runs an MQTT flow from its YAML config.",
+    )
+    parser.add_argument(
+        "config",
+        nargs="?",
+        help="Config file, mqtt_conf.yml of the working directory "
+        "by default.",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        help="Worker processes, overrides supervisor.workers. "
+        "The flow runs in this process with 1.",
+    )
+    parser.add_argument(
+        "--cpu-affinity",
+        action="store_true",
+        help="Pins each worker process to a CPU.",
+    )
+    args = parser.parse_args(argv)
+
+    config = MQTTConfigLoader.get_config(args.config)
+    supervisor_config = dict(config.get("supervisor") or {})
+    if args.workers is not None:
+        supervisor_config["workers"] = args.workers
+    if args.cpu_affinity:
+        supervisor_config["cpu_affinity"] = True
+
+    # one process unless the supervisor section or the workers are given
+    if config.get("supervisor") is not None or args.workers is not None:
+        workers = supervisor_config.get("workers") or os.cpu_count()
+    else:
+        workers = 1
+
+    if workers > 1:
+        supervisor_config["workers"] = workers
+        FlowSupervisor(config, supervisor_config).run()
+        return
+
+    from mqtt_flow.core.mqtt_flow import MQTTFlow
+
+    flow = MQTTFlow(config)
+    flow.start()
+    try:
+        wait_for_shutdown()
+    finally:
+        flow.stop()
+    # the flow consumer threads never return
+    os._exit(0)
+
+
+if __name__ == "__main__":
+    main()
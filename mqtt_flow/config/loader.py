@@ -1,12 +1,15 @@
 import os
 from pathlib import Path
-import yaml
 import uuid
 import re
+from mqtt_flow.config.schema import compile_config
+from mqtt_flow.utils.helpers import configure_logging
 
 
 class MQTTConfigLoader:
     DEFAULT_CONFIG_FILE_NAME = "mqtt_conf.yml"
+    default_log_level = "INFO"
+    loggers = {}
 
     def __init__(
         self,
@@ -21,7 +24,6 @@ class MQTTConfigLoader:
         self.custom_vars = custom_vars
         self.config = self._load_raw_config(config_path)
 
-        # TODO : add validator
         for client_config in self.config.get("mqtt_clients", []):
             if not client_config.get("client_id"):
                 client_config["client_id"] = client_config["client_name"]
@@ -59,9 +61,38 @@ class MQTTConfigLoader:
         logging_config = config.get("logging", {})
         cls.default_log_level = logging_config.get("default_level", "INFO")
         cls.loggers = logging_config.get("loggers", {})
+        configure_logging(logging_config)
 
         return loader.config
 
+    @classmethod
+    def get_compiled_config(
+        cls,
+        config_path=None,
+        userdata=None,
+        sub_topics=None,
+        custom_vars=None,
+        persistence=None,
+    ):
+        """
+        Loads the config like `get_config` and compiles it.
+
+        Returns:
+            FlowConfig: The validated immutable config.
+
+        Raises:
+            ConfigValidationError: With the list of all the schema errors.
+        """
+        return compile_config(
+            cls.get_config(
+                config_path=config_path,
+                userdata=userdata,
+                sub_topics=sub_topics,
+                custom_vars=custom_vars,
+                persistence=persistence,
+            )
+        )
+
     def register_persistence(self, client_name, persistence):
         for client_config in self.config.get("mqtt_clients", []):
             if client_config.get("client_name") == client_name:
@@ -102,6 +133,7 @@ class MQTTConfigLoader:
             )
 
     def _load_raw_config(self, config_path=None):
+        import yaml
 
         class CustomLoader(yaml.SafeLoader):
             pass
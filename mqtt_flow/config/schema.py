@@ -0,0 +1,709 @@
+"""
+Compile step of the raw YAML configuration.
+
+`compile_config` validates the raw config dict returned by
+`MQTTConfigLoader.get_config`, reporting every schema error at once, and
+turns it into immutable config objects with `__slots__`. Known keys are
+read as attributes on the per message paths, cross references (rule ->
+task, task -> queue, queue -> pool) are resolved once, and the dict
+interface (`get`, `[]`, `in`) is kept for task specific options.
+"""
+
+from collections.abc import Mapping
+import re
+from types import MappingProxyType
+
+NUMBER = (int, float)
+ANY = None
+
+
+class ConfigValidationError(ValueError):
+    def __init__(self, errors):
+        self.errors = errors
+        super().__init__(
+            "Invalid configuration:\n"
+            + "\n".join(f"  - {error}" for error in errors)
+        )
+
+
+def freeze(value):
+    """Recursively turns dicts into read-only mappings and lists into tuples."""
+    if isinstance(value, dict):
+        return MappingProxyType(
+            {key: freeze(item) for key, item in value.items()}
+        )
+
+    if isinstance(value, list):
+        return tuple(freeze(item) for item in value)
+
+    return value
+
+
+class FrozenConfig(Mapping):
+    """
+    Immutable config section. The keys of `FIELDS` are slots, missing keys
+    are None. Subclasses list `FIELDS` and their resolved references in
+    `__slots__`.
+    """
+
+    __slots__ = ("_raw",)
+    FIELDS = {}
+    MUTABLE_FIELDS = ()
+
+    def __init__(self, raw, **resolved):
+        raw = {
+            key: value if key in self.MUTABLE_FIELDS else freeze(value)
+            for key, value in raw.items()
+        }
+        object.__setattr__(self, "_raw", MappingProxyType(raw))
+        for field in self.FIELDS:
+            object.__setattr__(self, field, raw.get(field))
+        for name, value in resolved.items():
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __getitem__(self, key):
+        return self._raw[key]
+
+    def __iter__(self):
+        return iter(self._raw)
+
+    def __len__(self):
+        return len(self._raw)
+
+    def __repr__(self):
+        return f"{type(self).__name__}({dict(self._raw)!r})"
+
+
+class ClientConfig(FrozenConfig):
+    FIELDS = {
+        "client_name": str,
+        "client_id": str,
+        "client_id_unique": bool,
+        "server": str,
+        "port": int,
+        "max_reconnect_delay": NUMBER,
+        "will_set_topic": str,
+        "will_set_payload": ANY,
+        "keep_alive": int,
+        "queue_size": int,
+        "batch_size": int,
+        "publish_interval": NUMBER,
+        "ssl_config": Mapping,
+        "userdata": dict,
+        "clean_session": bool,
+        "on_log_callback_enable": bool,
+        "exit_on_reconnect": bool,
+        "sub_topics": (list, tuple),
+        "persistence": ANY,
+        "persistence_config": Mapping,
+        "connections": int,
+        "connection_client_ids": (list, tuple),
+        "consumer_group": Mapping,
+        "protocol": int,
+        "mqtt5": Mapping,
+        "outgoing_queue": Mapping,
+        "disconnect_policy": Mapping,
+        "payload_spill_threshold": int,
+        "shard": int,
+    }
+    MUTABLE_FIELDS = ("userdata", "persistence")
+    __slots__ = tuple(FIELDS)
+
+
+class RuleConfig(FrozenConfig):
+    FIELDS = {
+        "name": str,
+        "source_client_name": str,
+        "topic": str,
+        "regex": str,
+        "condition": str,
+        "task": str,
+        "filter": Mapping,
+        "priority": int,
+        "binary": bool,
+    }
+    __slots__ = tuple(FIELDS) + ("task_config",)
+
+
+class TaskConfig(FrozenConfig):
+    """Task definition, any other key is a task specific option."""
+
+    FIELDS = {
+        "name": str,
+        "path": str,
+        "queue_name": str,
+        "client_for_userdata": str,
+        "filter": Mapping,
+        "priority": int,
+        "binary": bool,
+        "schedule": (list, tuple),
+    }
+    __slots__ = tuple(FIELDS) + ("queue", "task_class")
+
+
+class QueueConfig(FrozenConfig):
+    FIELDS = {
+        "name": str,
+        "size": int,
+        "pool": str,
+        "execution_rate_limit_per_second": NUMBER,
+        "priority_levels": int,
+        "default_priority": int,
+        "starvation_limit": int,
+    }
+    __slots__ = tuple(FIELDS) + ("pool_config",)
+
+
+class PoolConfig(FrozenConfig):
+    FIELDS = {
+        "name": str,
+        "type": str,
+        "max_workers": int,
+        "min_workers": int,
+        "initial_workers": int,
+        "algorithm": str,
+        "target_latency": NUMBER,
+        "backoff": NUMBER,
+        "sample_window": int,
+        "smoothing": NUMBER,
+    }
+    __slots__ = tuple(FIELDS)
+
+
+class FlowConfig(FrozenConfig):
+    FIELDS = {
+        "logging": Mapping,
+        "mqtt_clients": (list, tuple),
+        "pools": (list, tuple),
+        "tasks_queues": (list, tuple),
+        "tasks": Mapping,
+        "rules": (list, tuple),
+        "processing_chains": Mapping,
+        "last_value_cache": Mapping,
+        "supervisor": Mapping,
+    }
+    __slots__ = tuple(FIELDS) + ("clients",)
+
+
+NESTED_FIELDS = {
+    "ssl_config": {"alpn_protocol", "ca", "cert", "key"},
+    "persistence_config": {
+        "name",
+        "main_path",
+        "backup_path",
+        "batch_size",
+        "batch_upload_min_delay",
+        "upload_interval",
+        "rules",
+        "reupload_topic_cache_size",
+        "write_queue_size",
+        "group_commit_max_batches",
+        "group_commit_delay",
+        "replay_lanes",
+        "replay_recent_lanes",
+        "replay_retries",
+        "retention",
+    },
+    "persistence_rule": {"topic", "regex", "reupload_topic_formatters", "ttl"},
+    "retention": {"max_bytes", "max_messages", "max_age", "check_interval"},
+    "consumer_group": {"name", "mode", "members", "member_index"},
+    "mqtt5": {
+        "session_expiry_interval",
+        "receive_maximum",
+        "topic_alias_maximum",
+        "message_expiry_interval",
+        "user_properties",
+    },
+    "outgoing_queue": {
+        "size",
+        "priority_levels",
+        "default_priority",
+        "starvation_limit",
+    },
+    "disconnect_policy": {"buffer_size", "buffer_seconds", "spill"},
+    "filter": {"field", "deadband", "max_silence", "max_topics"},
+    "last_value_cache": {"max_size", "ttl", "topics"},
+    "last_value_cache_topic": {"client_name", "topic"},
+    "supervisor": {
+        "workers",
+        "cpu_affinity",
+        "heartbeat_interval",
+        "heartbeat_timeout",
+        "restart",
+    },
+    "chain_step": {"task"},
+    "schedule_trigger": {
+        "interval",
+        "cron",
+        "jitter",
+        "misfire_grace_time",
+        "coalesce",
+        "args",
+    },
+}
+
+CONSUMER_GROUP_MODES = ("shared", "partition")
+PROTOCOLS = (3, 5)
+POOL_ALGORITHMS = ("aimd", "gradient")
+
+
+class _Validator:
+    def __init__(self):
+        self.errors = []
+
+    def error(self, location, message):
+        self.errors.append(f"{location}: {message}")
+
+    def check_mapping(self, location, value):
+        if not isinstance(value, Mapping):
+            self.error(location, f"expected a mapping, got {value!r}")
+            return False
+        return True
+
+    def check_fields(self, location, raw, fields, allow_unknown=False):
+        for key, value in raw.items():
+            if key not in fields:
+                if not allow_unknown:
+                    self.error(location, f"unknown key '{key}'")
+                continue
+
+            expected = fields[key]
+            if value is None or expected is ANY:
+                continue
+
+            if isinstance(expected, tuple) and expected is NUMBER:
+                valid = isinstance(value, NUMBER) and not isinstance(
+                    value, bool
+                )
+            else:
+                valid = isinstance(value, expected) and (
+                    expected is bool or not isinstance(value, bool)
+                )
+
+            if not valid:
+                self.error(location, f"invalid type for '{key}': {value!r}")
+
+    def check_nested(self, location, raw, key, nested_name=None):
+        value = raw.get(key)
+        if value is None:
+            return
+        if self.check_mapping(f"{location}.{key}", value):
+            unknown = set(value) - NESTED_FIELDS[nested_name or key]
+            for unknown_key in sorted(unknown):
+                self.error(f"{location}.{key}", f"unknown key '{unknown_key}'")
+
+    def check_regex(self, location, regex):
+        if regex is None:
+            return
+        try:
+            re.compile(regex)
+        except (re.error, TypeError) as e:
+            self.error(location, f"invalid regex {regex!r}: {e}")
+
+    def check_topic_formatters(self, location, topic_formatters):
+        from mqtt_flow.utils.helpers import compile_topic_formatters
+
+        if topic_formatters is None:
+            return
+        if not isinstance(topic_formatters, (list, tuple)):
+            self.error(location, f"expected a list, got {topic_formatters!r}")
+            return
+        try:
+            compile_topic_formatters(topic_formatters)
+        except (ValueError, re.error) as e:
+            self.error(location, f"invalid topic formatter: {e}")
+
+    def check_required(self, location, raw, *keys):
+        for key in keys:
+            if raw.get(key) in (None, ""):
+                self.error(location, f"missing '{key}'")
+
+    def check_choice(self, location, key, value, choices):
+        if value is not None and value not in choices:
+            self.error(
+                location,
+                f"invalid '{key}' {value!r}, expected one of {list(choices)}",
+            )
+
+
+def _compile_client(validator, index, raw):
+    location = f"mqtt_clients[{index}]"
+    if not validator.check_mapping(location, raw):
+        return None
+
+    raw = dict(raw)
+    if raw.get("client_name"):
+        location = f"{location} '{raw['client_name']}'"
+    validator.check_required(location, raw, "client_name")
+    validator.check_fields(location, raw, ClientConfig.FIELDS)
+
+    for key in (
+        "ssl_config",
+        "consumer_group",
+        "mqtt5",
+        "outgoing_queue",
+        "disconnect_policy",
+    ):
+        validator.check_nested(location, raw, key)
+    validator.check_nested(location, raw, "persistence_config")
+
+    persistence_config = raw.get("persistence_config")
+    if isinstance(persistence_config, Mapping):
+        validator.check_nested(
+            f"{location}.persistence_config", persistence_config, "retention"
+        )
+        for rule_index, rule in enumerate(
+            persistence_config.get("rules") or []
+        ):
+            rule_location = (
+                f"{location}.persistence_config.rules[{rule_index}]"
+            )
+            if validator.check_mapping(rule_location, rule):
+                for key in sorted(
+                    set(rule) - NESTED_FIELDS["persistence_rule"]
+                ):
+                    validator.error(rule_location, f"unknown key '{key}'")
+                validator.check_regex(rule_location, rule.get("regex"))
+                validator.check_topic_formatters(
+                    f"{rule_location}.reupload_topic_formatters",
+                    rule.get("reupload_topic_formatters"),
+                )
+
+    consumer_group = raw.get("consumer_group")
+    if isinstance(consumer_group, Mapping):
+        validator.check_choice(
+            f"{location}.consumer_group",
+            "mode",
+            consumer_group.get("mode"),
+            CONSUMER_GROUP_MODES,
+        )
+
+    validator.check_choice(
+        location, "protocol", raw.get("protocol"), PROTOCOLS
+    )
+    # a wrong type is reported by check_fields
+    connections = raw.get("connections", 1)
+    if connections is None or (type(connections) is int and connections < 1):
+        validator.error(location, "'connections' must be at least 1")
+    if type(connections) is not int or connections < 1:
+        connections = 1
+
+    if not raw.get("client_id"):
+        raw["client_id"] = raw.get("client_name")
+
+    if connections > 1 and not raw.get("connection_client_ids"):
+        raw["connection_client_ids"] = [raw["client_id"]] + [
+            f"{raw['client_id']}_{index}" for index in range(1, connections)
+        ]
+
+    return ClientConfig(raw)
+
+
+def _compile_pool(validator, index, raw):
+    from mqtt_flow.core.tasks_executor import TasksExecutor
+
+    location = f"pools[{index}]"
+    if not validator.check_mapping(location, raw):
+        return None
+
+    if raw.get("name"):
+        location = f"{location} '{raw['name']}'"
+    validator.check_required(location, raw, "name", "type")
+    validator.check_fields(location, raw, PoolConfig.FIELDS)
+    validator.check_choice(
+        location, "type", raw.get("type"), tuple(TasksExecutor.POOL_TYPES)
+    )
+    validator.check_choice(
+        location, "algorithm", raw.get("algorithm"), POOL_ALGORITHMS
+    )
+    if raw.get("type") == "adaptive_thread":
+        validator.check_required(location, raw, "max_workers")
+        max_workers = raw.get("max_workers")
+        for key in ("min_workers", "initial_workers"):
+            value = raw.get(key)
+            if (
+                isinstance(value, int)
+                and isinstance(max_workers, int)
+                and not 1 <= value <= max_workers
+            ):
+                validator.error(
+                    location, f"'{key}' must be between 1 and 'max_workers'"
+                )
+    return PoolConfig(raw)
+
+
+def _compile_queue(validator, index, raw, pools):
+    location = f"tasks_queues[{index}]"
+    if not validator.check_mapping(location, raw):
+        return None
+
+    raw = dict(raw)
+    if raw.get("name"):
+        location = f"{location} '{raw['name']}'"
+    validator.check_required(location, raw, "name", "pool")
+    validator.check_fields(location, raw, QueueConfig.FIELDS)
+
+    pool_name = raw.get("pool")
+    if pool_name and pool_name not in pools:
+        validator.error(location, f"unknown pool '{pool_name}'")
+
+    # a missing size is an unbounded queue
+    if raw.get("size") is None:
+        raw["size"] = 0
+
+    return QueueConfig(raw, pool_config=pools.get(pool_name))
+
+
+def _compile_task(validator, task_name, raw, queues, clients):
+    from mqtt_flow.core.task.task_loader import load_task_class
+
+    location = f"tasks.{task_name}"
+    if not validator.check_mapping(location, raw):
+        return None
+
+    raw = dict(raw, name=task_name)
+    validator.check_required(location, raw, "path", "queue_name")
+    validator.check_fields(
+        location, raw, TaskConfig.FIELDS, allow_unknown=True
+    )
+    validator.check_nested(location, raw, "filter")
+    validator.check_topic_formatters(
+        f"{location}.topic_formatters", raw.get("topic_formatters")
+    )
+
+    queue_name = raw.get("queue_name")
+    if queue_name and queue_name not in queues:
+        validator.error(location, f"unknown queue '{queue_name}'")
+
+    client_for_userdata = raw.get("client_for_userdata")
+    if client_for_userdata and client_for_userdata not in clients:
+        validator.error(location, f"unknown client '{client_for_userdata}'")
+
+    schedule = raw.get("schedule")
+    if isinstance(schedule, (list, tuple)):
+        _check_schedule(validator, location, raw, schedule)
+
+    task_class = None
+    path = raw.get("path")
+    if isinstance(path, str):
+        try:
+            task_class = load_task_class(path)
+        except Exception as e:
+            validator.error(location, f"cannot load task class {path}: {e}")
+
+    check_config = getattr(task_class, "check_config", None)
+    if check_config is not None:
+        try:
+            check_config(raw)
+        except ValueError as e:
+            validator.error(location, str(e))
+
+    return TaskConfig(raw, queue=queues.get(queue_name), task_class=task_class)
+
+
+def _check_schedule(validator, location, raw, schedule):
+    from mqtt_flow.core.scheduler import CronExpression
+
+    if schedule and not raw.get("client_for_userdata"):
+        validator.error(
+            location, "scheduled tasks need a 'client_for_userdata'"
+        )
+
+    for index, trigger in enumerate(schedule):
+        trigger_location = f"{location}.schedule[{index}]"
+        if not validator.check_mapping(trigger_location, trigger):
+            continue
+
+        for key in sorted(set(trigger) - NESTED_FIELDS["schedule_trigger"]):
+            validator.error(trigger_location, f"unknown key '{key}'")
+
+        interval = trigger.get("interval")
+        cron = trigger.get("cron")
+        if (interval is None) == (cron is None):
+            validator.error(
+                trigger_location, "expected one of 'interval' or 'cron'"
+            )
+        if interval is not None and (
+            not isinstance(interval, NUMBER)
+            or isinstance(interval, bool)
+            or interval <= 0
+        ):
+            validator.error(trigger_location, f"invalid interval {interval!r}")
+        if cron is not None:
+            try:
+                CronExpression(cron)
+            except (ValueError, AttributeError) as e:
+                validator.error(trigger_location, f"invalid cron: {e}")
+
+
+def _compile_rule(validator, index, raw, clients, tasks):
+    location = f"rules[{index}]"
+    if not validator.check_mapping(location, raw):
+        return None
+
+    if raw.get("name"):
+        location = f"{location} '{raw['name']}'"
+    validator.check_required(
+        location, raw, "name", "source_client_name", "task"
+    )
+    validator.check_fields(location, raw, RuleConfig.FIELDS)
+    validator.check_nested(location, raw, "filter")
+    validator.check_regex(location, raw.get("regex"))
+
+    condition = raw.get("condition")
+    if isinstance(condition, str):
+        try:
+            compile(condition, "<condition>", "eval")
+        except SyntaxError as e:
+            validator.error(location, f"invalid condition {condition!r}: {e}")
+
+    source_client_name = raw.get("source_client_name")
+    if source_client_name and source_client_name not in clients:
+        validator.error(location, f"unknown client '{source_client_name}'")
+
+    task_name = raw.get("task")
+    if isinstance(task_name, str) and task_name not in tasks:
+        validator.error(location, f"unknown task '{task_name}'")
+
+    return RuleConfig(
+        raw,
+        task_config=(
+            tasks.get(task_name) if isinstance(task_name, str) else None
+        ),
+    )
+
+
+def _check_chains(validator, chains, tasks):
+    for chain_name, steps in chains.items():
+        location = f"processing_chains.{chain_name}"
+        if chain_name in tasks:
+            validator.error(location, "has the name of a task")
+        if not isinstance(steps, list) or not steps:
+            validator.error(location, "expected a non empty list of steps")
+            continue
+
+        for index, step in enumerate(steps):
+            step_location = f"{location}[{index}]"
+            if not validator.check_mapping(step_location, step):
+                continue
+            for key in sorted(set(step) - NESTED_FIELDS["chain_step"]):
+                validator.error(step_location, f"unknown key '{key}'")
+            if not isinstance(step.get("task"), str) or (
+                step["task"] not in tasks
+            ):
+                validator.error(
+                    step_location, f"unknown task '{step.get('task')}'"
+                )
+
+
+def _check_unique(validator, section, names):
+    seen = set()
+    for name in names:
+        if name in seen:
+            validator.error(section, f"duplicate name '{name}'")
+        seen.add(name)
+
+
+def compile_config(config):
+    """
+    Validates the raw config and compiles it into a FlowConfig.
+
+    Args:
+        config (dict): Raw config as returned by MQTTConfigLoader.get_config.
+
+    Returns:
+        FlowConfig: The immutable compiled config.
+
+    Raises:
+        ConfigValidationError: With the list of all the schema errors.
+    """
+    if isinstance(config, FlowConfig):
+        return config
+
+    validator = _Validator()
+    if not validator.check_mapping("config", config):
+        raise ConfigValidationError(validator.errors)
+
+    validator.check_fields("config", config, FlowConfig.FIELDS)
+    validator.check_nested("config", config, "last_value_cache")
+    validator.check_nested("config", config, "supervisor")
+
+    def compiled(items):
+        return tuple(item for item in items if item is not None)
+
+    clients = compiled(
+        _compile_client(validator, index, raw)
+        for index, raw in enumerate(config.get("mqtt_clients") or [])
+    )
+    _check_unique(
+        validator,
+        "mqtt_clients",
+        [client.client_name for client in clients if client.client_name],
+    )
+    clients_by_name = {client.client_name: client for client in clients}
+
+    pools = compiled(
+        _compile_pool(validator, index, raw)
+        for index, raw in enumerate(config.get("pools") or [])
+    )
+    _check_unique(validator, "pools", [pool.name for pool in pools])
+    pools_by_name = {pool.name: pool for pool in pools}
+
+    queues = compiled(
+        _compile_queue(validator, index, raw, pools_by_name)
+        for index, raw in enumerate(config.get("tasks_queues") or [])
+    )
+    _check_unique(validator, "tasks_queues", [queue.name for queue in queues])
+    queues_by_name = {queue.name: queue for queue in queues}
+
+    tasks = {}
+    for task_name, raw in (config.get("tasks") or {}).items():
+        task = _compile_task(
+            validator, task_name, raw, queues_by_name, clients_by_name
+        )
+        if task is not None:
+            tasks[task_name] = task
+
+    chains = config.get("processing_chains") or {}
+    _check_chains(validator, chains, tasks)
+    runnables = {**{chain_name: None for chain_name in chains}, **tasks}
+
+    rules = compiled(
+        _compile_rule(validator, index, raw, clients_by_name, runnables)
+        for index, raw in enumerate(config.get("rules") or [])
+    )
+    _check_unique(validator, "rules", [rule.name for rule in rules])
+
+    last_value_cache = config.get("last_value_cache")
+    if isinstance(last_value_cache, Mapping):
+        for index, topic_config in enumerate(
+            last_value_cache.get("topics") or []
+        ):
+            location = f"last_value_cache.topics[{index}]"
+            if validator.check_mapping(location, topic_config):
+                for key in sorted(
+                    set(topic_config) - NESTED_FIELDS["last_value_cache_topic"]
+                ):
+                    validator.error(location, f"unknown key '{key}'")
+
+    if validator.errors:
+        raise ConfigValidationError(validator.errors)
+
+    return FlowConfig(
+        dict(
+            config,
+            mqtt_clients=clients,
+            pools=pools,
+            tasks_queues=queues,
+            tasks=MappingProxyType(tasks),
+            rules=rules,
+            processing_chains=chains,
+        ),
+        clients=MappingProxyType(clients_by_name),
+    )
@@ -0,0 +1,176 @@
+from types import GeneratorType
+
+
+class ChainStep:
+    __slots__ = ("task", "task_class", "task_config", "task_queue", "pool")
+
+    def __init__(self, task, pool):
+        self.task = task
+        self.task_class = task.task_class
+        self.task_config = task.task_config
+        self.task_queue = task.task_queue
+        self.pool = pool
+
+
+class ChainTask:
+    """
+    Queued unit of work of a processing chain. Runs the chain steps from
+    `step_index` in process, on the worker executing it.
+    """
+
+    def __init__(
+        self,
+        chain,
+        userdata,
+        step_index,
+        messages,
+        user_properties,
+        priority=None,
+        task_kwargs=None,
+    ):
+        self.chain = chain
+        self.name = chain.name
+        self.userdata = userdata
+        self.step_index = step_index
+        self.messages = messages
+        self.user_properties = user_properties
+        self.priority = priority
+        self.task_kwargs = task_kwargs
+
+    def process(self):
+        self.chain.run(
+            self.userdata,
+            self.step_index,
+            self.messages,
+            self.user_properties,
+            self.priority,
+            self.task_kwargs,
+        )
+
+    def __str__(self):
+        return f"Chain {self.name} from step {self.step_index}"
+
+
+class Chain:
+    """
+    Processing chain defined in the `processing_chains` config section.
+
+    Each step refers to a task of the `tasks` section. Steps are fused and
+    run one after the other on the same worker, the messages returned by
+    the `process` method of a step are the input of the next step:
+        - None ends the chain for this message (filter),
+        - a (topic, payload) tuple is passed to the next step,
+        - a list or a generator of (topic, payload) tuples fans out.
+
+    A step whose task queue uses a different pool than the previous step
+    starts a new queued ChainTask on that queue, this is the only place
+    where a queue hand off happens.
+    """
+
+    def __init__(self, mqtt_flow_config, chain_name, tasks, tasks_queues):
+        self.config = mqtt_flow_config
+        self.name = chain_name
+        self.chain_config = self.config.processing_chains[chain_name]
+
+        self.steps = []
+        for step_config in self.chain_config:
+            task_name = step_config.get("task")
+            if task_name not in tasks:
+                raise ValueError(
+                    f"Unknown task {task_name} in processing chain {chain_name}"
+                )
+            task = tasks[task_name]
+            self.steps.append(ChainStep(task, task.task_config.queue.pool))
+
+        if not self.steps:
+            raise ValueError(f"Processing chain {chain_name} has no steps")
+
+        self.task_queue = self.steps[0].task_queue
+        self.change_filter = self.steps[0].task.change_filter
+        self.binary = self.steps[0].task.binary
+
+    def submit(
+        self,
+        userdata=None,
+        task_args=None,
+        task_kwargs=None,
+        user_properties=None,
+        priority=None,
+    ):
+        userdata = self.steps[0].task.get_userdata(userdata)
+        if priority is None:
+            priority = self.steps[0].task_config.priority
+        self.task_queue.put(
+            ChainTask(
+                self,
+                userdata,
+                0,
+                [tuple(task_args or ())],
+                user_properties,
+                priority,
+                task_kwargs,
+            )
+        )
+
+    def _step_outputs(self, result):
+        if result is None:
+            return []
+
+        if isinstance(result, tuple):
+            return [result]
+
+        if isinstance(result, (list, GeneratorType)):
+            return list(result)
+
+        raise TypeError(
+            f"Step of chain {self.name} returned {type(result).__name__}, "
+            "expected None, a (topic, payload) tuple or a list of them"
+        )
+
+    def run(
+        self,
+        userdata,
+        step_index,
+        messages,
+        user_properties=None,
+        priority=None,
+        task_kwargs=None,
+    ):
+        """
+        Runs the steps from step_index. `task_kwargs` are the keyword
+        arguments of the first step, the next steps only get the messages.
+        """
+        for index in range(step_index, len(self.steps)):
+            step = self.steps[index]
+
+            if index != step_index and (
+                step.pool != self.steps[index - 1].pool
+            ):
+                step.task_queue.put(
+                    ChainTask(
+                        self,
+                        userdata,
+                        index,
+                        messages,
+                        user_properties,
+                        priority,
+                        task_kwargs if index == 0 else None,
+                    )
+                )
+                return
+
+            kwargs = (task_kwargs or {}) if index == 0 else {}
+            outputs = []
+            for task_args in messages:
+                task = step.task_class(
+                    userdata, step.task_config, *task_args, **kwargs
+                )
+                if user_properties:
+                    task.user_properties = user_properties
+                if priority is not None:
+                    task.priority = priority
+                outputs.extend(self._step_outputs(task.process()))
+
+            if not outputs:
+                return
+            messages = outputs
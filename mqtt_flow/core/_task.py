@@ -1,31 +1,64 @@
-from mqtt_flow.core.task.task_loader import load_task_class
+from mqtt_flow.core.change_filter import ChangeFilter
 
 
 class Task:
-    def __init__(self, mqtt_flow_config, task_name, tasks_queues):
+    def __init__(
+        self, mqtt_flow_config, task_name, tasks_queues, clients_userdata
+    ):
         self.config = mqtt_flow_config
         self.name = task_name
-        self.task_config = self.config.get("tasks", {}).get(task_name)
-        self.task_config["name"] = task_name
-        self.task_class = load_task_class(self.task_config.get("path"))
-        self.task_queue_name = self.task_config.get("queue_name")
+        self.task_config = self.config.tasks[task_name]
+        self.task_class = self.task_config.task_class
+        self.task_queue_name = self.task_config.queue_name
         self.task_queue = tasks_queues.get(self.task_queue_name)
+        self.binary = bool(self.task_config.binary)
+        self.change_filter = (
+            ChangeFilter(self.task_config.filter)
+            if self.task_config.filter
+            else None
+        )
+        self._default_userdata = clients_userdata.get(
+            self.task_config.client_for_userdata
+        )
+
+        load = getattr(self.task_class, "load", None)
+        if load is not None:
+            load(self.task_config)
+
+    def unload(self):
+        """Releases the state kept by the task class for this task."""
+        unload = getattr(self.task_class, "unload", None)
+        if unload is not None:
+            unload(self.task_config)
 
-    def submit(self, userdata=None, task_args=None, task_kwargs=None):
+    def get_userdata(self, userdata=None):
+        if userdata is None:
+            userdata = self._default_userdata
+
+        return userdata
+
+    def submit(
+        self,
+        userdata=None,
+        task_args=None,
+        task_kwargs=None,
+        user_properties=None,
+        priority=None,
+    ):
         if task_args is None:
             task_args = tuple()
         if task_kwargs is None:
             task_kwargs = {}
 
         if userdata is None:
-            client_for_userdata = self.task_config.get("client_for_userdata")
-
-            for client_config in self.config.get("mqtt_clients", []):
-                if client_config.get("client_name") == client_for_userdata:
-                    userdata = client_config.get("userdata")
+            userdata = self._default_userdata
 
         task = self.task_class(
             userdata, self.task_config, *task_args, **task_kwargs
         )
+        if user_properties:
+            task.user_properties = user_properties
+        if priority is not None:
+            task.priority = priority
 
         self.task_queue.put(task)
@@ -0,0 +1,88 @@
+from collections import OrderedDict
+import numbers
+import threading
+import time
+
+
+class ChangeFilter:
+    """
+    Report by exception filter. A message is forwarded only if its value
+    changed beyond the deadband since the last message forwarded on the same
+    topic, or if nothing was forwarded on the topic for `max_silence`
+    seconds (heartbeat).
+
+    Last forwarded values are kept in an LRU bounded to `max_topics`.
+
+    Config:
+        field (str): Payload field compared, the whole payload by default.
+        deadband (float): Minimum absolute change of numeric values.
+            Default: 0, any change is forwarded.
+        max_silence (float): Seconds after which a message is forwarded even
+            if unchanged. Default: None, no heartbeat.
+        max_topics (int): Maximum number of topics tracked. Default: 10000.
+    """
+
+    DEFAULT_MAX_TOPICS = 10000
+
+    def __init__(self, filter_config):
+        self.field = filter_config.get("field")
+        self.deadband = filter_config.get("deadband", 0)
+        self.max_silence = filter_config.get("max_silence")
+        self.max_topics = filter_config.get(
+            "max_topics", self.DEFAULT_MAX_TOPICS
+        )
+        self._last_forwarded = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get_value(self, payload):
+        if self.field is None:
+            return payload
+
+        if isinstance(payload, dict):
+            return payload.get(self.field)
+
+        return None
+
+    def _is_changed(self, value, last_value):
+        if (
+            isinstance(value, numbers.Real)
+            and isinstance(last_value, numbers.Real)
+            and not isinstance(value, bool)
+            and not isinstance(last_value, bool)
+        ):
+            if self.deadband:
+                return abs(value - last_value) > self.deadband
+        return value != last_value
+
+    def should_forward(self, topic, payload):
+        """
+        Checks if the message has to be forwarded and records it if so.
+
+        Args:
+            topic (str): The message topic.
+            payload: The message payload.
+
+        Returns:
+            bool: True if the message has to be forwarded, False otherwise.
+        """
+        value = self._get_value(payload)
+        now = time.monotonic()
+
+        with self._lock:
+            last = self._last_forwarded.get(topic)
+
+            if last is not None:
+                last_value, last_forwarded_at = last
+                self._last_forwarded.move_to_end(topic)
+
+                if not self._is_changed(value, last_value) and (
+                    self.max_silence is None
+                    or now - last_forwarded_at < self.max_silence
+                ):
+                    return False
+
+            self._last_forwarded[topic] = (value, now)
+            if len(self._last_forwarded) > self.max_topics:
+                self._last_forwarded.popitem(last=False)
+
+        return True
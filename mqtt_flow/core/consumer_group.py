@@ -0,0 +1,64 @@
+import zlib
+
+
+class ConsumerGroup:
+    """
+    Splits the subscribed topic stream of a client between several MQTTFlow
+    instances.
+
+    Two modes are supported:
+        shared: subscriptions are prefixed with `$share/<name>/` and the
+            broker load balances messages between the group members
+            (MQTT v5 shared subscriptions).
+        partition: every member subscribes to the raw topics and only keeps
+            the topics hashed to its `member_index` out of `members`. This
+            is the fallback for brokers without shared subscriptions and
+            keeps per-topic ordering.
+
+    Messages are always delivered with their original topic, so rules keep
+    matching on the un-prefixed topic.
+    """
+
+    SHARED_MODE = "shared"
+    PARTITION_MODE = "partition"
+    MODES = (SHARED_MODE, PARTITION_MODE)
+
+    def __init__(self, group_config):
+        self.name = group_config.get("name")
+        self.mode = group_config.get("mode", self.SHARED_MODE)
+        self.members = int(group_config.get("members", 1))
+        self.member_index = int(group_config.get("member_index", 0))
+
+        if self.mode not in self.MODES:
+            raise ValueError(f"Unknown consumer group mode: {self.mode}")
+
+        if self.mode == self.SHARED_MODE and not self.name:
+            raise ValueError("Missing 'name' in shared consumer group")
+
+        if not 0 <= self.member_index < self.members:
+            raise ValueError(
+                f"Consumer group member_index {self.member_index} out of "
+                f"range for {self.members} members"
+            )
+
+    def subscription_topic(self, topic):
+        """
+        Returns the topic to subscribe to for the given subscription topic,
+        either a topic string or a (topic, qos) tuple.
+        """
+        if self.mode != self.SHARED_MODE:
+            return topic
+
+        if isinstance(topic, (tuple, list)):
+            return (f"$share/{self.name}/{topic[0]}", *topic[1:])
+
+        return f"$share/{self.name}/{topic}"
+
+    def owns(self, topic):
+        """
+        Checks if messages on the given topic are processed by this member.
+        """
+        if self.mode != self.PARTITION_MODE or self.members == 1:
+            return True
+
+        return zlib.crc32(topic.encode()) % self.members == self.member_index
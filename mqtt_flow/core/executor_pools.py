@@ -1,6 +1,6 @@
 from concurrent.futures import ThreadPoolExecutor
-from multiprocessing import Pool
 import threading
+import time
 import uuid
 from mqtt_flow.utils.helpers import get_logger
 
@@ -94,3 +94,183 @@ class ProcessPool:
 
     def submit(self, task, *args, **kwargs):
         return self.pool.apply_async(task, args=args, **kwargs)
+
+
+class AdaptiveThreadPool:
+    """
+    Thread pool whose concurrency limit is discovered from the observed
+    task latency and task queue depth, between `min_workers` and
+    `max_workers`.
+
+    Algorithms:
+        aimd: every `sample_window` completed tasks, the limit is
+            multiplied by `backoff` if the average latency is above
+            `target_latency`, otherwise increased by 1 if tasks are
+            waiting in the queues.
+        gradient: the limit follows the ratio between the lowest observed
+            latency and the current average latency, plus a headroom of
+            sqrt(limit) while tasks are waiting in the queues.
+
+    `submit` blocks while the limit is reached, so tasks wait in their
+    queue instead of piling up in the executor.
+    """
+
+    AIMD = "aimd"
+    GRADIENT = "gradient"
+    DEFAULT_MIN_WORKERS = 1
+    DEFAULT_TARGET_LATENCY = 1
+    DEFAULT_BACKOFF = 0.9
+    DEFAULT_SAMPLE_WINDOW = 20
+    DEFAULT_SMOOTHING = 0.2
+    MIN_LATENCY_DECAY = 1.01
+
+    def __init__(self, pool_config):
+        self.name = pool_config.get("name")
+        self.max_workers = pool_config.get("max_workers")
+        self.min_workers = pool_config.get(
+            "min_workers", self.DEFAULT_MIN_WORKERS
+        )
+        self.algorithm = pool_config.get("algorithm", self.AIMD)
+        self.target_latency = pool_config.get(
+            "target_latency", self.DEFAULT_TARGET_LATENCY
+        )
+        self.backoff = pool_config.get("backoff", self.DEFAULT_BACKOFF)
+        self.sample_window = pool_config.get(
+            "sample_window", self.DEFAULT_SAMPLE_WINDOW
+        )
+        self.smoothing = pool_config.get("smoothing", self.DEFAULT_SMOOTHING)
+        self.limit = float(
+            pool_config.get("initial_workers", self.min_workers)
+        )
+        self.logger = get_logger("executor_pools")
+        self._pool = ThreadPoolExecutor(
+            max_workers=self.max_workers,
+            thread_name_prefix=f"flow_task_{self.name}",
+        )
+        self._condition = threading.Condition()
+        self._queues = []
+        self._inflight = 0
+        self._latencies = []
+        self._min_latency = None
+        self._avg_latency = None
+        self._increases = 0
+        self._decreases = 0
+        self._last_decision = None
+
+        if self.max_workers is None:
+            raise ValueError(f"Adaptive pool {self.name} needs max_workers")
+
+        if self.algorithm not in (self.AIMD, self.GRADIENT):
+            raise ValueError(
+                f"Unknown adaptive pool algorithm {self.algorithm}"
+            )
+
+    @property
+    def resource_available(self):
+        return True
+
+    @property
+    def running_tasks_count(self):
+        return self._inflight
+
+    @property
+    def queue_depth(self):
+        return sum(task_queue.qsize() for task_queue in self._queues)
+
+    @property
+    def metrics(self):
+        return {
+            "limit": int(self.limit),
+            "inflight": self._inflight,
+            "queue_depth": self.queue_depth,
+            "avg_latency": self._avg_latency,
+            "min_latency": self._min_latency,
+            "increases": self._increases,
+            "decreases": self._decreases,
+            "last_decision": self._last_decision,
+        }
+
+    def register_queue(self, task_queue):
+        """Registers a task queue whose depth drives the limit."""
+        self._queues.append(task_queue)
+
+    def _update_limit(self, avg_latency):
+        limit = self.limit
+        waiting = self.queue_depth > 0
+
+        # the lowest latency slowly decays so it adapts to new conditions
+        self._min_latency = (
+            avg_latency
+            if self._min_latency is None
+            else min(self._min_latency * self.MIN_LATENCY_DECAY, avg_latency)
+        )
+
+        if self.algorithm == self.AIMD:
+            if avg_latency > self.target_latency:
+                limit = limit * self.backoff
+            elif waiting:
+                limit = limit + 1
+        else:
+            gradient = (
+                max(0.5, min(1, self._min_latency / avg_latency))
+                if avg_latency > 0
+                else 1
+            )
+            new_limit = limit * gradient + (limit**0.5 if waiting else 0)
+            limit = limit * (1 - self.smoothing) + new_limit * self.smoothing
+
+        limit = max(self.min_workers, min(self.max_workers, limit))
+
+        if int(limit) > int(self.limit):
+            self._increases += 1
+            self._last_decision = "increase"
+        elif int(limit) < int(self.limit):
+            self._decreases += 1
+            self._last_decision = "decrease"
+        else:
+            self._last_decision = "hold"
+
+        if self._last_decision != "hold":
+            self.logger.debug(
+                "Pool %s limit %s -> %s (avg latency %.3fs)",
+                self.name,
+                int(self.limit),
+                int(limit),
+                avg_latency,
+            )
+
+        self.limit = limit
+        self._avg_latency = avg_latency
+
+    def _run(self, task, *args, **kwargs):
+        started_at = time.monotonic()
+        try:
+            task(*args, **kwargs)
+        except Exception:
+            self.logger.exception("Exception in Task Consumer")
+        finally:
+            latency = time.monotonic() - started_at
+            with self._condition:
+                self._inflight -= 1
+                try:
+                    self._latencies.append(latency)
+                    if len(self._latencies) >= self.sample_window:
+                        latencies, self._latencies = self._latencies, []
+                        self._update_limit(sum(latencies) / len(latencies))
+                except Exception:
+                    self.logger.exception(
+                        "Failed to update the limit of pool %s", self.name
+                    )
+                finally:
+                    # waiting submits are woken up whatever happens above
+                    self._condition.notify_all()
+
+    def submit(self, task, *args, **kwargs):
+        kwargs.pop("error_callback", None)
+
+        with self._condition:
+            while self._inflight >= int(self.limit):
+                self._condition.wait()
+            self._inflight += 1
+
+        return self._pool.submit(self._run, task, *args, **kwargs)
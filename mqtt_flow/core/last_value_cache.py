@@ -0,0 +1,101 @@
+from collections import OrderedDict
+import functools
+import threading
+import time
+from mqtt_flow.utils.helpers import topic_matches_filter
+
+
+class LastValueCache:
+    """
+    Thread safe cache of the last payload received per client and topic,
+    filled by MQTTFlow from the incoming messages.
+
+    Config:
+        topics (list of dict): Cached topics, each with an MQTT topic filter
+            `topic` and an optional `client_name`. All incoming messages are
+            cached if not defined.
+        max_size (int): Maximum number of topics kept, least recently updated
+            topics are evicted first. Default: 10000.
+        ttl (float): Seconds after which a value expires. Default: None,
+            values never expire.
+    """
+
+    DEFAULT_MAX_SIZE = 10000
+    DEFAULT_FILTER_CACHE_SIZE = 4096
+
+    def __init__(self, cache_config):
+        self.max_size = cache_config.get("max_size", self.DEFAULT_MAX_SIZE)
+        self.ttl = cache_config.get("ttl")
+        self._topic_filters = [
+            (topic_config.get("client_name"), topic_config.get("topic"))
+            for topic_config in cache_config.get("topics", [])
+        ]
+        self._values = OrderedDict()
+        self._lock = threading.Lock()
+        self.is_cached = functools.lru_cache(
+            maxsize=self.DEFAULT_FILTER_CACHE_SIZE
+        )(self._is_cached)
+
+    def _is_cached(self, client_name, topic):
+        if not self._topic_filters:
+            return True
+
+        return any(
+            (filter_client_name is None or filter_client_name == client_name)
+            and topic_matches_filter(topic, topic_filter)
+            for filter_client_name, topic_filter in self._topic_filters
+        )
+
+    def _is_expired(self, updated_at, now):
+        return self.ttl is not None and now - updated_at > self.ttl
+
+    def update(self, client_name, topic, payload):
+        if not self.is_cached(client_name, topic):
+            return
+
+        key = (client_name, topic)
+        with self._lock:
+            self._values[key] = (payload, time.monotonic())
+            self._values.move_to_end(key)
+            if len(self._values) > self.max_size:
+                self._values.popitem(last=False)
+
+    def get(self, client_name, topic, default=None):
+        """
+        Returns the last payload received by the client on the topic, or
+        the default if there is none or it expired.
+        """
+        key = (client_name, topic)
+        with self._lock:
+            value = self._values.get(key)
+            if value is None:
+                return default
+
+            payload, updated_at = value
+            if self._is_expired(updated_at, time.monotonic()):
+                del self._values[key]
+                return default
+
+        return payload
+
+    def snapshot(self, topic_filter, client_name=None):
+        """
+        Returns a dict of topic to last payload for all the topics matching
+        the MQTT topic filter, for the given client or for all clients.
+        """
+        now = time.monotonic()
+        snapshot = {}
+
+        with self._lock:
+            for key, (payload, updated_at) in list(self._values.items()):
+                if self._is_expired(updated_at, now):
+                    del self._values[key]
+                    continue
+
+                value_client_name, topic = key
+                if (
+                    client_name is None or client_name == value_client_name
+                ) and topic_matches_filter(topic, topic_filter):
+                    snapshot[topic] = payload
+
+        return snapshot
@@ -5,20 +5,28 @@ import os
 class OnConnectCallback:
 
     @classmethod
-    def get_callback(cls, sub_topics=None):
+    def get_callback(cls, sub_topics=None, consumer_group=None):
         """
         Returns the actual on_connect callback function configured with the provided subscription topics.
         Args:
             sub_topics (list of tuples): Subscription topics.
+            consumer_group (ConsumerGroup): Consumer group the subscriptions
+                are shared with, if any.
         Returns:
             function: The configured on_connect callback function.
         """
         if sub_topics is None:
             sub_topics = []
 
+        if consumer_group is not None:
+            sub_topics = [
+                consumer_group.subscription_topic(topic)
+                for topic in sub_topics
+            ]
+
         logger = get_logger("on_connect_mqtt_callback")
 
-        def on_connect(client, userdata, flags, rc):
+        def on_connect(client, userdata, flags, rc, properties=None):
             """
             The actual on_connect callback that subscribes to the specified topics.
             Args:
@@ -26,6 +34,7 @@ class OnConnectCallback:
                 userdata: The private user data as set in Client() or userdata_set().
                 flags: Response flags sent by the broker.
                 rc: The connection result.
+                properties: The MQTT v5 CONNACK properties, None for v3.1.1.
             """
 
             if client.first_time_connected and client.exit_on_reconnect:
@@ -47,4 +56,12 @@ class OnConnectCallback:
             for topic in sub_topics:
                 client.subscribe(topic)
 
+            # reply topics of the task requests, subscribed on first use
+            pending_requests = (userdata or {}).get("_pending_requests")
+            if pending_requests is not None:
+                for topic in pending_requests.get_reply_filters(
+                    userdata["_client_name"]
+                ):
+                    client.subscribe(topic)
+
         return on_connect
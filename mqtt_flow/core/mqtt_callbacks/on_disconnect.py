@@ -11,13 +11,14 @@ class OnDisconnectCallback:
         """
         logger = get_logger("mqtt_on_disconnect_callback")
 
-        def on_disconnect(client, userdata, rc):
+        def on_disconnect(client, userdata, rc, properties=None):
             """
             The actual on_disconnect callback function.
             Args:
                 client: The MQTT client instance.
                 userdata: The private user data as set in Client() or userdata_set().
                 rc: The connection result.
+                properties: The MQTT v5 DISCONNECT properties, None for v3.1.1.
             """
             logger.warning(
                 f"MQTT client {client._client_id} disconnected with result code {rc}"
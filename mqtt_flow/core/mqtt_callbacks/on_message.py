@@ -1,12 +1,25 @@
 from mqtt_flow.utils.helpers import get_logger
-import json
+from mqtt_flow.utils.payload import spill_payload
+
+
+def _is_reply(userdata, topic):
+    """Replies to the requests of this member are never shared."""
+    pending_requests = userdata.get("_pending_requests")
+    return pending_requests is not None and pending_requests.is_reply(
+        userdata["_client_name"], topic
+    )
 
 
 class OnMessageCallback:
     @classmethod
-    def get_callback(cls):
+    def get_callback(cls, consumer_group=None, payload_spill_threshold=None):
         """
         Returns the actual on_message callback function.
+        Args:
+            consumer_group (ConsumerGroup): Consumer group used to drop the
+                messages owned by other group members, if any.
+            payload_spill_threshold (int): Payloads larger than this many
+                bytes are queued in a memory mapped file.
         Returns:
             function: The configured on_message callback function.
         """
@@ -21,20 +34,36 @@ class OnMessageCallback:
                 msg: The received message.
             """
             topic = message.topic
-            try:
-                payload = str(message.payload)[2:-1]
-                payload = json.loads(payload.replace("'", '"'))
-            except json.decoder.JSONDecodeError:
-                payload = str(message.payload)[2:-1]
+            if (
+                consumer_group is not None
+                and not consumer_group.owns(topic)
+                and not _is_reply(userdata, topic)
+            ):
+                return
+
+            # decoded by the consumer, only when a rule or task needs it
+            raw_payload = spill_payload(
+                message.payload, payload_spill_threshold
+            )
 
             logger.debug(
-                f"MQTT client {client._client_id} received message on topic {topic} with payload {payload}"
+                "MQTT client %s received message on topic %s with payload %s",
+                client._client_id,
+                topic,
+                raw_payload,
             )
 
+            properties = getattr(message, "properties", None)
+            user_properties = dict(getattr(properties, "UserProperty", []))
+
             message = {
                 "topic": topic,
-                "payload": payload,
+                "raw_payload": raw_payload,
                 "userdata": userdata,
+                "user_properties": user_properties,
+                "correlation_data": getattr(
+                    properties, "CorrelationData", None
+                ),
             }
 
             userdata["_clients_queues"][userdata["_client_name"]][
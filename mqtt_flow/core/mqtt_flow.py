@@ -6,121 +6,296 @@ from mqtt_flow.core.mqtt_callbacks import (
     OnDisconnectCallback,
 )
 from mqtt_flow.core.tasks_executor import TasksExecutor
+from mqtt_flow.core.consumer_group import ConsumerGroup
+from mqtt_flow.core.last_value_cache import LastValueCache
+from mqtt_flow.core.outgoing_buffer import OutgoingBuffer
+from mqtt_flow.core.scheduler import Scheduler
+from mqtt_flow.core.pending_requests import PendingRequests
 import queue
 import threading
 from mqtt_flow.core._task import Task
-from mqtt_flow.core.task.task_loader import load_task_class
+from mqtt_flow.core._chain import Chain
+from mqtt_flow.config.schema import compile_config
 from mqtt_flow.utils.helpers import get_logger
-from mqtt_flow.peristence import MQTTPersistence
-from mqtt_flow.peristence import PersistenceQueueError
+from mqtt_flow.utils.topic_index import TopicIndex
+from mqtt_flow.utils.priority_queue import PriorityLaneQueue
+from mqtt_flow.peristence.mock_persistence import MockPersistence
+from mqtt_flow.utils.payload import decode_payload
 import time
 
+_NOT_DECODED = object()
+
 # TODO trigger in persistence (application level)
 # TODO config, readme
 # TODO code doc + docs link on github
 
 
+class FlowRouting:
+    """
+    Routing state of a flow: rules, rules index and tasks. It is never
+    modified once built, MQTTFlow.reload swaps the whole snapshot at once.
+    """
+
+    __slots__ = ("config", "rules", "rules_index", "tasks")
+
+    def __init__(self, config, rules, rules_index, tasks):
+        self.config = config
+        self.rules = rules
+        self.rules_index = rules_index
+        self.tasks = tasks
+
+
 class MQTTFlow:
     PUBLISH_DELAY_IN_SECONDS = 0.02
 
-    def __init__(self, config):
+    def __init__(self, config, client_factory=None, shard=None):
+        """
+        Args:
+            config (dict or FlowConfig): Raw config as returned by
+                MQTTConfigLoader.get_config, compiled here, or an already
+                compiled config.
+            client_factory (callable): Creates the raw MQTT connections of
+                all the clients, paho by default. See MQTTClient.
+            shard (FlowShard): Clients run by this process when the flow is
+                split across worker processes, the messages published to
+                the other clients are forwarded to their worker. All the
+                clients run here by default.
+
+        Raises:
+            ConfigValidationError: If the raw config is invalid.
+        """
 
         self.logger = get_logger("mqtt_flow")
-        self.config = config
+        self.config = compile_config(config)
+        self.last_reload_seconds = None
+        self._reload_lock = threading.Lock()
+        self._client_factory = client_factory
+        self._shard = shard
         self._clients_queues = self._create_mqtt_clients_queues()
         self._tasks_queues = self._create_tasks_queues()
-        self._rules = self._create_rules()
-        self._tasks = self._create_tasks()
+        self._last_value_cache = self._create_last_value_cache()
+        self._scheduler = Scheduler(self._submit_scheduled_task)
+        self._pending_requests = PendingRequests(
+            self._scheduler, self.get_client
+        )
+        self._clients_userdata = self._create_clients_userdata()
+        self._routing = self._create_routing(self.config)
         self._register_clients_base_userdata()
         self._clients = self._create_mqtt_clients()
+        self._outgoing_buffers = self._create_outgoing_buffers()
         self._tasks_executor = TasksExecutor(
             self._tasks_queues,
-            self.config.copy().get("tasks_queues", []),
-            self.config.copy().get("pools", []),
+            self.config.tasks_queues,
+            self.config.pools,
+        )
+        self._scheduler.set_jobs(self._get_schedules(self.config))
+
+    @property
+    def _rules(self):
+        return self._routing.rules
+
+    @property
+    def _rules_index(self):
+        return self._routing.rules_index
+
+    @property
+    def _tasks(self):
+        return self._routing.tasks
+
+    def _create_routing(self, config, previous=None):
+        rules = self._create_rules(config, previous)
+        return FlowRouting(
+            config,
+            rules,
+            self._create_rules_index(rules),
+            self._create_tasks(config, previous),
         )
 
-    def _create_tasks(self):
+    def _create_tasks(self, config, previous=None):
         tasks = {}
-        for task_name in self.config.get("tasks", {}):
-            tasks[task_name] = Task(self.config, task_name, self._tasks_queues)
+        for task_name, task_config in config.tasks.items():
+            previous_task = previous.tasks.get(task_name) if previous else None
+
+            # unchanged tasks are kept with their state (filters, windows)
+            if (
+                isinstance(previous_task, Task)
+                and previous_task.task_config == task_config
+            ):
+                tasks[task_name] = previous_task
+                continue
+
+            tasks[task_name] = Task(
+                config,
+                task_name,
+                self._tasks_queues,
+                self._clients_userdata,
+            )
+
+        chains = {}
+        for chain_name in config.processing_chains:
+            chains[chain_name] = Chain(
+                config, chain_name, tasks, self._tasks_queues
+            )
+
+        tasks.update(chains)
         return tasks
 
-    def _create_rules(self):
+    def _create_rules(self, config, previous=None):
         rules = {}
-        for rule_config in self.config.get("rules", []):
-            rule_name = rule_config.get("name")
-            source_client_name = rule_config.get("source_client_name")
+        for rule_config in config.rules:
+            rule_name = rule_config.name
+            source_client_name = rule_config.source_client_name
 
             if source_client_name not in rules:
                 rules[source_client_name] = {}
-            rules[source_client_name][rule_name] = MQTTRule(rule_config)
+
+            previous_rule = (
+                previous.rules.get(source_client_name, {}).get(rule_name)
+                if previous
+                else None
+            )
+            if (
+                previous_rule is not None
+                and previous_rule.rule_config == rule_config
+            ):
+                rules[source_client_name][rule_name] = previous_rule
+            else:
+                rules[source_client_name][rule_name] = MQTTRule(rule_config)
         return rules
 
-    def _register_clients_base_userdata(self):
-        for client_config in self.config.get("mqtt_clients", []):
+    def _create_last_value_cache(self):
+        cache_config = self.config.last_value_cache
+        if not cache_config:
+            return None
+        return LastValueCache(cache_config)
+
+    def _create_rules_index(self, rules):
+        rules_index = {}
+        for source_client_name, client_rules in rules.items():
+            rules_index[source_client_name] = TopicIndex()
+            for rule in client_rules.values():
+                rules_index[source_client_name].add(
+                    rule, topic=rule.rule_topic, regex=rule.regex
+                )
+        return rules_index
+
+    def _create_clients_userdata(self):
+        """
+        Creates the runtime userdata of each client, a copy of the configured
+        userdata with the flow internals added, the config is not mutated.
+        """
+        clients_userdata = {}
+        for client_config in self.config.mqtt_clients:
+            client_name = client_config.client_name
+            clients_userdata[client_name] = {
+                **(client_config.userdata or {}),
+                "_client_name": client_name,
+                "_tasks_queues": self._tasks_queues,
+                "_clients_queues": self._clients_queues,
+                "_last_value_cache": self._last_value_cache,
+                "_pending_requests": self._pending_requests,
+            }
+        return clients_userdata
 
-            client_name = client_config.get("client_name")
-            if "userdata" not in client_config:
-                client_config["userdata"] = {}
+    def _register_clients_base_userdata(self):
+        for userdata in self._clients_userdata.values():
+            userdata["_tasks"] = self._tasks
 
-            client_config["userdata"]["_client_name"] = client_name
-            client_config["userdata"]["_tasks_queues"] = self._tasks_queues
-            client_config["userdata"]["_clients_queues"] = self._clients_queues
-            client_config["userdata"]["_tasks"] = self._tasks
+    def _is_local_client(self, client_name):
+        return self._shard is None or self._shard.owns(client_name)
 
     def _create_mqtt_clients_queues(self):
         queues = {}
-        for client_config in self.config.get("mqtt_clients", []):
-            client_name = client_config.get("client_name")
+        for client_config in self.config.mqtt_clients:
+            client_name = client_config.client_name
+            if not self._is_local_client(client_name):
+                queues[client_name] = {
+                    "incoming": queue.Queue(),
+                    "outgoing": self._shard.create_remote_queue(client_name),
+                }
+                continue
+
+            outgoing_queue_config = client_config.outgoing_queue or {}
+            if outgoing_queue_config.get("priority_levels"):
+                outgoing_queue = self._create_priority_queue(
+                    outgoing_queue_config
+                )
+            else:
+                outgoing_queue = queue.Queue()
             queues[client_name] = {
                 "incoming": queue.Queue(),
-                "outgoing": queue.Queue(),
+                "outgoing": outgoing_queue,
             }
         return queues
 
+    def _create_priority_queue(self, queue_config):
+        return PriorityLaneQueue(
+            queue_config.get("size") or 0,
+            priority_levels=queue_config.get("priority_levels"),
+            default_priority=queue_config.get("default_priority"),
+            starvation_limit=queue_config.get(
+                "starvation_limit",
+                PriorityLaneQueue.DEFAULT_STARVATION_LIMIT,
+            ),
+        )
+
+    def _create_task_queue(self, queue_config):
+        if queue_config.priority_levels:
+            return self._create_priority_queue(queue_config)
+        return queue.Queue(queue_config.size)
+
     def _create_tasks_queues(self):
         queues = {}
-        for queue_config in self.config.get("tasks_queues", []):
-            queue_name = queue_config.get("name")
-            queue_size = queue_config.get("size")
-            queues[queue_name] = queue.Queue(queue_size)
+        for queue_config in self.config.tasks_queues:
+            queues[queue_config.name] = self._create_task_queue(queue_config)
         return queues
 
     def _create_mqtt_client(self, client_config):
         """Create MQTT client instance based on the loaded configuration."""
 
         client_attributes = {
-            "client_name": client_config.get("client_name"),
-            "client_id": client_config.get("client_id"),
-            "server": client_config.get("server"),
-            "port": client_config.get("port"),
-            "max_reconnect_delay": client_config.get("max_reconnect_delay"),
-            "will_set_topic": client_config.get("will_set_topic"),
-            "will_set_payload": client_config.get("will_set_payload"),
-            "keep_alive": client_config.get("keep_alive"),
-            "queue_size": client_config.get("queue_size"),
-            "batch_size": client_config.get("batch_size"),
-            "publish_interval": client_config.get("publish_interval"),
-            "ssl_config": client_config.get("ssl_config"),
-            "userdata": client_config.get("userdata"),
-            "clean_session": client_config.get("clean_session"),
-            "on_log_callback_enable": client_config.get(
-                "on_log_callback_enable"
-            ),
-            "exit_on_reconnect": client_config.get("exit_on_reconnect"),
+            "client_name": client_config.client_name,
+            "client_id": client_config.client_id,
+            "server": client_config.server,
+            "port": client_config.port,
+            "max_reconnect_delay": client_config.max_reconnect_delay,
+            "will_set_topic": client_config.will_set_topic,
+            "will_set_payload": client_config.will_set_payload,
+            "keep_alive": client_config.keep_alive,
+            "queue_size": client_config.queue_size,
+            "batch_size": client_config.batch_size,
+            "publish_interval": client_config.publish_interval,
+            "ssl_config": client_config.ssl_config,
+            "userdata": self._clients_userdata[client_config.client_name],
+            "clean_session": client_config.clean_session,
+            "on_log_callback_enable": client_config.on_log_callback_enable,
+            "exit_on_reconnect": client_config.exit_on_reconnect,
+            "connection_client_ids": client_config.connection_client_ids,
+            "protocol": client_config.protocol,
+            "mqtt5_config": client_config.mqtt5,
         }
 
-        persistence = client_config.get("persistence")
+        persistence = client_config.persistence
         if not persistence:
-            persistence_config = client_config.get("persistence_config")
+            persistence_config = client_config.persistence_config
             if persistence_config:
+                # persistqueue and sqlite3 are only loaded when configured
+                from mqtt_flow.peristence import (
+                    MQTTPersistence,
+                    PersistenceQueueError,
+                )
+
                 try:
                     persistence = MQTTPersistence(persistence_config)
                 except PersistenceQueueError:
                     self.logger.warning(
-                        f"Failed to initialise persistence for client {client_config.get('client_name')}"
+                        f"Failed to initialise persistence for client {client_config.client_name}"
                     )
 
+        consumer_group = None
+        if client_config.consumer_group:
+            consumer_group = ConsumerGroup(client_config.consumer_group)
+
         return MQTTClient(
             **{
                 attr: value
@@ -128,109 +303,415 @@ class MQTTFlow:
                 if value is not None
             },
             on_connect=OnConnectCallback.get_callback(
-                client_config.get("sub_topics")
+                client_config.sub_topics, consumer_group
+            ),
+            on_message=OnMessageCallback.get_callback(
+                consumer_group, client_config.payload_spill_threshold
             ),
-            on_message=OnMessageCallback.get_callback(),
             on_disconnect=OnDisconnectCallback.get_callback(),
             persistence=persistence,
+            client_factory=self._client_factory,
         )
 
     def _create_mqtt_clients(self):
         """Create MQTT client instances based on the loaded configuration."""
         clients = {}
-        for client_config in self.config.get("mqtt_clients", []):
-            client_name = client_config.get("client_name")
-
-            if client_name is None:
-                raise ValueError(
-                    "Missing 'client_name' in MQTT client configuration"
-                )
-
-            if client_name in clients:
-                raise ValueError(
-                    f"Duplicate MQTT client name found: {client_name}"
+        for client_config in self.config.mqtt_clients:
+            if self._is_local_client(client_config.client_name):
+                clients[client_config.client_name] = self._create_mqtt_client(
+                    client_config
                 )
-            clients[client_name] = self._create_mqtt_client(client_config)
         return clients
 
+    def _create_outgoing_buffers(self):
+        """Creates the outage buffers of the clients with a disconnect policy."""
+        buffers = {}
+        for client_config in self.config.mqtt_clients:
+            if (
+                client_config.disconnect_policy is None
+                or client_config.client_name not in self._clients
+            ):
+                continue
+
+            persistence = self._clients[client_config.client_name].persistence
+            if isinstance(persistence, MockPersistence):
+                persistence = None
+            buffers[client_config.client_name] = OutgoingBuffer(
+                client_config.disconnect_policy, persistence
+            )
+        return buffers
+
+    @staticmethod
+    def _get_schedules(config):
+        return {
+            task_name: task_config.schedule
+            for task_name, task_config in config.tasks.items()
+            if task_config.schedule
+        }
+
+    def _submit_scheduled_task(self, task_name, task_args):
+        """Submits a scheduled run, tasks removed by a reload are skipped."""
+        task = self._routing.tasks.get(task_name)
+        if task is not None:
+            task.submit(task_args=task_args)
+
     def get_client(self, client_name):
         """Get an MQTT client instance by name."""
         return self._clients.get(client_name)
 
+    def get_client_names(self):
+        """Get the names of the MQTT clients run by this flow (or shard)."""
+        return list(self._clients)
+
     def _incoming_msg_queue_consumer(self, client_name):
         incoming_queue = self._clients_queues[client_name]["incoming"]
-
         while True:
             try:
                 message = incoming_queue.get()
                 topic = message["topic"]
-                payload = message["payload"]
+                raw_payload = message.get("raw_payload")
+                # decoded on first use, binary rules and tasks get the raw
+                # payload and never pay for the decoding
+                payload = message.get("payload", _NOT_DECODED)
                 userdata = message["userdata"]
+                user_properties = message.get("user_properties")
+
+                # replies to the task requests, never routed to the rules
+                if self._pending_requests.resolve(client_name, message):
+                    continue
+
+                if (
+                    self._last_value_cache is not None
+                    and self._last_value_cache.is_cached(client_name, topic)
+                ):
+                    if payload is _NOT_DECODED:
+                        payload = decode_payload(raw_payload)
+                    self._last_value_cache.update(client_name, topic, payload)
 
                 self.logger.debug(
-                    f"Incoming Message : {message['topic']} -> {message['payload']}"
+                    "Incoming Message : %s -> %s",
+                    topic,
+                    raw_payload if payload is _NOT_DECODED else payload,
                 )
 
-                for rule_name, rule in self._rules.get(
-                    client_name, {}
-                ).items():
-                    if rule.is_rule_matched(topic, payload):
+                # one snapshot per message, a reload never splits a message
+                routing = self._routing
+                rules_index = routing.rules_index.get(client_name)
+                if rules_index is None:
+                    continue
+
+                for rule in rules_index.match(topic):
+                    task = routing.tasks[rule.task_name]
+                    if rule.binary or task.binary:
+                        rule_payload = (
+                            payload if raw_payload is None else raw_payload
+                        )
+                    else:
+                        if payload is _NOT_DECODED:
+                            payload = decode_payload(raw_payload)
+                        rule_payload = payload
+
+                    if rule.is_condition_matched(
+                        topic, rule_payload, user_properties
+                    ):
                         self.logger.debug(
-                            f"Rule {rule_name} matched for {client_name}"
+                            "Rule %s matched for %s",
+                            rule.rule_name,
+                            client_name,
                         )
+
+                        # suppressed messages never instantiate a task
+                        if (
+                            rule.change_filter is not None
+                            and not rule.change_filter.should_forward(
+                                topic, rule_payload
+                            )
+                        ) or (
+                            task.change_filter is not None
+                            and not task.change_filter.should_forward(
+                                topic, rule_payload
+                            )
+                        ):
+                            continue
+
                         self.logger.debug(
-                            f"Client {client_name} Incoming Message : {message['topic']} -> {message['payload']}"
+                            "Client %s Incoming Message : %s -> %s",
+                            client_name,
+                            topic,
+                            rule_payload,
                         )
-                        self._tasks[rule.task_name].submit(
-                            userdata=userdata, task_args=(topic, payload)
+                        task.submit(
+                            userdata=userdata,
+                            task_args=(topic, rule_payload),
+                            user_properties=user_properties,
+                            priority=rule.priority,
                         )
             except Exception:
                 self.logger.exception(
                     "Exception in Incoming Message Queue Consumer"
                 )
 
+    def _publish_outgoing_message(self, client_name, client, message):
+        self.logger.debug(
+            "Client %s Outgoing Message : %s -> %s",
+            client_name,
+            message["topic"],
+            message["payload"],
+        )
+        msg_info = client.publish(
+            message["topic"],
+            message["payload"],
+            *message.get("args", []),
+            **message.get("kwargs", {}),
+        )
+        if msg_info is not None:
+            self.logger.debug(
+                "Message sent to topic : %s with rc: %s",
+                message["topic"],
+                msg_info.rc,
+            )
+
+        if msg_info is not None:
+            if msg_info.rc != 0:
+                self.logger.warning(
+                    "Failed to publish message to %s: %s",
+                    client_name,
+                    msg_info.rc,
+                )
+        return msg_info
+
+    @staticmethod
+    def _should_buffer(client, message):
+        """
+        Whether a message not published must be buffered: its connection is
+        down and the client did not already persist it (`persist=True`).
+        """
+        if client.is_connected(message["topic"]):
+            return False
+
+        return not (
+            message.get("kwargs", {}).get("persist")
+            and not isinstance(client.persistence, MockPersistence)
+        )
+
+    def _publish_buffered_messages(self, client_name, client, buffer):
+        """
+        Publishes the spilled then the in memory messages of the buffer,
+        oldest first. Returns False if the connection dropped meanwhile.
+        """
+        while True:
+            message = buffer.peek()
+            if message is None:
+                return True
+
+            msg_info = self._publish_outgoing_message(
+                client_name, client, message
+            )
+            if msg_info is None and self._should_buffer(client, message):
+                return False
+            buffer.pop()
+
+    def _buffer_outgoing_messages(self, client_name, outgoing_queue, buffer):
+        """
+        Holds the outgoing messages of a disconnected client in its buffer,
+        spilling it when full, until the client is connected and the buffer
+        is published again. Returns once the buffer is empty.
+        """
+        client = self._clients[client_name]
+
+        while True:
+            if client.is_ready:
+                if not buffer:
+                    return
+
+                self.logger.info(
+                    "Client %s reconnected, publishing %s buffered messages "
+                    "and %s spilled batches",
+                    client_name,
+                    len(buffer),
+                    (
+                        buffer.persistence.get_spill_pqueue_size()
+                        if buffer.persistence
+                        else 0
+                    ),
+                )
+                if self._publish_buffered_messages(
+                    client_name, client, buffer
+                ):
+                    return
+
+            try:
+                buffer.append(outgoing_queue.get(timeout=buffer.poll_interval))
+            except queue.Empty:
+                pass
+
+            if buffer.should_spill():
+                buffered = len(buffer)
+                buffer.spill()
+                self.logger.info(
+                    "Client %s disconnected, %s buffered messages %s",
+                    client_name,
+                    buffered - len(buffer),
+                    "spilled" if buffer.persistence else "dropped",
+                )
+
     def _outgoing_msg_queue_consumer(self, client_name):
         outgoing_queue = self._clients_queues[client_name]["outgoing"]
         client = self._clients[client_name]
+        buffer = self._outgoing_buffers.get(client_name)
+
+        # without buffer, messages published by tasks before the first
+        # connection is established are kept in the outgoing queue
+        if buffer is None:
+            client.wait_ready()
+
         while True:
             try:
-                message = outgoing_queue.get()
-                self.logger.debug(
-                    f"Client {client_name} Outgoing Message : {message['topic']} -> {message['payload']}"
-                )
-                msg_info = client.publish(
-                    message["topic"],
-                    message["payload"],
-                    *message.get("args", []),
-                    **message.get("kwargs", {}),
-                )
-                if msg_info is not None:
-                    self.logger.debug(
-                        f"Message sent to topic : {message['topic']} with rc: {msg_info.rc}"
+                if buffer is not None and (buffer or not client.is_ready):
+                    self._buffer_outgoing_messages(
+                        client_name, outgoing_queue, buffer
                     )
+                    continue
 
-                if msg_info is not None:
-                    if msg_info.rc != 0:
-                        self.logger.warning(
-                            f"Failed to publish message to {client_name}: {msg_info.rc}"
-                        )
+                message = outgoing_queue.get()
+                msg_info = self._publish_outgoing_message(
+                    client_name, client, message
+                )
+                if (
+                    msg_info is None
+                    and buffer is not None
+                    and self._should_buffer(client, message)
+                ):
+                    buffer.append(message)
                 # time.sleep(self.PUBLISH_DELAY_IN_SECONDS)
             except Exception:
                 self.logger.exception(
                     "Exception in Outgoing Message Queue Consumer"
                 )
 
+    def get_pools_metrics(self):
+        """Get the metrics of the executor pools, e.g. adaptive limits."""
+        return self._tasks_executor.get_pools_metrics()
+
+    def get_scheduler_metrics(self):
+        """Get the number of scheduled jobs and of runs, misfired or not."""
+        return {**self._scheduler.metrics, "jobs": len(self._scheduler)}
+
+    def get_requests_metrics(self):
+        """Get the number of pending requests and of replies or timeouts."""
+        return {
+            **self._pending_requests.metrics,
+            "pending": len(self._pending_requests),
+        }
+
+    def get_outgoing_buffers_metrics(self):
+        """
+        Get the counts of messages buffered, spilled to persistence and
+        dropped during the outages of the clients with a disconnect policy.
+        """
+        return {
+            client_name: {**buffer.metrics, "size": len(buffer)}
+            for client_name, buffer in self._outgoing_buffers.items()
+        }
+
+    @staticmethod
+    def _client_settings(client_config):
+        # client ids are made unique each time the config is loaded
+        return {
+            key: value
+            for key, value in client_config.items()
+            if key not in ("client_id", "connection_client_ids")
+        }
+
+    def reload(self, config):
+        """
+        Reloads the rules, tasks and processing chains without stopping the
+        clients. The new routing is built aside and swapped in at once,
+        messages are routed either with the old or with the new one.
+
+        Clients, their queues, the persistence and the last value cache are
+        kept. New task queues and pools are created and started, existing
+        ones keep their settings. Unchanged rules and tasks are kept with
+        their state (change filters, windows).
+
+        Args:
+            config (dict or FlowConfig): The new config.
+
+        Returns:
+            float: The reload duration in seconds, also available as
+                `last_reload_seconds`.
+
+        Raises:
+            ConfigValidationError: If the raw config is invalid, the running
+                routing is left untouched.
+            ValueError: If clients are added or removed.
+        """
+        started_at = time.perf_counter()
+
+        with self._reload_lock:
+            config = compile_config(config)
+
+            if set(config.clients) != set(self.config.clients):
+                raise ValueError(
+                    "MQTT clients can not be added or removed by a reload"
+                )
+            for client_name, client_config in config.clients.items():
+                if self._client_settings(client_config) != (
+                    self._client_settings(self.config.clients[client_name])
+                ):
+                    self.logger.warning(
+                        f"Changes of client {client_name} are ignored until restart"
+                    )
+            if config.last_value_cache != self.config.last_value_cache:
+                self.logger.warning(
+                    "Changes of last_value_cache are ignored until restart"
+                )
+
+            for queue_config in config.tasks_queues:
+                if queue_config.name not in self._tasks_queues:
+                    self._tasks_queues[queue_config.name] = (
+                        self._create_task_queue(queue_config)
+                    )
+
+            previous = self._routing
+            routing = self._create_routing(config, previous)
+
+            # new queues must be consumed before tasks can be put on them
+            self._tasks_executor.reload(config.tasks_queues, config.pools)
+
+            self._routing = routing
+            self.config = config
+            self._register_clients_base_userdata()
+            self._scheduler.set_jobs(self._get_schedules(config))
+
+            for task_name, task in previous.tasks.items():
+                if (
+                    isinstance(task, Task)
+                    and routing.tasks.get(task_name) is not task
+                ):
+                    task.unload()
+
+        self.last_reload_seconds = time.perf_counter() - started_at
+        self.logger.info(
+            f"Reloaded {len(config.rules)} rules and {len(routing.tasks)} tasks in {self.last_reload_seconds * 1000:.2f} ms"
+        )
+        return self.last_reload_seconds
+
     def submit_task(self, task_name, task_args=None, task_kwargs=None):
         self._tasks[task_name].submit(
             task_args=task_args, task_kwargs=task_kwargs
         )
 
     def start(self):
-        """Start all MQTT client connections."""
+        """
+        Start all MQTT client connections, the message consumers and the
+        tasks executor. Connections are established in the background, see
+        `wait_ready`.
+        """
         for client in self._clients.values():
             client.start()
 
-        for client_name in self._clients_queues.keys():
+        for client_name in self._clients.keys():
             threading.Thread(
                 target=self._incoming_msg_queue_consumer,
                 args=(client_name,),
@@ -241,8 +722,38 @@ class MQTTFlow:
             ).start()
 
         self._tasks_executor.start()
+        self._scheduler.start()
+        if self._shard is not None:
+            self._shard.start(self._clients_queues)
+
+    def wait_ready(self, timeout=None):
+        """
+        Blocks until all the MQTT clients are connected.
+
+        Args:
+            timeout (float): Maximum seconds to wait for all the clients,
+                forever if None.
+
+        Returns:
+            bool: True if all the clients are connected, False on timeout.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        for client in self._clients.values():
+            remaining = (
+                None
+                if deadline is None
+                else max(deadline - time.monotonic(), 0)
+            )
+            if not client.wait_ready(remaining):
+                return False
+
+        return True
 
     def stop(self):
         """Stop all MQTT client connections."""
+        self._scheduler.stop()
         for client in self._clients.values():
             client.stop()
+        if self._shard is not None:
+            self._shard.stop()
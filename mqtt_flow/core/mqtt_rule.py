@@ -1,5 +1,7 @@
 from mqtt_flow.utils.helpers import get_logger
 from mqtt_flow.utils.helpers import match_topic
+from mqtt_flow.core.change_filter import ChangeFilter
+import re
 
 
 class MQTTRule:
@@ -8,17 +10,29 @@ class MQTTRule:
         Initializes the MQTTRule with the provided configuration.
 
         Args:
-            rule_config (dict): Configuration for the rule, including conditions and task information.
+            rule_config (RuleConfig): Compiled configuration for the rule, including conditions and task information.
         """
         self.logger = get_logger("mqtt_rule")
-        self.rule_name = rule_config.get("name")
-        self.source_client_name = rule_config.get("source_client_name")
-        self.regex = rule_config.get("regex")
-        self.rule_topic = rule_config.get("topic")
-        self.condition = rule_config.get("condition")
-        self.task_name = rule_config.get("task")
-
-    def is_rule_matched(self, topic, payload):
+        self.rule_config = rule_config
+        self.rule_name = rule_config.name
+        self.source_client_name = rule_config.source_client_name
+        self.regex = rule_config.regex
+        self._pattern = re.compile(self.regex) if self.regex else None
+        self.rule_topic = rule_config.topic
+        self.condition = rule_config.condition
+        self._condition_code = (
+            compile(self.condition, f"<rule {self.rule_name}>", "eval")
+            if self.condition
+            else None
+        )
+        self.task_name = rule_config.task
+        self.priority = rule_config.priority
+        self.binary = bool(rule_config.binary)
+        self.change_filter = (
+            ChangeFilter(rule_config.filter) if rule_config.filter else None
+        )
+
+    def is_rule_matched(self, topic, payload, user_properties=None):
         """
         Checks if the given message matches the rule criteria.
 
@@ -29,19 +43,39 @@ class MQTTRule:
             bool: True if the message matches the rule, False otherwise.
         """
 
-        if not match_topic(topic, self.regex, self.rule_topic):
+        if not match_topic(topic, self._pattern, self.rule_topic):
             return False
 
+        return self.is_condition_matched(topic, payload, user_properties)
+
+    def is_condition_matched(self, topic, payload, user_properties=None):
+        """
+        Checks if the given message matches the rule condition only. Used
+        when the topic has already been matched through the rules index.
+
+        Args:
+            topic (str): The message topic.
+            payload: The message payload.
+            user_properties (dict): MQTT v5 user properties of the message.
+
+        Returns:
+            bool: True if the condition is met or not defined, False otherwise.
+        """
+
         # Evaluate the condition (if defined)
-        if self.condition:
+        if self._condition_code is not None:
             # Safe eval or a similar secure evaluation method should be used here
             # This example uses direct eval for simplicity, which is not secure!
             # Consider using a library like 'safe_eval' for safely evaluating conditions.
             try:
                 condition_met = eval(
-                    self.condition,
+                    self._condition_code,
                     {},
-                    {"topic": topic, "payload": payload},
+                    {
+                        "topic": topic,
+                        "payload": payload,
+                        "user_properties": user_properties or {},
+                    },
                 )
             except Exception as e:
                 self.logger.exception(
@@ -0,0 +1,149 @@
+from collections import deque
+import time
+
+
+class OutgoingBuffer:
+    """
+    Outgoing messages of a client held while it is disconnected, filled by
+    MQTTFlow instead of publishing into a dead connection.
+
+    When the buffer holds more than `buffer_size` messages or its oldest
+    message is older than `buffer_seconds`, the whole buffer is spilled in
+    bulk to the spill queue of the client persistence (or dropped without
+    persistence). On reconnect the spilled messages then the messages still
+    in memory are published, in order, before the live traffic. Messages
+    published with `persist=True` are the exception: they go through the
+    persistence rules and are replayed by the persistence lanes.
+
+    Config (`disconnect_policy` of the client):
+        buffer_size (int): Messages held in memory. Default: 1000.
+        buffer_seconds (float): Maximum seconds a message is held in memory.
+            Default: 60.
+        spill (bool): Spill to the client persistence when the buffer is
+            full, otherwise the oldest messages are dropped. Default: yes.
+    """
+
+    DEFAULT_BUFFER_SIZE = 1000
+    DEFAULT_BUFFER_SECONDS = 60
+    MAX_POLL_INTERVAL = 1
+
+    def __init__(self, policy_config, persistence=None):
+        self.buffer_size = policy_config.get(
+            "buffer_size", self.DEFAULT_BUFFER_SIZE
+        )
+        self.buffer_seconds = policy_config.get(
+            "buffer_seconds", self.DEFAULT_BUFFER_SECONDS
+        )
+        self.persistence = (
+            persistence if policy_config.get("spill", True) else None
+        )
+        self.metrics = {"buffered": 0, "spilled": 0, "dropped": 0}
+        self._messages = deque()
+        # messages of the spilled batch being published, and its row id
+        self._spilled = deque()
+        self._spilled_row_id = None
+
+    def __len__(self):
+        """Number of messages held in memory."""
+        return len(self._messages)
+
+    def __bool__(self):
+        return bool(self._messages) or self.has_spilled()
+
+    def has_spilled(self):
+        """Whether spilled messages are waiting to be published."""
+        return bool(self._spilled) or bool(
+            self.persistence is not None
+            and self.persistence.get_spill_pqueue_size()
+        )
+
+    @property
+    def poll_interval(self):
+        """Seconds to wait for the next message before checking again."""
+        return min(self.buffer_seconds, self.MAX_POLL_INTERVAL)
+
+    def append(self, message):
+        self._messages.append((message, time.monotonic()))
+        self.metrics["buffered"] += 1
+
+    def peek(self):
+        """
+        Returns the oldest message to publish, spilled messages first, None
+        if the buffer is empty. The message stays in the buffer until pop
+        is called, so a failed publish is retried.
+        """
+        if not self._spilled and self.persistence is not None:
+            spilled = self.persistence.get_spilled()
+            if spilled is not None:
+                self._spilled_row_id, messages = spilled
+                self._spilled.extend(messages)
+
+        if self._spilled:
+            return self._spilled[0]
+        if self._messages:
+            return self._messages[0][0]
+        return None
+
+    def pop(self):
+        """Removes the message returned by peek, once published."""
+        if not self._spilled:
+            self._messages.popleft()
+            return
+
+        self._spilled.popleft()
+        if not self._spilled:
+            # the spilled batch is deleted once fully published
+            self.persistence.delete_spilled(self._spilled_row_id)
+            self._spilled_row_id = None
+
+    def should_spill(self):
+        if not self._messages:
+            return False
+
+        return (
+            len(self._messages) > self.buffer_size
+            or time.monotonic() - self._messages[0][1] >= self.buffer_seconds
+        )
+
+    def spill(self):
+        """
+        Moves all the buffered messages to the persistence, in a single
+        bulk write. Without persistence the messages above buffer_size or
+        older than buffer_seconds are dropped instead, oldest first.
+        """
+        if self.persistence is None:
+            now = time.monotonic()
+            while self._messages and (
+                len(self._messages) > self.buffer_size
+                or now - self._messages[0][1] >= self.buffer_seconds
+            ):
+                self._messages.popleft()
+                self.metrics["dropped"] += 1
+            return
+
+        messages = []
+        while self._messages:
+            message = self._messages.popleft()[0]
+            if message.get("kwargs", {}).get("persist"):
+                # goes through the persistence rules, like a publish with
+                # persist=True on a disconnected client
+                self.persistence.append_to_batch(
+                    {"topic": message["topic"], "payload": message["payload"]}
+                )
+            else:
+                messages.append(
+                    {
+                        "topic": message["topic"],
+                        "payload": message["payload"],
+                        "args": message.get("args", ()),
+                        "kwargs": message.get("kwargs", {}),
+                    }
+                )
+
+        if not messages:
+            return
+
+        if self.persistence.put_spilled(messages):
+            self.metrics["spilled"] += len(messages)
+        else:
+            self.metrics["dropped"] += len(messages)
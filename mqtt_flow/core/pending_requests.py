@@ -0,0 +1,209 @@
+from concurrent.futures import Future
+import threading
+import uuid
+from mqtt_flow.utils.helpers import get_logger
+from mqtt_flow.utils.payload import decode_payload
+
+
+class PendingRequests:
+    """
+    Requests published by the tasks and waiting for their reply, shared by
+    all the clients of a flow. MQTTFlow resolves them from the incoming
+    messages before the rules, replies are never routed to the rules.
+
+    With MQTT v5 the request carries the ResponseTopic and CorrelationData
+    properties, the responder publishes its reply on the response topic
+    with the same correlation data. With MQTT v3.1.1 the correlation id is
+    the last level of the reply topic: the request payload (a dict) gets a
+    `reply_topic` key, e.g. `reply_topic/<correlation id>`, where the
+    responder publishes its reply.
+
+    Each reply topic is subscribed once per client, on the first request,
+    and again on reconnect.
+
+    Args:
+        scheduler (Scheduler): Runs the timeouts, no thread waits for the
+            replies.
+        get_client (callable): Returns the MQTTClient of a client name.
+    """
+
+    DEFAULT_TIMEOUT = 30
+
+    def __init__(self, scheduler, get_client):
+        self.logger = get_logger("pending_requests")
+        self._scheduler = scheduler
+        self._get_client = get_client
+        self._requests = {}
+        # client name -> reply topic -> topic filter subscribed
+        self._reply_topics = {}
+        self._lock = threading.Lock()
+        self.metrics = {"replied": 0, "timed_out": 0, "late": 0}
+
+    def __len__(self):
+        return len(self._requests)
+
+    def get_reply_filters(self, client_name):
+        """Returns the topic filters subscribed for the replies."""
+        return list(self._reply_topics.get(client_name, {}).values())
+
+    def _subscribe(self, client, client_name, reply_topic, topic_filter):
+        with self._lock:
+            reply_topics = self._reply_topics.setdefault(client_name, {})
+            if reply_topic in reply_topics:
+                return
+            reply_topics[reply_topic] = topic_filter
+
+        client.subscribe_topics(topic_filter)
+
+    def request(
+        self,
+        client_name,
+        topic,
+        payload,
+        reply_topic,
+        publish,
+        timeout=None,
+        **kwargs,
+    ):
+        """
+        Publishes a request and returns a Future of its reply, a dict with
+        the `topic`, the decoded `payload`, the `raw_payload` and the
+        `user_properties` of the reply message. The future fails with a
+        TimeoutError if no reply is received in time.
+
+        Callbacks added to the future run in the consumer thread of the
+        client, they should submit a task rather than do the work.
+
+        Args:
+            client_name (str): Client publishing the request and receiving
+                the reply.
+            topic (str): Request topic.
+            payload: Request payload, a dict with MQTT v3.1.1.
+            reply_topic (str): Topic of the replies, without wildcards.
+            publish (callable): Called as `publish(topic, payload, **kwargs)`
+                to queue the request.
+            timeout (float): Seconds to wait for the reply. Default: 30.
+        """
+        client = self._get_client(client_name)
+        if client is None:
+            raise ValueError(f"Unknown client {client_name}")
+
+        correlation_id = uuid.uuid4().hex
+        if client.protocol == 5:
+            self._subscribe(client, client_name, reply_topic, reply_topic)
+            kwargs["response_topic"] = reply_topic
+            kwargs["correlation_data"] = correlation_id.encode()
+        else:
+            if not isinstance(payload, dict):
+                raise ValueError(
+                    "MQTT v3.1.1 requests need a dict payload to carry "
+                    "their reply topic"
+                )
+            self._subscribe(
+                client, client_name, reply_topic, f"{reply_topic}/+"
+            )
+            payload = {
+                **payload,
+                "reply_topic": f"{reply_topic}/{correlation_id}",
+            }
+
+        future = Future()
+        future.set_running_or_notify_cancel()
+        with self._lock:
+            timeout_call = self._scheduler.call_later(
+                self.DEFAULT_TIMEOUT if timeout is None else timeout,
+                self._expire,
+                correlation_id,
+            )
+            self._requests[correlation_id] = (
+                client_name,
+                future,
+                timeout_call,
+            )
+
+        publish(topic, payload, **kwargs)
+        return future
+
+    def _expire(self, correlation_id):
+        with self._lock:
+            request = self._requests.pop(correlation_id, None)
+        if request is None:
+            return
+
+        self.metrics["timed_out"] += 1
+        request[1].set_exception(
+            TimeoutError(f"No reply to request {correlation_id}")
+        )
+
+    def _get_correlation_id(self, client_name, topic, correlation_data):
+        """
+        Returns the correlation id of a reply, None if the message was not
+        received on a reply topic.
+        """
+        reply_topics = self._reply_topics.get(client_name)
+        if not reply_topics:
+            return None
+
+        if reply_topics.get(topic) == topic:
+            if correlation_data is None:
+                return ""
+            if isinstance(correlation_data, bytes):
+                return correlation_data.decode(errors="replace")
+            return correlation_data
+
+        reply_topic, _, correlation_id = topic.rpartition("/")
+        topic_filter = reply_topics.get(reply_topic)
+        if topic_filter is not None and topic_filter != reply_topic:
+            return correlation_id
+
+        return None
+
+    def is_reply(self, client_name, topic):
+        return self._get_correlation_id(client_name, topic, None) is not None
+
+    def resolve(self, client_name, message):
+        """
+        Resolves the request a message replies to.
+
+        Returns:
+            bool: True if the message was received on a reply topic, even
+                if its request already timed out.
+        """
+        correlation_id = self._get_correlation_id(
+            client_name, message["topic"], message.get("correlation_data")
+        )
+        if correlation_id is None:
+            return False
+
+        with self._lock:
+            request = self._requests.get(correlation_id)
+            if request is not None and request[0] == client_name:
+                del self._requests[correlation_id]
+            else:
+                request = None
+
+        if request is None:
+            self.metrics["late"] += 1
+            self.logger.debug(
+                "Reply on %s without pending request", message["topic"]
+            )
+            return True
+
+        _, future, timeout_call = request
+        timeout_call.cancel()
+
+        raw_payload = message.get("raw_payload")
+        payload = message.get("payload")
+        if payload is None and raw_payload is not None:
+            payload = decode_payload(raw_payload)
+
+        self.metrics["replied"] += 1
+        future.set_result(
+            {
+                "topic": message["topic"],
+                "payload": payload,
+                "raw_payload": raw_payload,
+                "user_properties": message.get("user_properties") or {},
+            }
+        )
+        return True
@@ -0,0 +1,325 @@
+from datetime import datetime, timedelta
+import heapq
+import itertools
+import random
+import threading
+import time
+from mqtt_flow.utils.helpers import get_logger
+
+
+class CronExpression:
+    """
+    Standard 5 fields cron expression: minute, hour, day of month, month and
+    day of week (0 or 7 is Sunday), in local time. Fields accept `*`,
+    values, ranges `a-b`, steps `*/n` or `a-b/n` and lists `a,b`. As in cron,
+    when both days are restricted a day matching either of them matches.
+    """
+
+    FIELD_RANGES = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+    # how far to look ahead before giving up (impossible dates, e.g. 30 Feb)
+    MAX_SEARCH = timedelta(days=366 * 5)
+
+    def __init__(self, expression):
+        self.expression = expression
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(
+                f"cron expression {expression!r} must have 5 fields"
+            )
+
+        (
+            self.minutes,
+            self.hours,
+            self.days,
+            self.months,
+            weekdays,
+        ) = (
+            self._parse_field(field, low, high)
+            for field, (low, high) in zip(fields, self.FIELD_RANGES)
+        )
+        # cron Sunday is 0 or 7, datetime Sunday is 6
+        self.weekdays = {(weekday - 1) % 7 for weekday in weekdays}
+        self._any_day = fields[2] == "*"
+        self._any_weekday = fields[4] == "*"
+
+    @staticmethod
+    def _parse_field(field, low, high):
+        values = set()
+        for part in field.split(","):
+            value_range, _, step = part.partition("/")
+            step = int(step) if step else 1
+
+            if value_range == "*":
+                start, end = low, high
+            elif "-" in value_range:
+                start, end = (int(value) for value in value_range.split("-"))
+            else:
+                start = int(value_range)
+                end = high if step > 1 else start
+
+            if not low <= start <= end <= high or step < 1:
+                raise ValueError(f"invalid cron field {field!r}")
+            values.update(range(start, end + 1, step))
+        return values
+
+    def _is_day_matched(self, moment):
+        day_matched = moment.day in self.days
+        weekday_matched = moment.weekday() in self.weekdays
+        if self._any_day or self._any_weekday:
+            return day_matched and weekday_matched
+        return day_matched or weekday_matched
+
+    def next_after(self, moment):
+        """
+        Returns the first datetime matching the expression strictly after
+        the given one, whole fields are skipped when they do not match.
+        """
+        moment = moment.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = moment + self.MAX_SEARCH
+
+        while moment < limit:
+            if moment.month not in self.months:
+                moment = (moment.replace(day=1) + timedelta(days=32)).replace(
+                    day=1, hour=0, minute=0
+                )
+            elif not self._is_day_matched(moment):
+                moment = moment.replace(hour=0, minute=0) + timedelta(days=1)
+            elif moment.hour not in self.hours:
+                moment = moment.replace(minute=0) + timedelta(hours=1)
+            elif moment.minute not in self.minutes:
+                moment += timedelta(minutes=1)
+            else:
+                return moment
+
+        raise ValueError(f"cron expression {self.expression!r} never fires")
+
+
+class Trigger:
+    """
+    Schedule of a task.
+
+    Config (one item of the task `schedule`):
+        interval (float): Seconds between two runs.
+        cron (str): 5 fields cron expression, instead of interval.
+        jitter (float): Random delay in seconds added to each run, spreads
+            the runs of many devices or tasks. Default: 0.
+        misfire_grace_time (float): Seconds a run can be late (e.g. after a
+            long blocking call or a system suspend), later runs are skipped.
+            Default: None, never skipped.
+        coalesce (bool): Runs missed meanwhile are executed once instead of
+            once each. Default: yes.
+        args (list): Arguments given to the task, like the (topic, payload)
+            of a rule.
+    """
+
+    def __init__(self, trigger_config):
+        self.trigger_config = trigger_config
+        self.interval = trigger_config.get("interval")
+        self.cron = (
+            CronExpression(trigger_config["cron"])
+            if trigger_config.get("cron")
+            else None
+        )
+        self.jitter = trigger_config.get("jitter", 0)
+        self.misfire_grace_time = trigger_config.get("misfire_grace_time")
+        self.coalesce = trigger_config.get("coalesce", True)
+        self.args = tuple(trigger_config.get("args") or ())
+
+    def next_run(self, after):
+        """Returns the first run time (epoch) after the given one."""
+        if self.cron is not None:
+            return self.cron.next_after(
+                datetime.fromtimestamp(after)
+            ).timestamp()
+
+        return after + self.interval
+
+
+class _Job:
+    __slots__ = ("task_name", "trigger", "due", "jitter", "cancelled")
+
+    def __init__(self, task_name, trigger, due):
+        self.task_name = task_name
+        self.trigger = trigger
+        self.due = due
+        self.jitter = 0
+        self.cancelled = False
+
+
+class _Call:
+    __slots__ = ("callback", "args", "cancelled")
+
+    def __init__(self, callback, args):
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Scheduler:
+    """
+    Runs the scheduled tasks of the flow from a single thread. Jobs are kept
+    in a heap ordered by their next run, the thread sleeps until the first
+    one is due and submits the task, so that the task queues, pools and
+    rate limits apply as for the rules. One-off calls, such as the request
+    timeouts, share the same thread.
+
+    Args:
+        submit (callable): Called as `submit(task_name, args)` for each run.
+    """
+
+    def __init__(self, submit):
+        self.logger = get_logger("scheduler")
+        self._submit = submit
+        self._jobs = {}
+        self._heap = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._thread = None
+        self._running = False
+        self.metrics = {"runs": 0, "misfired": 0, "failed": 0}
+
+    def __len__(self):
+        return len(self._jobs)
+
+    def _push(self, job, run_at):
+        heapq.heappush(self._heap, (run_at, next(self._sequence), job))
+
+    def _schedule(self, job):
+        job.jitter = random.uniform(0, job.trigger.jitter)
+        self._push(job, job.due + job.jitter)
+
+    def set_jobs(self, schedules):
+        """
+        Replaces the scheduled jobs. Jobs whose trigger config is unchanged
+        keep their next run, so a reload does not shift nor repeat runs.
+
+        Args:
+            schedules (dict): Task name to its list of trigger configs.
+        """
+        now = time.time()
+        with self._condition:
+            jobs = {}
+            for task_name, trigger_configs in schedules.items():
+                for index, trigger_config in enumerate(trigger_configs):
+                    key = (task_name, index)
+                    job = self._jobs.pop(key, None)
+                    if (
+                        job is None
+                        or job.trigger.trigger_config != trigger_config
+                    ):
+                        if job is not None:
+                            job.cancelled = True
+                        trigger = Trigger(trigger_config)
+                        job = _Job(task_name, trigger, trigger.next_run(now))
+                        self._schedule(job)
+                    jobs[key] = job
+
+            for job in self._jobs.values():
+                job.cancelled = True
+            self._jobs = jobs
+            self._condition.notify()
+
+    def call_later(self, delay, callback, *args):
+        """
+        Calls `callback(*args)` once from the scheduler thread after delay
+        seconds, e.g. a timeout. The callback must not block.
+
+        Returns:
+            An object whose `cancel()` prevents the call if not done yet.
+        """
+        call = _Call(callback, args)
+        with self._condition:
+            self._push(call, time.time() + delay)
+            self._condition.notify()
+        return call
+
+    def _call(self, call):
+        try:
+            call.callback(*call.args)
+        except Exception:
+            self.logger.exception("Failed to run scheduled call")
+
+    def _run(self, job):
+        try:
+            self._submit(job.task_name, job.trigger.args)
+            self.metrics["runs"] += 1
+        except Exception:
+            self.metrics["failed"] += 1
+            self.logger.exception(
+                "Failed to submit scheduled task %s", job.task_name
+            )
+
+    def _fire(self, job, now):
+        """
+        Runs a due job and schedules its next run. Without coalescing, the
+        next run of a late job is due at once, missed runs are caught up one
+        by one. Runs stay aligned on the schedule, neither the jitter nor
+        the wake up latency shift the next ones.
+        """
+        trigger = job.trigger
+        # the jitter is a planned delay, not a lateness
+        late = now - job.due - job.jitter
+        if (
+            trigger.misfire_grace_time is not None
+            and late > trigger.misfire_grace_time
+        ):
+            self.metrics["misfired"] += 1
+            self.logger.warning(
+                "Scheduled run of %s missed by %.1f s", job.task_name, late
+            )
+        else:
+            self._run(job)
+
+        due = trigger.next_run(job.due)
+        if trigger.coalesce:
+            while due <= now:
+                due = trigger.next_run(due)
+        job.due = due
+
+        with self._condition:
+            if not job.cancelled:
+                self._schedule(job)
+
+    def _loop(self):
+        while True:
+            with self._condition:
+                while self._running:
+                    if self._heap and self._heap[0][2].cancelled:
+                        heapq.heappop(self._heap)
+                        continue
+
+                    timeout = (
+                        self._heap[0][0] - time.time() if self._heap else None
+                    )
+                    if timeout is not None and timeout <= 0:
+                        break
+                    self._condition.wait(timeout)
+
+                if not self._running:
+                    return
+
+                _, _, job = heapq.heappop(self._heap)
+
+            if isinstance(job, _Call):
+                self._call(job)
+            else:
+                self._fire(job, time.time())
+
+    def start(self):
+        with self._condition:
+            if self._running:
+                return
+            self._running = True
+
+        self._thread = threading.Thread(
+            target=self._loop, name="scheduler", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify()
@@ -0,0 +1,541 @@
+from collections import Counter
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+import time
+from mqtt_flow.config.schema import compile_config
+from mqtt_flow.utils.helpers import configure_logging, get_logger
+from mqtt_flow.utils.payload import SpilledPayload
+
+
+class RemoteClientQueue:
+    """
+    Outgoing queue of a client run by another worker process. Messages put
+    by the tasks are sent to the supervisor, which forwards them to the
+    worker of the client, published from the client outgoing queue there.
+    """
+
+    def __init__(self, client_name, outbox, metrics):
+        self.client_name = client_name
+        self._outbox = outbox
+        self._metrics = metrics
+
+    def put(self, message, block=True, timeout=None):
+        if isinstance(message.get("payload"), (memoryview, SpilledPayload)):
+            # mmaps and memoryviews can not be sent to another process
+            message = {**message, "payload": bytes(message["payload"])}
+        self._outbox.put(
+            ("publish", self.client_name, message), block, timeout
+        )
+        self._metrics["forwarded"] += 1
+
+    def put_nowait(self, message):
+        self.put(message, block=False)
+
+
+class FlowShard:
+    """
+    Part of a flow run by a worker process of FlowSupervisor: the clients
+    owned by the worker and its queues to the supervisor. The messages
+    published to the clients of the other workers are sent to the outbox,
+    the messages for the clients of this worker are received in the inbox.
+
+    Each worker has its own pair of queues, which are recreated when it is
+    restarted: a killed worker can not leave a queue shared with the other
+    workers locked.
+
+    Args:
+        index (int): Index of the worker.
+        owners (dict): Client name to the index of the worker running it.
+        inbox (multiprocessing.Queue): Messages from the supervisor, None
+            to stop.
+        outbox (multiprocessing.Queue): Messages and heartbeats to the
+            supervisor.
+    """
+
+    def __init__(self, index, owners, inbox, outbox):
+        self.logger = get_logger(f"flow_shard_{index}")
+        self.index = index
+        self.owners = owners
+        self._inbox = inbox
+        self._outbox = outbox
+        self._thread = None
+        self.stopped = threading.Event()
+        self.metrics = {"forwarded": 0, "received": 0}
+
+    def owns(self, client_name):
+        return self.owners.get(client_name) == self.index
+
+    def create_remote_queue(self, client_name):
+        return RemoteClientQueue(client_name, self._outbox, self.metrics)
+
+    def send_status(self, status):
+        self._outbox.put(("status", self.index, status))
+
+    def _receive(self, clients_queues):
+        while True:
+            item = self._inbox.get()
+            if item is None:
+                self.stopped.set()
+                return
+
+            client_name, message = item
+            try:
+                clients_queues[client_name]["outgoing"].put(message)
+                self.metrics["received"] += 1
+            except Exception:
+                self.logger.exception(
+                    "Failed to forward message to client %s", client_name
+                )
+
+    def start(self, clients_queues):
+        """Publishes the messages forwarded by the other workers."""
+        self._thread = threading.Thread(
+            target=self._receive,
+            args=(clients_queues,),
+            name=f"shard_{self.index}_inbox",
+            daemon=True,
+        )
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None and not self.stopped.is_set():
+            self._inbox.put(None)
+
+
+def partition_clients(config, workers):
+    """
+    Assigns the MQTT clients to the workers. Clients with a `shard` are
+    pinned to that worker, the others go to the least loaded worker, the
+    load of a client being one plus its number of rules.
+
+    Returns:
+        dict: Client name to worker index.
+    """
+    rules_count = Counter(
+        rule.get("source_client_name") for rule in config.get("rules") or []
+    )
+    loads = [0] * workers
+    owners = {}
+    unpinned = []
+
+    for client_config in config.get("mqtt_clients") or []:
+        client_name = client_config["client_name"]
+        shard = client_config.get("shard")
+        if shard is None:
+            unpinned.append(client_name)
+            continue
+        if not 0 <= shard < workers:
+            raise ValueError(
+                f"Client {client_name} shard {shard} is not one of the "
+                f"{workers} workers"
+            )
+        owners[client_name] = shard
+        loads[shard] += 1 + rules_count[client_name]
+
+    for client_name in sorted(
+        unpinned, key=lambda name: rules_count[name], reverse=True
+    ):
+        index = loads.index(min(loads))
+        owners[client_name] = index
+        loads[index] += 1 + rules_count[client_name]
+
+    return owners
+
+
+def _sum_metrics(total, metrics):
+    """Adds the numeric metrics to the total, recursively."""
+    for key, value in metrics.items():
+        if isinstance(value, dict):
+            _sum_metrics(total.setdefault(key, {}), value)
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            total[key] = total.get(key, 0) + value
+    return total
+
+
+def wait_for_shutdown():
+    """Blocks the main thread until SIGINT or SIGTERM."""
+    stopped = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *args: stopped.set())
+
+    while not stopped.wait(1):
+        pass
+
+
+def _collect_metrics(flow, shard):
+    return {
+        "pools": flow.get_pools_metrics(),
+        "scheduler": flow.get_scheduler_metrics(),
+        "requests": flow.get_requests_metrics(),
+        "outgoing_buffers": flow.get_outgoing_buffers_metrics(),
+        "shard": dict(shard.metrics),
+    }
+
+
+def _run_worker(
+    index, config, owners, inbox, outbox, cpus, heartbeat_interval
+):
+    """Entry point of a worker process, runs one shard of the flow."""
+    # imported here, the supervisor process never runs a flow
+    from mqtt_flow.core.mqtt_flow import MQTTFlow
+
+    configure_logging(config.get("logging") or {})
+    logger = get_logger(f"flow_worker_{index}")
+    parent_pid = os.getppid()
+
+    if cpus:
+        os.sched_setaffinity(0, cpus)
+
+    shard = FlowShard(index, owners, inbox, outbox)
+    flow = MQTTFlow(config, shard=shard)
+    flow.start()
+    logger.info(
+        "Worker %s started with pid %s, clients %s",
+        index,
+        os.getpid(),
+        sorted(flow.get_client_names()),
+    )
+
+    while not shard.stopped.wait(heartbeat_interval):
+        if os.getppid() != parent_pid:
+            logger.warning("Supervisor exited, stopping worker %s", index)
+            break
+
+        try:
+            shard.send_status(
+                {
+                    "time": time.time(),
+                    "ready": flow.wait_ready(0),
+                    "metrics": _collect_metrics(flow, shard),
+                }
+            )
+        except Exception:
+            logger.exception("Failed to send heartbeat of worker %s", index)
+
+    flow.stop()
+    # the flow consumer threads never return
+    os._exit(0)
+
+
+class FlowSupervisor:
+    """
+    Runs a flow across several worker processes, one MQTTFlow per process,
+    so that it is not bound to a single core by the GIL.
+
+    The MQTT clients are partitioned across the workers (see
+    `partition_clients`), each worker runs its clients, the rules on their
+    messages and the tasks those rules submit. Messages published by a task
+    to a client of another worker are forwarded to that worker by the
+    supervisor, over the queues (pipes) of the workers. Scheduled tasks run
+    in the worker owning their `client_for_userdata`.
+
+    Each worker has its own task queues, pools, last value cache and
+    pending requests: a task only sees the last values and can only make
+    requests through the clients of its worker.
+
+    Config (`supervisor` section of the flow config):
+        workers (int): Worker processes. Default: number of CPUs.
+        cpu_affinity (bool or list): Pins each worker to a CPU, or to the
+            CPUs of its item in a list of CPU lists. Linux only.
+            Default: no.
+        heartbeat_interval (float): Seconds between two heartbeats of the
+            workers, which carry their metrics. Default: 5.
+        heartbeat_timeout (float): Seconds without heartbeat after which a
+            worker is unhealthy. Default: 3 heartbeat intervals.
+        restart (bool): Restarts the workers which died or stopped sending
+            heartbeats. Default: yes.
+
+    Args:
+        config (dict): Raw config as returned by
+            MQTTConfigLoader.get_config, sent as is to the workers. Its
+            values (e.g. userdata) must be picklable.
+        supervisor_config (dict): Overrides the `supervisor` section.
+
+    Raises:
+        ConfigValidationError: If the config is invalid.
+    """
+
+    DEFAULT_HEARTBEAT_INTERVAL = 5
+    HEARTBEAT_TIMEOUT_INTERVALS = 3
+    STOP_TIMEOUT = 10
+
+    def __init__(self, config, supervisor_config=None):
+        self.logger = get_logger("flow_supervisor")
+        # fails fast, before any worker is spawned
+        compile_config(config)
+        self.config = config
+
+        if supervisor_config is None:
+            supervisor_config = config.get("supervisor") or {}
+        self.workers = supervisor_config.get("workers") or os.cpu_count()
+        self.cpu_affinity = supervisor_config.get("cpu_affinity", False)
+        self.heartbeat_interval = supervisor_config.get(
+            "heartbeat_interval", self.DEFAULT_HEARTBEAT_INTERVAL
+        )
+        self.heartbeat_timeout = supervisor_config.get(
+            "heartbeat_timeout",
+            self.heartbeat_interval * self.HEARTBEAT_TIMEOUT_INTERVALS,
+        )
+        self.restart = supervisor_config.get("restart", True)
+
+        self.owners = partition_clients(config, self.workers)
+        for index in range(self.workers):
+            if index not in self.owners.values():
+                self.logger.warning("Worker %s has no MQTT client", index)
+
+        # spawned workers do not inherit the threads and locks of the parent
+        self._context = multiprocessing.get_context("spawn")
+        self._processes = [None] * self.workers
+        self._inboxes = [None] * self.workers
+        self._status = [
+            {
+                "heartbeat": None,
+                "ready": False,
+                "metrics": {},
+                "restarts": 0,
+                "exitcode": None,
+            }
+            for _ in range(self.workers)
+        ]
+        self._started_at = [None] * self.workers
+        self._lock = threading.Lock()
+        self._running = False
+
+    def _get_worker_config(self, index):
+        """
+        Returns the config of a worker: all the clients, tasks and chains,
+        only the rules of its clients and the schedules of its tasks.
+        """
+        owned = {
+            client_name
+            for client_name, owner in self.owners.items()
+            if owner == index
+        }
+
+        tasks = {}
+        for task_name, task_config in (self.config.get("tasks") or {}).items():
+            if (
+                task_config.get("schedule")
+                and task_config.get("client_for_userdata") not in owned
+            ):
+                task_config = {
+                    key: value
+                    for key, value in task_config.items()
+                    if key != "schedule"
+                }
+            tasks[task_name] = task_config
+
+        return {
+            **self.config,
+            "tasks": tasks,
+            "rules": [
+                rule_config
+                for rule_config in self.config.get("rules") or []
+                if rule_config.get("source_client_name") in owned
+            ],
+        }
+
+    def _get_worker_cpus(self, index):
+        if not self.cpu_affinity:
+            return None
+        if not hasattr(os, "sched_setaffinity"):
+            self.logger.warning("CPU affinity is not supported, ignored")
+            return None
+
+        if self.cpu_affinity is True:
+            cpus = sorted(os.sched_getaffinity(0))
+            return [cpus[index % len(cpus)]]
+        return list(self.cpu_affinity[index % len(self.cpu_affinity)])
+
+    def _start_worker(self, index):
+        inbox = self._context.Queue()
+        outbox = self._context.Queue()
+        process = self._context.Process(
+            target=_run_worker,
+            args=(
+                index,
+                self._get_worker_config(index),
+                self.owners,
+                inbox,
+                outbox,
+                self._get_worker_cpus(index),
+                self.heartbeat_interval,
+            ),
+            name=f"mqtt_flow_worker_{index}",
+        )
+        process.start()
+        self._processes[index] = process
+        self._inboxes[index] = inbox
+        self._started_at[index] = time.time()
+        self.logger.info("Started worker %s, pid %s", index, process.pid)
+
+        threading.Thread(
+            target=self._route,
+            args=(index, process, outbox),
+            name=f"flow_supervisor_route_{index}",
+            daemon=True,
+        ).start()
+
+    def _update_status(self, index, status):
+        with self._lock:
+            worker_status = self._status[index]
+            worker_status["heartbeat"] = status["time"]
+            worker_status["ready"] = status["ready"]
+            worker_status["metrics"] = status["metrics"]
+
+    def _route(self, index, process, outbox):
+        """
+        Receives the heartbeats of a worker and forwards its messages to
+        the clients of the other workers, until the worker is replaced.
+        """
+        while self._running and self._processes[index] is process:
+            try:
+                kind, target, item = outbox.get(
+                    timeout=self.heartbeat_interval
+                )
+            except queue.Empty:
+                continue
+            except (EOFError, OSError):
+                return
+
+            if kind == "status":
+                self._update_status(index, item)
+                continue
+
+            try:
+                self._inboxes[self.owners[target]].put((target, item))
+            except Exception:
+                self.logger.exception(
+                    "Failed to forward message to client %s", target
+                )
+
+    def _heartbeat_age(self, index, now):
+        last_seen = self._status[index]["heartbeat"]
+        if last_seen is None or last_seen < self._started_at[index]:
+            last_seen = self._started_at[index]
+        return now - last_seen
+
+    def _check_workers(self):
+        now = time.time()
+        for index, process in enumerate(self._processes):
+            if not process.is_alive():
+                if self._status[index].get("exitcode") is not None:
+                    # already reported, not restarted
+                    continue
+                self._status[index]["exitcode"] = process.exitcode
+                self.logger.error(
+                    "Worker %s exited with code %s", index, process.exitcode
+                )
+            elif self._heartbeat_age(index, now) > self.heartbeat_timeout:
+                self.logger.error(
+                    "Worker %s stopped sending heartbeats", index
+                )
+                if not self.restart:
+                    continue
+                process.terminate()
+                process.join(self.STOP_TIMEOUT)
+            else:
+                continue
+
+            if self.restart and self._running:
+                with self._lock:
+                    self._status[index]["restarts"] += 1
+                    self._status[index]["ready"] = False
+                    self._status[index]["exitcode"] = None
+                self._start_worker(index)
+
+    def _monitor(self):
+        while self._running:
+            time.sleep(self.heartbeat_interval)
+            if self._running:
+                self._check_workers()
+
+    def start(self):
+        """Starts the worker processes and their monitoring."""
+        self._running = True
+        for index in range(self.workers):
+            self._start_worker(index)
+
+        threading.Thread(
+            target=self._monitor, name="flow_supervisor", daemon=True
+        ).start()
+
+    def stop(self):
+        """Stops the workers, terminated if they do not exit in time."""
+        self._running = False
+        for index, process in enumerate(self._processes):
+            if process is not None and process.is_alive():
+                self._inboxes[index].put(None)
+
+        deadline = time.monotonic() + self.STOP_TIMEOUT
+        for index, process in enumerate(self._processes):
+            if process is None:
+                continue
+            process.join(max(deadline - time.monotonic(), 0))
+            if process.is_alive():
+                self.logger.warning("Terminating worker %s", index)
+                process.terminate()
+                process.join()
+
+    def run(self):
+        """Runs the workers until SIGINT or SIGTERM."""
+        self.start()
+        try:
+            wait_for_shutdown()
+        finally:
+            self.stop()
+
+    def get_metrics(self):
+        """
+        Get the last metrics sent by each worker and their sum over all the
+        workers.
+        """
+        with self._lock:
+            workers = {
+                index: status["metrics"]
+                for index, status in enumerate(self._status)
+            }
+
+        total = {}
+        for metrics in workers.values():
+            _sum_metrics(total, metrics)
+        return {"total": total, "workers": workers}
+
+    def get_health(self):
+        """
+        Get the state of each worker. The supervisor is healthy when all
+        the workers are alive, sent a heartbeat in time and have all their
+        clients connected.
+        """
+        now = time.time()
+        workers = {}
+        with self._lock:
+            for index, process in enumerate(self._processes):
+                status = self._status[index]
+                alive = process is not None and process.is_alive()
+                heartbeat_age = (
+                    self._heartbeat_age(index, now) if alive else None
+                )
+                workers[index] = {
+                    "pid": process.pid if process is not None else None,
+                    "alive": alive,
+                    "ready": status["ready"],
+                    "heartbeat_age": heartbeat_age,
+                    "restarts": status["restarts"],
+                    "clients": sorted(
+                        client_name
+                        for client_name, owner in self.owners.items()
+                        if owner == index
+                    ),
+                }
+
+        healthy = all(
+            worker["alive"]
+            and worker["ready"]
+            and worker["heartbeat_age"] <= self.heartbeat_timeout
+            for worker in workers.values()
+        )
+        return {"healthy": healthy, "workers": workers}
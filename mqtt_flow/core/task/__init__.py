@@ -1,4 +1,5 @@
 from .flow_task import MQTTFlowTask
 from .relay_message_task import RelayMessage
 from .simple_task import SimpleTask
-from .task_loader import load_task_class
\ No newline at end of file
+from .task_loader import load_task_class
+from .window_aggregate_task import WindowAggregate
\ No newline at end of file
@@ -1,5 +1,5 @@
 from mqtt_flow.core.task.flow_task import MQTTFlowTask
-from mqtt_flow.utils.helpers import format_topic
+from mqtt_flow.utils.helpers import get_topic_formatter
 from mqtt_flow.utils.helpers import get_logger
 
 
@@ -20,13 +20,15 @@ class RelayMessage(MQTTFlowTask):
         else:
             self.topic_formatters = []
 
+        self._format_topic = get_topic_formatter(self.topic_formatters)
+
     def format_payload(self):
         return self.payload
 
     def process(self):
 
         topic = (
-            format_topic(self.topic, self.topic_formatters)
+            self._format_topic(self.topic)
             if self.topic_to_publish is None
             else self.topic_to_publish
         )
@@ -37,9 +39,17 @@ class RelayMessage(MQTTFlowTask):
             payload,
             persist=self.persist,
             qos=self.qos,
+            **(
+                {"user_properties": self.user_properties}
+                if self.user_properties
+                else {}
+            ),
         )
 
         if self.log:
             self.logger.info(
-                f"Message relayed to client {self.client_to_publish}: {topic} -> {payload}"
+                "Message relayed to client %s: %s -> %s",
+                self.client_to_publish,
+                topic,
+                payload,
             )
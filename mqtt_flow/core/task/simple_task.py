@@ -1,4 +1,5 @@
 import abc
+import functools
 
 
 class SimpleTask(metaclass=abc.ABCMeta):
@@ -6,26 +7,111 @@ class SimpleTask(metaclass=abc.ABCMeta):
     def __init__(self, userdata, task_config):
         self._userdata = userdata
         self.task_config = task_config
-        self.name = task_config.get("name")
+        self.name = task_config.name
+        self.user_properties = {}
+        self.priority = task_config.priority
 
         self._client_name = self._userdata.get("_client_name")
         self._tasks_queues = self._userdata.get("_tasks_queues")
         self._clients_queues = self._userdata.get("_clients_queues")
         self._tasks = self._userdata.get("_tasks")
+        self._last_value_cache = self._userdata.get("_last_value_cache")
+        self._pending_requests = self._userdata.get("_pending_requests")
 
-    def publish_message(self, client_name, topic, payload, *args, **kwargs):
+    def publish_message(
+        self, client_name, topic, payload, *args, priority=None, **kwargs
+    ):
         self._clients_queues[client_name]["outgoing"].put(
             {
                 "topic": topic,
                 "payload": payload,
                 "args": args,
                 "kwargs": kwargs,
+                "priority": self.priority if priority is None else priority,
             }
         )
 
+    def request(
+        self, client_name, topic, payload, reply_topic, timeout=None, **kwargs
+    ):
+        """
+        Publishes a request and returns a concurrent.futures.Future of its
+        reply, see PendingRequests.request. The task does not need to wait:
+        a done callback can submit the task handling the reply, e.g.
+
+            future = self.request("client", "cmd/reboot", {}, "cmd/replies")
+            future.add_done_callback(
+                lambda reply: self.submit_task(
+                    "on_reboot_reply", (reply.result()["payload"],)
+                )
+            )
+
+        Args:
+            client_name (str): Client publishing the request and receiving
+                the reply.
+            topic (str): Request topic.
+            payload: Request payload, must be a dict with MQTT v3.1.1.
+            reply_topic (str): Topic of the replies.
+            timeout (float): Seconds to wait for the reply, the future fails
+                with a TimeoutError after. Default: 30.
+            kwargs: Publish arguments, e.g. qos.
+        """
+        return self._pending_requests.request(
+            client_name,
+            topic,
+            payload,
+            reply_topic,
+            functools.partial(self.publish_message, client_name),
+            timeout=timeout,
+            **kwargs,
+        )
+
+    def get_last_value(self, topic, client_name=None, default=None):
+        """
+        Returns the last payload received on the topic by the given client
+        (the task client by default) from the flow last value cache.
+        """
+        if self._last_value_cache is None:
+            return default
+
+        return self._last_value_cache.get(
+            client_name or self._client_name, topic, default
+        )
+
+    def get_last_values(self, topic_filter, client_name=None):
+        """
+        Returns a dict of topic to last payload for the topics matching the
+        MQTT topic filter, for the given client or all clients.
+        """
+        if self._last_value_cache is None:
+            return {}
+
+        return self._last_value_cache.snapshot(topic_filter, client_name)
+
     def __str__(self):
         return f"Task {self.name}"
 
+    @classmethod
+    def check_config(cls, task_config):
+        """
+        Called when the config is compiled, raises a ValueError for invalid
+        task specific options.
+        """
+
+    @classmethod
+    def load(cls, task_config):
+        """
+        Called when the flow loads the task, on start and when a reload adds
+        or changes it. The task config given is the current one.
+        """
+
+    @classmethod
+    def unload(cls, task_config):
+        """
+        Called when the task is removed or replaced by a reload of the flow,
+        to release the state shared by its instances if any.
+        """
+
     def submit_task(self, task_name, task_args=None, task_kwargs=None):
         self._tasks[task_name].submit(
             userdata=self._userdata,
@@ -0,0 +1,365 @@
+from array import array
+import bisect
+import math
+import re
+import threading
+import time
+from mqtt_flow.core.task.flow_task import MQTTFlowTask
+from mqtt_flow.utils.helpers import get_topic_formatter
+from mqtt_flow.utils.helpers import get_logger
+
+# NumPy is imported when the first window is reduced, False until then
+_numpy = False
+
+
+def _get_numpy():
+    global _numpy
+
+    if _numpy is False:
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        _numpy = numpy
+    return _numpy
+
+
+PERCENTILE_REGEX = re.compile(r"^p(\d+(?:\.\d+)?)$")
+
+
+def _percentile(values, percent):
+    """Linear interpolation percentile, same as numpy's default method."""
+    values = sorted(values)
+    position = (len(values) - 1) * percent / 100
+    lower = math.floor(position)
+    upper = math.ceil(position)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+_REDUCERS = {
+    "count": len,
+    "sum": math.fsum,
+    "min": min,
+    "max": max,
+    "mean": lambda values: math.fsum(values) / len(values),
+    "last": lambda values: values[-1],
+}
+
+_NUMPY_REDUCERS = {
+    "count": lambda values: int(values.size),
+    "sum": lambda values: float(values.sum()),
+    "min": lambda values: float(values.min()),
+    "max": lambda values: float(values.max()),
+    "mean": lambda values: float(values.mean()),
+    "last": lambda values: float(values[-1]),
+}
+
+
+def _reduce(values, aggregations):
+    """
+    Reduces the given values (array of floats, NaN for missing values) to
+    the requested aggregations. Uses NumPy vectorized reductions when
+    available.
+    """
+    np = _get_numpy()
+    if np is not None:
+        values = np.array(values, dtype=np.float64)
+        values = values[~np.isnan(values)]
+        reducers = _NUMPY_REDUCERS
+        percentile = lambda values, percent: float(
+            np.percentile(values, percent)
+        )
+    else:
+        values = [value for value in values if not math.isnan(value)]
+        reducers = _REDUCERS
+        percentile = _percentile
+
+    if not len(values):
+        return None
+
+    result = {}
+    for aggregation in aggregations:
+        if aggregation in reducers:
+            result[aggregation] = reducers[aggregation](values)
+        else:
+            result[aggregation] = percentile(
+                values, float(PERCENTILE_REGEX.match(aggregation)[1])
+            )
+    return result
+
+
+class _KeyWindow:
+    """Array backed samples of a single window key."""
+
+    __slots__ = ("topic", "timestamps", "values")
+
+    def __init__(self, topic, fields):
+        self.topic = topic
+        self.timestamps = array("d")
+        self.values = {field: array("d") for field in fields}
+
+    def add(self, timestamp, values):
+        self.timestamps.append(timestamp)
+        for field, field_values in self.values.items():
+            field_values.append(values.get(field, math.nan))
+
+    def evict(self, before):
+        index = bisect.bisect_left(self.timestamps, before)
+        if index:
+            del self.timestamps[:index]
+            for field_values in self.values.values():
+                del field_values[:index]
+
+
+class WindowStore:
+    """
+    Shared state of a WindowAggregate task. Windows end on multiples of
+    `step` (equal to `size` for tumbling windows) and are closed by a
+    single thread per task, which publishes one aggregated message per key.
+    """
+
+    TUMBLING = "tumbling"
+    SLIDING = "sliding"
+    DEFAULT_AGGREGATIONS = ("count", "mean", "min", "max", "last")
+    AGGREGATIONS = tuple(_REDUCERS)
+
+    def __init__(self, window_config, publish):
+        self.logger = get_logger("window_aggregate")
+        self.type = window_config.get("type", self.TUMBLING)
+        self.size = window_config.get("size", 60)
+        self.step = (
+            window_config.get("step", self.size)
+            if self.type == self.SLIDING
+            else self.size
+        )
+        self.key = window_config.get("key", "topic")
+        self.fields = tuple(window_config.get("fields", ["value"]))
+        self.aggregations = tuple(
+            window_config.get("aggregations", self.DEFAULT_AGGREGATIONS)
+        )
+        self._publish = publish
+        self._windows = {}
+        self._lock = threading.Lock()
+        self._stopped = False
+
+        self.check_aggregations(self.aggregations)
+
+        threading.Thread(target=self._close_windows, daemon=True).start()
+
+    @classmethod
+    def check_aggregations(cls, aggregations):
+        """Raises a ValueError for an unknown aggregation or percentile."""
+        for aggregation in aggregations:
+            if aggregation in cls.AGGREGATIONS:
+                continue
+
+            match = PERCENTILE_REGEX.match(str(aggregation))
+            if match is None:
+                raise ValueError(f"Unknown window aggregation {aggregation}")
+            if not 0 <= float(match[1]) <= 100:
+                raise ValueError(
+                    f"Window percentile {aggregation} is not within p0-p100"
+                )
+
+    def add(self, key, topic, values):
+        with self._lock:
+            # taken under the lock to keep the samples sorted by time
+            timestamp = time.time()
+            window = self._windows.get(key)
+            if window is None:
+                window = self._windows[key] = _KeyWindow(topic, self.fields)
+            window.add(timestamp, values)
+
+    def close(self, end):
+        """
+        Aggregates the samples of the window ending at `end` for every key,
+        publishes them and evicts the samples not needed anymore.
+        """
+        start = end - self.size
+        closed = []
+
+        with self._lock:
+            for key, window in list(self._windows.items()):
+                lower = bisect.bisect_left(window.timestamps, start)
+                upper = bisect.bisect_left(window.timestamps, end)
+
+                if upper > lower:
+                    closed.append(
+                        (
+                            key,
+                            window.topic,
+                            {
+                                field: window.values[field][lower:upper]
+                                for field in self.fields
+                            },
+                        )
+                    )
+
+                window.evict(end + self.step - self.size)
+                if not window.timestamps:
+                    del self._windows[key]
+
+        # reductions and publishes happen outside of the lock
+        for key, topic, values in closed:
+            payload = {"key": key, "start": start, "end": end}
+            for field, field_values in values.items():
+                aggregated = _reduce(field_values, self.aggregations)
+                if aggregated is not None:
+                    payload[field] = aggregated
+            self._publish(topic, payload)
+
+    def stop(self):
+        """Stops the closing thread once the current window is closed."""
+        self._stopped = True
+
+    def _close_windows(self):
+        end = (math.floor(time.time() / self.step) + 1) * self.step
+        while True:
+            time.sleep(max(end - time.time(), 0))
+            try:
+                self.close(end)
+            except Exception:
+                self.logger.exception("Exception while closing windows")
+            if self._stopped:
+                return
+            end += self.step
+
+
+class WindowAggregate(MQTTFlowTask):
+    """
+    Aggregates numeric payload fields over tumbling or sliding time windows
+    per key and publishes one message per key when a window closes.
+
+    Task config:
+        window:
+            type: tumbling or sliding
+            size: window length in seconds
+            step: sliding windows only, seconds between two windows
+            key: `topic` or the payload field used to group messages
+            fields: numeric payload fields, `value` for scalar payloads
+            aggregations: count, sum, min, max, mean, last or pNN
+        client_to_publish: client publishing the aggregates
+        topic_to_publish / topic_formatters: as for RelayMessage
+    """
+
+    _stores = {}
+    # task name -> its current task config, None once unloaded
+    _loaded_task_configs = {}
+    _stores_lock = threading.Lock()
+
+    def __init__(self, userdata, task_config, topic, payload):
+        super().__init__(userdata, task_config, topic, payload)
+        self.client_to_publish = self.task_config.get("client_to_publish")
+        self.topic_to_publish = self.task_config.get("topic_to_publish")
+        self.qos = self.task_config.get("qos", 0)
+        self.persist = self.task_config.get("persist", False)
+        self._format_topic = get_topic_formatter(
+            self.task_config.get("topic_formatters", [])
+        )
+
+    def _get_store(self):
+        """
+        Returns the store of the task config, None if the config was
+        replaced or removed by a reload: the instances still queued with
+        it never replace the store of the current config.
+        """
+        task_config, store = self._stores.get(self.name, (None, None))
+        if task_config is self.task_config:
+            return store
+
+        with self._stores_lock:
+            # instances created without the flow load their own config
+            loaded = self._loaded_task_configs.setdefault(
+                self.name, self.task_config
+            )
+            if loaded is not self.task_config:
+                return None
+
+            task_config, store = self._stores.get(self.name, (None, None))
+            if task_config is not self.task_config:
+                if store is not None:
+                    store.stop()
+                store = WindowStore(
+                    self.task_config.get("window", {}),
+                    self.publish_aggregate,
+                )
+                self._stores[self.name] = (self.task_config, store)
+        return store
+
+    @classmethod
+    def check_config(cls, task_config):
+        WindowStore.check_aggregations(
+            (task_config.get("window") or {}).get(
+                "aggregations", WindowStore.DEFAULT_AGGREGATIONS
+            )
+        )
+
+    @classmethod
+    def load(cls, task_config):
+        with cls._stores_lock:
+            name = task_config.get("name")
+            cls._loaded_task_configs[name] = task_config
+            stored_task_config, store = cls._stores.get(name, (None, None))
+            if store is not None and stored_task_config is not task_config:
+                store.stop()
+                del cls._stores[name]
+
+    @classmethod
+    def unload(cls, task_config):
+        with cls._stores_lock:
+            name = task_config.get("name")
+            if cls._loaded_task_configs.get(name) is task_config:
+                cls._loaded_task_configs[name] = None
+
+            stored_task_config, store = cls._stores.get(name, (None, None))
+            if stored_task_config is task_config:
+                store.stop()
+                del cls._stores[name]
+
+    def publish_aggregate(self, topic, payload):
+        self.publish_message(
+            self.client_to_publish,
+            topic,
+            payload,
+            persist=self.persist,
+            qos=self.qos,
+        )
+
+    def get_values(self, fields):
+        if isinstance(self.payload, dict):
+            values = {}
+            for field in fields:
+                try:
+                    values[field] = float(self.payload[field])
+                except (KeyError, TypeError, ValueError):
+                    pass
+            return values
+
+        try:
+            return {"value": float(self.payload)}
+        except (TypeError, ValueError):
+            return {}
+
+    def process(self):
+        store = self._get_store()
+        if store is None:
+            # queued before a reload replaced or removed the task
+            return
+
+        values = self.get_values(store.fields)
+        if not values:
+            return
+
+        if store.key == "topic":
+            key = self.topic
+        elif isinstance(self.payload, dict):
+            key = self.payload.get(store.key)
+        else:
+            key = None
+
+        topic = (
+            self.topic_to_publish
+            if self.topic_to_publish
+            else self._format_topic(self.topic)
+        )
+        store.add(key, topic, values)
@@ -3,6 +3,7 @@ from mqtt_flow.core.executor_pools import (
     SimpleThreadPool,
     ThreadPool,
     SequentialPool,
+    AdaptiveThreadPool,
 )
 from mqtt_flow.utils.helpers import get_logger
 import time
@@ -14,6 +15,7 @@ class TasksExecutor:
         "simple_thread": SimpleThreadPool,
         "thread": ThreadPool,
         "sequential": SequentialPool,
+        "adaptive_thread": AdaptiveThreadPool,
     }
 
     def __init__(self, tasks_queues, queues_config, pools_config):
@@ -22,13 +24,16 @@ class TasksExecutor:
         self.queues_config = queues_config
         self.pools_config = pools_config
         self._pools = self._create_pools()
+        self._consumed_queues = set()
+        self._started = False
 
-    def _create_pools(self):
-        pools = {}
+    def _create_pools(self, pools=None):
+        pools = dict(pools or {})
         for pool_config in self.pools_config:
-            pool_name = pool_config.get("name")
-            pool_type = pool_config.get("type")
-            pools[pool_name] = self.POOL_TYPES[pool_type](pool_config)
+            if pool_config.name not in pools:
+                pools[pool_config.name] = self.POOL_TYPES[pool_config.type](
+                    pool_config
+                )
         return pools
 
     def consume_task_queue(
@@ -41,7 +46,7 @@ class TasksExecutor:
         while True:
             try:
                 task = task_queue.get()
-                self.logger.debug(f"Executing Task {task}")
+                self.logger.debug("Executing Task %s", task)
                 if pool.resource_available:
                     pool.submit(task.process)
 
@@ -56,20 +61,49 @@ class TasksExecutor:
             except Exception:
                 self.logger.exception("Exception in Task Consumer")
 
+    def get_pools_metrics(self):
+        """Returns the metrics of the pools exposing them, by pool name."""
+        return {
+            pool_name: pool.metrics
+            for pool_name, pool in self._pools.items()
+            if hasattr(pool, "metrics")
+        }
+
+    def reload(self, queues_config, pools_config):
+        """
+        Creates the new pools and consumes the new task queues, existing
+        pools and queue consumers keep their settings.
+        """
+        self.queues_config = queues_config
+        self.pools_config = pools_config
+        self._pools = self._create_pools(self._pools)
+        if self._started:
+            self._consume_task_queues()
+
     def start(self):
+        self._started = True
+        self._consume_task_queues()
+
+    def _consume_task_queues(self):
         for task_queue_name, task_queue in self.tasks_queues.items():
+            if task_queue_name in self._consumed_queues:
+                continue
+
             pool = None
             for queue_config in self.queues_config:
-                if queue_config.get("name") == task_queue_name:
-                    pool_name = queue_config.get("pool")
-                    pool = self._pools[pool_name]
-                    execution_rate_limit_per_second = queue_config.get(
-                        "execution_rate_limit_per_second",
-                        self.DEFAULT_EXECUTION_RATE_LIMIT_PER_SECOND,
+                if queue_config.name == task_queue_name:
+                    pool = self._pools[queue_config.pool]
+                    execution_rate_limit_per_second = (
+                        queue_config.execution_rate_limit_per_second
+                        or self.DEFAULT_EXECUTION_RATE_LIMIT_PER_SECOND
                     )
                     break
 
             if pool is not None:
+                self._consumed_queues.add(task_queue_name)
+                if isinstance(pool, AdaptiveThreadPool):
+                    pool.register_queue(task_queue)
+
                 task_queue_thread = threading.Thread(
                     target=self.consume_task_queue,
                     args=(task_queue, pool, execution_rate_limit_per_second),
@@ -0,0 +1,686 @@
+"""
+In-process MQTT broker and paho client double, for deterministic tests and
+high rate local runs without any network.
+
+    broker = LoopbackBroker(latency=0.001)
+    flow = MQTTFlow(config, client_factory=broker.client_factory)
+
+The clients created by `broker.client_factory` implement the subset of the
+paho `Client` API used by MQTTClient. Each client runs its own loop thread
+calling the callbacks in order, like the paho network loop.
+"""
+
+from collections import deque
+import functools
+import heapq
+import itertools
+import threading
+import time
+import paho.mqtt.client as mqtt
+from paho.mqtt.properties import Properties
+from paho.mqtt.packettypes import PacketTypes
+from mqtt_flow.utils.helpers import topic_matches_filter
+
+SHARED_SUBSCRIPTION_PREFIX = "$share/"
+
+CONNECTION_LOST = 7
+
+
+def _encode_payload(payload):
+    """Same conversion as paho publish."""
+    if payload is None:
+        return b""
+    if isinstance(payload, (bytes, bytearray)):
+        return bytes(payload)
+    if isinstance(payload, str):
+        return payload.encode()
+    if isinstance(payload, (int, float)):
+        return str(payload).encode()
+    raise TypeError("payload must be a string, bytearray, int, float or None.")
+
+
+class LoopbackMessage:
+    """Received message, same attributes as paho MQTTMessage."""
+
+    __slots__ = ("topic", "payload", "qos", "retain", "mid", "properties")
+
+    def __init__(self, topic, payload, qos=0, retain=False, properties=None):
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.retain = retain
+        self.mid = 0
+        self.properties = properties
+
+
+class LoopbackMessageInfo:
+    """Result of a publish, same API as paho MQTTMessageInfo."""
+
+    def __init__(self, mid, rc=mqtt.MQTT_ERR_SUCCESS):
+        self.mid = mid
+        self.rc = rc
+        self._published = threading.Event()
+
+    def _set_as_published(self):
+        self._published.set()
+
+    def is_published(self):
+        return self._published.is_set()
+
+    def wait_for_publish(self, timeout=None):
+        return self._published.wait(timeout)
+
+
+class _Subscription:
+    __slots__ = ("client_id", "topic_filter", "qos", "group")
+
+    def __init__(self, client_id, topic, qos):
+        self.client_id = client_id
+        self.qos = qos
+        self.group = None
+        if topic.startswith(SHARED_SUBSCRIPTION_PREFIX):
+            self.group, topic = topic[len(SHARED_SUBSCRIPTION_PREFIX) :].split(
+                "/", 1
+            )
+        self.topic_filter = topic
+
+
+class _Session:
+    """Broker side state of a client id, kept between connections."""
+
+    def __init__(self):
+        self.client = None
+        self.clean = True
+        self.subscriptions = {}
+        self.pending = deque()
+
+
+class LoopbackBroker:
+    """
+    In-memory MQTT broker.
+
+    Features: `+`/`#` wildcard routing, `$share/<group>/` shared
+    subscriptions (round robin), retained messages, persistent sessions
+    (QoS 1/2 messages kept while a non clean client is offline), QoS 1/2
+    acknowledgements after a network round trip, will messages and topic
+    aliases.
+
+    Args:
+        latency (float or callable): One way client <-> broker latency in
+            seconds, or a function returning it (jitter).
+        topic_alias_maximum (int): Aliases accepted per MQTT v5 connection.
+        match_cache_size (int): Topics whose matching subscriptions are
+            cached.
+    """
+
+    DEFAULT_MATCH_CACHE_SIZE = 4096
+
+    def __init__(
+        self,
+        latency=0,
+        topic_alias_maximum=0,
+        match_cache_size=DEFAULT_MATCH_CACHE_SIZE,
+    ):
+        self.latency = latency
+        self.topic_alias_maximum = topic_alias_maximum
+        self.online = True
+        self.metrics = {
+            "published": 0,
+            "delivered": 0,
+            "dropped": 0,
+            "connections": 0,
+            "disconnections": 0,
+        }
+        self._sessions = {}
+        self._retained = {}
+        self._refused = set()
+        self._group_counters = {}
+        self._lock = threading.RLock()
+        self._match = functools.lru_cache(maxsize=match_cache_size)(
+            self._match_subscriptions
+        )
+
+    def client_factory(
+        self, client_id="", userdata=None, protocol=mqtt.MQTTv311, **kwargs
+    ):
+        """
+        Client factory for MQTTClient and MQTTFlow, creates clients
+        connected to this broker.
+        """
+        return LoopbackClient(
+            self,
+            client_id=client_id,
+            userdata=userdata,
+            protocol=protocol,
+            clean_session=kwargs.get("clean_session"),
+        )
+
+    def get_latency(self):
+        if callable(self.latency):
+            return self.latency()
+        return self.latency
+
+    # fault injection
+
+    def disconnect_client(self, client_id, rc=CONNECTION_LOST):
+        """Drops the connection of a client, which then reconnects."""
+        with self._lock:
+            session = self._sessions.get(client_id)
+            client = session.client if session else None
+
+        if client is not None:
+            client._connection_lost(rc)
+
+    def refuse_connections(self, client_id, refused=True):
+        """Refuses (or accepts again) the connections of a client id."""
+        with self._lock:
+            if refused:
+                self._refused.add(client_id)
+            else:
+                self._refused.discard(client_id)
+
+    def set_online(self, online):
+        """
+        Takes the broker offline, dropping all the connections and refusing
+        new ones, or back online.
+        """
+        with self._lock:
+            self.online = online
+            clients = [
+                session.client
+                for session in self._sessions.values()
+                if session.client is not None
+            ]
+
+        if not online:
+            for client in clients:
+                client._connection_lost(CONNECTION_LOST)
+
+    # connections
+
+    def _connect(self, client, clean):
+        with self._lock:
+            if not self.online or client.client_id in self._refused:
+                return None
+
+            session = self._sessions.get(client.client_id)
+            session_present = session is not None and not clean
+            if session is None or clean:
+                session = self._sessions[client.client_id] = _Session()
+                self._match.cache_clear()
+
+            previous = session.client
+            session.client = client
+            session.clean = clean
+            pending = list(session.pending)
+            session.pending.clear()
+            self.metrics["connections"] += 1
+
+        # a client id connected twice takes over the session
+        if previous is not None and previous is not client:
+            previous._connection_lost(CONNECTION_LOST)
+
+        for message in pending:
+            client._deliver(message)
+
+        return session_present
+
+    def _disconnect(self, client, send_will):
+        with self._lock:
+            session = self._sessions.get(client.client_id)
+            if session is None or session.client is not client:
+                return
+
+            session.client = None
+            self.metrics["disconnections"] += 1
+            if session.clean:
+                del self._sessions[client.client_id]
+                self._match.cache_clear()
+
+        if send_will and client._will is not None:
+            topic, payload, qos, retain = client._will
+            self._route(topic, payload, qos, retain, None)
+
+    def _subscribe(self, client, topic, qos):
+        with self._lock:
+            session = self._sessions.get(client.client_id)
+            if session is None:
+                return
+
+            session.subscriptions[topic] = _Subscription(
+                client.client_id, topic, qos
+            )
+            self._match.cache_clear()
+            retained = [
+                message
+                for retained_topic, message in self._retained.items()
+                if topic_matches_filter(
+                    retained_topic, session.subscriptions[topic].topic_filter
+                )
+            ]
+
+        for message in retained:
+            client._deliver(message)
+
+    def _unsubscribe(self, client, topic):
+        with self._lock:
+            session = self._sessions.get(client.client_id)
+            if session is not None and session.subscriptions.pop(topic, None):
+                self._match.cache_clear()
+
+    # routing
+
+    def _match_subscriptions(self, topic):
+        return tuple(
+            subscription
+            for session in self._sessions.values()
+            for subscription in session.subscriptions.values()
+            if topic_matches_filter(topic, subscription.topic_filter)
+        )
+
+    def _route(self, topic, payload, qos, retain, properties):
+        with self._lock:
+            self.metrics["published"] += 1
+
+            if retain:
+                if payload:
+                    self._retained[topic] = LoopbackMessage(
+                        topic, payload, qos, True, properties
+                    )
+                else:
+                    self._retained.pop(topic, None)
+
+            receivers = {}
+            groups = {}
+            for subscription in self._match(topic):
+                if subscription.group is None:
+                    receivers[subscription.client_id] = max(
+                        receivers.get(subscription.client_id, 0),
+                        subscription.qos,
+                    )
+                else:
+                    groups.setdefault(
+                        (subscription.group, subscription.topic_filter), []
+                    ).append(subscription)
+
+            # one receiver per shared subscription group, round robin
+            for group, subscriptions in groups.items():
+                counter = self._group_counters.setdefault(
+                    group, itertools.count()
+                )
+                subscription = subscriptions[
+                    next(counter) % len(subscriptions)
+                ]
+                receivers[subscription.client_id] = max(
+                    receivers.get(subscription.client_id, 0),
+                    subscription.qos,
+                )
+
+            deliveries = []
+            for client_id, subscription_qos in receivers.items():
+                session = self._sessions[client_id]
+                message = LoopbackMessage(
+                    topic,
+                    payload,
+                    min(qos, subscription_qos),
+                    False,
+                    properties,
+                )
+                if session.client is not None:
+                    deliveries.append((session.client, message))
+                elif message.qos > 0:
+                    session.pending.append(message)
+
+            if not receivers:
+                self.metrics["dropped"] += 1
+
+        for client, message in deliveries:
+            client._deliver(message)
+
+    def _requeue(self, client, message):
+        """Keeps a QoS 1/2 message lost on a dropped connection."""
+        with self._lock:
+            session = self._sessions.get(client.client_id)
+            if session is not None and not session.clean:
+                session.pending.append(message)
+                return True
+
+            self.metrics["dropped"] += 1
+            return False
+
+
+class LoopbackClient:
+    """
+    paho Client double connected to a LoopbackBroker. Only the parts of the
+    paho API used by MQTTClient are implemented.
+    """
+
+    _ids = itertools.count(1)
+
+    def __init__(
+        self,
+        broker,
+        client_id="",
+        userdata=None,
+        protocol=mqtt.MQTTv311,
+        clean_session=None,
+    ):
+        self._broker = broker
+        if not client_id:
+            # random id like paho
+            client_id = f"loopback-{next(LoopbackClient._ids)}"
+        self.client_id = client_id
+        self._client_id = client_id.encode()
+        self._userdata = userdata
+        self._protocol = protocol
+        self._clean_session = True if clean_session is None else clean_session
+        self._clean_start = True
+        self._will = None
+        self._min_delay = 1
+        self._max_delay = 120
+        self._connected = False
+        self._connecting = False
+        self._mid = itertools.count(1)
+        self._inflight = {}
+        self._topic_aliases = {}
+        self._events = []
+        self._event_sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._thread = None
+        self._running = False
+
+        self.on_connect = None
+        self.on_disconnect = None
+        self.on_message = None
+        self.on_publish = None
+        self.on_subscribe = None
+        self.on_log = None
+
+    # configuration, same signatures as paho
+
+    def user_data_set(self, userdata):
+        self._userdata = userdata
+
+    def will_set(self, topic, payload=None, qos=0, retain=False, **kwargs):
+        self._will = (topic, _encode_payload(payload), qos, retain)
+
+    def reconnect_delay_set(self, min_delay=1, max_delay=120):
+        self._min_delay = min_delay
+        self._max_delay = max_delay
+
+    def tls_set_context(self, context=None):
+        pass
+
+    def enable_logger(self, logger=None):
+        pass
+
+    # event loop
+
+    def _schedule(self, delay, callback, *args):
+        with self._condition:
+            heapq.heappush(
+                self._events,
+                (
+                    time.monotonic() + delay,
+                    next(self._event_sequence),
+                    callback,
+                    args,
+                ),
+            )
+            self._condition.notify()
+
+    def _loop(self):
+        while True:
+            with self._condition:
+                while self._running:
+                    if self._events:
+                        timeout = self._events[0][0] - time.monotonic()
+                        if timeout <= 0:
+                            break
+                    else:
+                        timeout = None
+                    self._condition.wait(timeout)
+
+                if not self._running:
+                    return
+
+                _, _, callback, args = heapq.heappop(self._events)
+
+            try:
+                callback(*args)
+            except Exception:
+                # like paho, a failing callback does not stop the loop
+                pass
+
+    def loop_start(self):
+        if self._thread is not None:
+            return mqtt.MQTT_ERR_INVAL
+
+        self._running = True
+        self._thread = threading.Thread(
+            target=self._loop, name=f"loopback_{self.client_id}", daemon=True
+        )
+        self._thread.start()
+        if self._connecting:
+            self._schedule(0, self._attempt_connection, self._min_delay)
+        return mqtt.MQTT_ERR_SUCCESS
+
+    def loop_stop(self, force=False):
+        if self._thread is None:
+            return mqtt.MQTT_ERR_INVAL
+
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+
+        if self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+        return mqtt.MQTT_ERR_SUCCESS
+
+    # connection
+
+    def connect_async(
+        self,
+        host=None,
+        port=1883,
+        keepalive=60,
+        bind_address="",
+        bind_port=0,
+        clean_start=mqtt.MQTT_CLEAN_START_FIRST_ONLY,
+        properties=None,
+    ):
+        if self._protocol == mqtt.MQTTv5:
+            self._clean_start = clean_start is not False
+        self._connecting = True
+        if self._thread is not None:
+            self._schedule(0, self._attempt_connection, self._min_delay)
+
+    def connect(self, *args, **kwargs):
+        self.connect_async(*args, **kwargs)
+        return mqtt.MQTT_ERR_SUCCESS
+
+    def reconnect(self):
+        self._connecting = True
+        self._schedule(0, self._attempt_connection, self._min_delay)
+        return mqtt.MQTT_ERR_SUCCESS
+
+    def _is_clean(self):
+        if self._protocol == mqtt.MQTTv5:
+            return self._clean_start
+        return self._clean_session
+
+    def _attempt_connection(self, delay):
+        if not self._connecting or self._connected:
+            return
+
+        session_present = self._broker._connect(self, self._is_clean())
+        if session_present is None:
+            # refused, retried with the reconnect backoff
+            self._schedule(
+                delay,
+                self._attempt_connection,
+                min(delay * 2, self._max_delay),
+            )
+            return
+
+        self._schedule(
+            self._broker.get_latency() * 2,
+            self._handle_connack,
+            session_present,
+        )
+
+    def _handle_connack(self, session_present):
+        if not self._connecting or self._connected:
+            return
+
+        self._connected = True
+        self._topic_aliases = {}
+
+        # QoS 1/2 messages not acknowledged are sent again
+        for message_info, message in list(self._inflight.values()):
+            self._send(message_info, message)
+
+        if self.on_connect is None:
+            return
+
+        flags = {"session present": int(session_present)}
+        if self._protocol == mqtt.MQTTv5:
+            properties = Properties(PacketTypes.CONNACK)
+            if self._broker.topic_alias_maximum:
+                properties.TopicAliasMaximum = self._broker.topic_alias_maximum
+            self.on_connect(
+                self, self._userdata, flags, mqtt.ReasonCodes(2), properties
+            )
+        else:
+            self.on_connect(self, self._userdata, flags, 0)
+
+    def _call_on_disconnect(self, rc):
+        if self.on_disconnect is None:
+            return
+
+        if self._protocol == mqtt.MQTTv5:
+            self.on_disconnect(self, self._userdata, rc, None)
+        else:
+            self.on_disconnect(self, self._userdata, rc)
+
+    def _connection_lost(self, rc):
+        if not self._connected:
+            return
+
+        self._connected = False
+        self._broker._disconnect(self, send_will=True)
+        self._schedule(0, self._call_on_disconnect, rc)
+        self._schedule(
+            self._min_delay, self._attempt_connection, self._min_delay
+        )
+
+    def disconnect(self, reasoncode=None, properties=None):
+        self._connecting = False
+        if not self._connected:
+            return mqtt.MQTT_ERR_NO_CONN
+
+        self._connected = False
+        self._broker._disconnect(self, send_will=False)
+        self._schedule(0, self._call_on_disconnect, mqtt.MQTT_ERR_SUCCESS)
+        return mqtt.MQTT_ERR_SUCCESS
+
+    def is_connected(self):
+        return self._connected
+
+    # subscriptions
+
+    def subscribe(self, topic, qos=0, options=None, properties=None):
+        if isinstance(topic, tuple):
+            topic, qos = topic[0], topic[1]
+        topics = topic if isinstance(topic, list) else [(topic, qos)]
+
+        if not self._connected:
+            return mqtt.MQTT_ERR_NO_CONN, None
+
+        mid = next(self._mid)
+        for topic_filter, topic_qos in topics:
+            self._broker._subscribe(
+                self, topic_filter, getattr(topic_qos, "QoS", topic_qos)
+            )
+        return mqtt.MQTT_ERR_SUCCESS, mid
+
+    def unsubscribe(self, topic, properties=None):
+        if not self._connected:
+            return mqtt.MQTT_ERR_NO_CONN, None
+
+        for topic_filter in topic if isinstance(topic, list) else [topic]:
+            self._broker._unsubscribe(self, topic_filter)
+        return mqtt.MQTT_ERR_SUCCESS, next(self._mid)
+
+    # publish
+
+    def publish(
+        self, topic, payload=None, qos=0, retain=False, properties=None
+    ):
+        message_info = LoopbackMessageInfo(next(self._mid))
+
+        if not self._connected:
+            message_info.rc = mqtt.MQTT_ERR_NO_CONN
+            return message_info
+
+        topic_alias = getattr(properties, "TopicAlias", None)
+        if topic_alias is not None:
+            if topic:
+                self._topic_aliases[topic_alias] = topic
+            else:
+                topic = self._topic_aliases[topic_alias]
+
+        message = (topic, _encode_payload(payload), qos, retain, properties)
+        if qos > 0:
+            self._inflight[message_info.mid] = (message_info, message)
+        else:
+            message_info._set_as_published()
+
+        self._send(message_info, message)
+        return message_info
+
+    def _send(self, message_info, message):
+        self._schedule(
+            self._broker.get_latency(), self._arrive, message_info, message
+        )
+
+    def _arrive(self, message_info, message):
+        if not self._connected:
+            # lost with the connection, QoS 1/2 are sent again on reconnect
+            return
+
+        self._broker._route(*message)
+        if message[2] > 0:
+            self._schedule(
+                self._broker.get_latency(), self._handle_ack, message_info
+            )
+        elif self.on_publish is not None:
+            self.on_publish(self, self._userdata, message_info.mid)
+
+    def _handle_ack(self, message_info):
+        if self._inflight.pop(message_info.mid, None) is None:
+            return
+
+        message_info._set_as_published()
+        if self.on_publish is not None:
+            self.on_publish(self, self._userdata, message_info.mid)
+
+    # delivery
+
+    def _deliver(self, message):
+        self._schedule(
+            self._broker.get_latency(), self._handle_message, message
+        )
+
+    def _handle_message(self, message):
+        if not self._connected:
+            if message.qos > 0:
+                self._broker._requeue(self, message)
+            return
+
+        with self._broker._lock:
+            self._broker.metrics["delivered"] += 1
+
+        if self.on_message is not None:
+            self.on_message(self, self._userdata, message)
@@ -12,19 +12,19 @@ Description:
     always require a mqtt connection.
 """
 
-import paho.mqtt.publish as publish_single
 import paho.mqtt.client as mqtt
-import ssl
+from paho.mqtt.properties import Properties
+from paho.mqtt.packettypes import PacketTypes
 import time
-from retry import retry
 import threading
-from queue import Queue
+from queue import Empty, Queue
 import json
-from unittest.mock import Mock
+import zlib
 from mqtt_flow.core.mqtt_callbacks.on_log import OnLogCallback
 
 from mqtt_flow.utils.helpers import get_logger
-from mqtt_flow.peristence import MockPersistence
+from mqtt_flow.peristence.mock_persistence import MockPersistence
+from mqtt_flow.utils.payload import SpilledPayload
 
 
 class MQTTClient:
@@ -74,6 +74,33 @@ class MQTTClient:
             Default : 60
         started(bool): Indicates whether mqtt client connection has been
             initiated or not
+        connection_client_ids (list of str): Client ids of the broker
+            connections opened by this client. The first one is the
+            primary connection which owns the subscriptions, publishes are
+            spread across all of them by topic hash so that per-topic
+            ordering is kept. Defaults to a single connection.
+        protocol (int): MQTT protocol version, 3 for v3.1.1 or 5 for v5.
+            Defaults to 3.
+        mqtt5_config (dict): MQTT v5 only settings.
+            Example:
+                {
+                    "session_expiry_interval": 0,
+                    "receive_maximum": 100,
+                    "topic_alias_maximum": 20,
+                    "message_expiry_interval": 300,
+                    "user_properties": {"site": "site1"}
+                }
+            receive_maximum limits the QoS 1/2 messages the broker sends
+            before they are acknowledged, topic_alias_maximum is the number
+            of topic aliases used for outgoing QoS 0 messages (bounded by
+            the broker's own maximum), message_expiry_interval and
+            user_properties are the defaults added to every publish.
+        client_factory (callable): Creates the raw client of each
+            connection, called as
+            `client_factory(client_id=..., userdata=..., protocol=...,
+            clean_session=...)` (clean_session only for v3) and returning a
+            paho `Client` compatible object. Defaults to paho, see
+            `mqtt_flow.mqtt_lib.loopback` for an in-process broker.
     """
 
     def __init__(
@@ -92,12 +119,16 @@ class MQTTClient:
         clean_session=True,
         ssl_config=None,
         userdata=None,
-        on_connect=Mock(),
-        on_message=Mock(),
-        on_disconnect=Mock(),
+        on_connect=None,
+        on_message=None,
+        on_disconnect=None,
         exit_on_reconnect=False,
         on_log_callback_enable=False,
         persistence=None,
+        connection_client_ids=None,
+        protocol=3,
+        mqtt5_config=None,
+        client_factory=None,
     ):
         """
         Sets up the parameters required to setup the mqtt client. It
@@ -156,11 +187,18 @@ class MQTTClient:
         self.clean_session = clean_session
         self.batches = {}
         self.queue = Queue(maxsize=self.queue_size)
+        self._queue_lock = threading.Lock()
         self._batch_lock = threading.Lock()
         self.persistence = persistence if persistence else MockPersistence()
         self.on_log_callback_enable = on_log_callback_enable
         self.started = False
         self.exit_on_reconnect = exit_on_reconnect
+        self.connection_client_ids = connection_client_ids or [client_id]
+        self._publish_clients = []
+        self.protocol = protocol
+        self.mqtt5_config = mqtt5_config or {}
+        self._ready = threading.Event()
+        self.client_factory = client_factory or self._paho_client_factory
         self.log.info(
             f"Initialising client with name: {client_name} id : {client_id} on {server}:{port} with keepalive={keep_alive} and clean session={clean_session}"
         )
@@ -175,8 +213,15 @@ class MQTTClient:
 
     def _publish_queue(self):
         """Publishes all pending items from the queue."""
-        current_queue_size = self.queue.qsize()
-        messages = [self.queue.get() for _ in range(current_queue_size)]
+        # drained without blocking, concurrent drains (interval thread,
+        # full queue, replay lanes) each take what is left
+        messages = []
+        with self._queue_lock:
+            while True:
+                try:
+                    messages.append(self.queue.get_nowait())
+                except Empty:
+                    break
         for topic, payload in messages:
             self.publish(topic, payload)
 
@@ -189,39 +234,49 @@ class MQTTClient:
                     self.batches[topic] = []
 
     def start(self):
-        """Starts the MQTT client connection and background tasks."""
+        """
+        Starts the MQTT client connection and background tasks without
+        waiting for the connection, see `wait_ready`.
+        """
         self.started = True
-        threading.Thread(target=self._mqtt_worker).start()
-        time.sleep(1)  # Wait for the connection to establish
+        self._mqtt_worker()
         threading.Thread(target=self._publish_after_interval).start()
         self.persistence.start(self)
 
+    @property
+    def is_ready(self):
+        """True once the primary connection is established."""
+        return self._ready.is_set()
+
+    def wait_ready(self, timeout=None):
+        """
+        Blocks until the primary connection is established and the
+        on_connect callback (subscriptions) has run.
+
+        Args:
+            timeout (float): Maximum seconds to wait, forever if None.
+
+        Returns:
+            bool: True if the client is connected, False on timeout.
+        """
+        return self._ready.wait(timeout)
+
     def stop(self):
         """Stops the MQTT client and finalizes publishing."""
         if hasattr(self, "client"):
             self._publish_batches()
             self._publish_queue()
             self.log.info("Disconnecting MQTT client")
-            self.client.disconnect()
-            self.client.loop_stop()
+            for client in self._publish_clients:
+                client.disconnect()
+                client.loop_stop()
             self.started = False
-
-    @retry(
-        exceptions=(ConnectionRefusedError, OSError),
-        delay=1,
-        max_delay=8,
-        backoff=2,
-    )
-    def _retry_connection(self):
-        """Retries MQTT connection with exponential backoff."""
-        if self.started:
-            self.log.info(
-                f"Retrying MQTT connection to {self.server}:{self.port}"
-            )
-            self.client.reconnect()
+            self.persistence.flush()
 
     def _prepare_ssl_context(self, alpn_protocol, ca, cert, key):
         """Sets up SSL context with ALPN for AWS IoT connection."""
+        import ssl
+
         ssl_context = ssl.create_default_context()
         if alpn_protocol:
             ssl_context.set_alpn_protocols([alpn_protocol])
@@ -233,15 +288,35 @@ class MQTTClient:
             ssl_context.load_cert_chain(certfile=cert, keyfile=key)
         return ssl_context
 
-    def _mqtt_worker(self):
-        """Configures and starts the MQTT client."""
-        self.client = mqtt.Client(
-            client_id=self.client_id,
-            userdata=self.userdata,
-            clean_session=self.clean_session,
-        )
-        self.client.first_time_connected = False
-        self.client.exit_on_reconnect = self.exit_on_reconnect
+    @staticmethod
+    def _paho_client_factory(**kwargs):
+        """Default client factory, creates paho clients."""
+        return mqtt.Client(**kwargs)
+
+    def _create_client(self, client_id, primary=True):
+        """
+        Creates a raw mqtt client. Only the primary client gets the on_connect
+        callback (subscriptions) and the will message.
+        """
+        if self.protocol == 5:
+            client = self.client_factory(
+                client_id=client_id,
+                userdata=self.userdata,
+                protocol=mqtt.MQTTv5,
+            )
+        else:
+            client = self.client_factory(
+                client_id=client_id,
+                userdata=self.userdata,
+                protocol=mqtt.MQTTv311,
+                clean_session=self.clean_session,
+            )
+        client.primary = primary
+        client.topic_aliases = {}
+        client.topic_alias_maximum = 0
+        client.topic_alias_lock = threading.Lock()
+        client.first_time_connected = False
+        client.exit_on_reconnect = self.exit_on_reconnect
         if self.ssl_config:
             ssl_context = self._prepare_ssl_context(
                 self.ssl_config.get("alpn_protocol"),
@@ -249,23 +324,148 @@ class MQTTClient:
                 self.ssl_config.get("cert"),
                 self.ssl_config.get("key"),
             )
-            self.client.tls_set_context(context=ssl_context)
-        if self.will_topic and self.will_payload:
-            self.client.will_set(self.will_topic, self.will_payload)
-        self.client.reconnect_delay_set(
+            client.tls_set_context(context=ssl_context)
+        if primary and self.will_topic and self.will_payload:
+            client.will_set(self.will_topic, self.will_payload)
+        client.reconnect_delay_set(
             min_delay=1, max_delay=self.max_reconnect_delay
         )
-        self.client.on_connect = self.on_connect
-        self.client.on_message = self.on_message
-        self.client.on_disconnect = self.on_disconnect
+        client.on_connect = self._handle_connect
+        if primary:
+            client.on_message = self.on_message
+        client.on_disconnect = self._handle_disconnect
         if self.on_log_callback_enable:
             on_log = OnLogCallback.get_callback()
-            self.client.on_log = on_log
-        try:
-            self.client.connect(self.server, self.port, self.keepalive)
-        except (ConnectionRefusedError, OSError):
-            self._retry_connection()
-        self.client.loop_start()
+            client.on_log = on_log
+        return client
+
+    def _connect_kwargs(self):
+        """Returns the MQTT v5 only arguments of connect."""
+        if self.protocol != 5:
+            return {}
+
+        properties = Properties(PacketTypes.CONNECT)
+        properties.SessionExpiryInterval = self.mqtt5_config.get(
+            "session_expiry_interval", 0
+        )
+        if self.mqtt5_config.get("receive_maximum"):
+            properties.ReceiveMaximum = self.mqtt5_config["receive_maximum"]
+
+        return {"clean_start": self.clean_session, "properties": properties}
+
+    def _handle_connect(self, client, userdata, flags, rc, properties=None):
+        """
+        Resets the per connection state (topic aliases) and calls the
+        on_connect callback for the primary connection.
+        """
+        with client.topic_alias_lock:
+            client.topic_aliases = {}
+            client.topic_alias_maximum = min(
+                self.mqtt5_config.get("topic_alias_maximum", 0),
+                getattr(properties, "TopicAliasMaximum", 0),
+            )
+
+        if not client.primary:
+            return
+
+        if self.on_connect:
+            if self.protocol == 5:
+                self.on_connect(client, userdata, flags, rc, properties)
+            else:
+                self.on_connect(client, userdata, flags, rc)
+
+        if rc == 0:
+            self._ready.set()
+
+    def _handle_disconnect(self, client, userdata, rc, properties=None):
+        """Clears the readiness of the primary connection."""
+        if client.primary:
+            self._ready.clear()
+
+        if self.on_disconnect:
+            if self.protocol == 5:
+                self.on_disconnect(client, userdata, rc, properties)
+            else:
+                self.on_disconnect(client, userdata, rc)
+
+    def _publish_properties(
+        self,
+        publish_client,
+        topic,
+        qos,
+        user_properties=None,
+        message_expiry_interval=None,
+        response_topic=None,
+        correlation_data=None,
+    ):
+        """
+        Builds the MQTT v5 publish properties and returns the topic to send,
+        which is empty when an already registered topic alias is used.
+        Aliases are only used for QoS 0 messages as those are never
+        retransmitted on a new connection.
+
+        Called with the `topic_alias_lock` of the connection held until the
+        message is queued, so that no message uses an alias before the one
+        registering it.
+        """
+        properties = Properties(PacketTypes.PUBLISH)
+
+        if message_expiry_interval is None:
+            message_expiry_interval = self.mqtt5_config.get(
+                "message_expiry_interval"
+            )
+        if message_expiry_interval:
+            properties.MessageExpiryInterval = message_expiry_interval
+        if response_topic is not None:
+            properties.ResponseTopic = response_topic
+        if correlation_data is not None:
+            properties.CorrelationData = correlation_data
+
+        all_user_properties = {
+            **self.mqtt5_config.get("user_properties", {}),
+            **(user_properties or {}),
+        }
+        if all_user_properties:
+            properties.UserProperty = [
+                (str(key), str(value))
+                for key, value in all_user_properties.items()
+            ]
+
+        if qos == 0 and publish_client.topic_alias_maximum:
+            topic_alias = publish_client.topic_aliases.get(topic)
+            if topic_alias is not None:
+                properties.TopicAlias = topic_alias
+                return "", properties
+
+            topic_alias = len(publish_client.topic_aliases) + 1
+            if topic_alias <= publish_client.topic_alias_maximum:
+                publish_client.topic_aliases[topic] = topic_alias
+                properties.TopicAlias = topic_alias
+
+        return topic, properties
+
+    def _mqtt_worker(self):
+        """
+        Configures the MQTT connections and starts their network loops.
+        Connections are established in the loops, which retry with the
+        reconnect delay backoff until the broker is reachable.
+        """
+        client = self._create_client(self.connection_client_ids[0])
+        self._publish_clients = [client] + [
+            self._create_client(client_id, primary=False)
+            for client_id in self.connection_client_ids[1:]
+        ]
+        # exposed last, publishes check `client` before using the list
+        self.client = client
+
+        for client in self._publish_clients:
+            client.connect_async(
+                self.server,
+                self.port,
+                self.keepalive,
+                **self._connect_kwargs(),
+            )
+            client.loop_start()
 
     def subscribe_topics(self, topics):
         """
@@ -284,36 +484,93 @@ class MQTTClient:
         for topic in topics:
             self.client.subscribe(topic)
 
-    def publish(self, topic, payload, persist=False, qos=0):
+    def _get_publish_client(self, topic):
+        """
+        Returns the connection used to publish on the given topic. A topic
+        is always published through the same connection to keep ordering.
+        """
+        if len(self._publish_clients) <= 1:
+            return self.client
+
+        return self._publish_clients[
+            zlib.crc32(topic.encode()) % len(self._publish_clients)
+        ]
+
+    def publish(
+        self,
+        topic,
+        payload,
+        persist=False,
+        qos=0,
+        user_properties=None,
+        message_expiry_interval=None,
+        response_topic=None,
+        correlation_data=None,
+    ):
         """
         Publishes a message immediately to the specified topic.
 
         Args:
             topic (str): Topic where the message will be published.
-            payload (str, int, float): Payload of the message.
+            payload (str, int, float, bytes): Payload of the message.
+            user_properties (dict): MQTT v5 user properties of the message.
+            message_expiry_interval (int): MQTT v5 message expiry in
+                seconds, overrides the client default.
+            response_topic (str): MQTT v5 response topic of a request.
+            correlation_data (bytes): MQTT v5 correlation data of a request
+                or of its reply.
         """
         if isinstance(payload, dict) or isinstance(payload, list):
             payload = json.dumps(payload)
+        elif isinstance(payload, (memoryview, SpilledPayload)):
+            # paho only sends bytes, the one copy of a binary relay
+            payload = bytes(payload)
 
         if not hasattr(self, "client"):
             self.log.warning("MQTT client not initialized.")
             return None
 
-        if self.persistence and persist and not self.is_connected():
+        publish_client = self._get_publish_client(topic)
+        connected = publish_client.is_connected()
+
+        if self.persistence and persist and not connected:
             self.persistence.append_to_batch(
                 {"topic": topic, "payload": payload}
             )
             return None
 
-        if self.is_connected():
+        if connected:
             try:
                 self.log.debug(
-                    f"Outgoing Message from {self.client_name}: {topic} -> {payload}"
+                    "Outgoing Message from %s: %s -> %s",
+                    self.client_name,
+                    topic,
+                    payload,
                 )
-                message_info = self.client.publish(topic, payload, qos=qos)
+                if self.protocol == 5:
+                    with publish_client.topic_alias_lock:
+                        publish_topic, properties = self._publish_properties(
+                            publish_client,
+                            topic,
+                            qos,
+                            user_properties,
+                            message_expiry_interval,
+                            response_topic,
+                            correlation_data,
+                        )
+                        message_info = publish_client.publish(
+                            publish_topic,
+                            payload,
+                            qos=qos,
+                            properties=properties,
+                        )
+                else:
+                    message_info = publish_client.publish(
+                        topic, payload, qos=qos
+                    )
                 return message_info
             except OSError as e:
-                self.log.warning(f"Failed to publish message: {e}")
+                self.log.warning("Failed to publish message: %s", e)
                 return None
         else:
             return None
@@ -323,8 +580,10 @@ class MQTTClient:
             topic = data_point["topic"]
             payload = data_point["payload"]
             if self.is_connected():
-                self.log.info(
-                    f"Uploading message from persisted batch to {topic} -> {payload}"
+                self.log.debug(
+                    "Uploading message from persisted batch to %s -> %s",
+                    topic,
+                    payload,
                 )
                 self.qpublish(topic, payload)
             else:
@@ -370,8 +629,9 @@ class MQTTClient:
 
     def publish_high_priority(self, topic, payload, hostname=None, port=None):
         """
-        Publishes a high-priority message without using the persistent client.
-        This can be used for immediate, one-off messages.
+        Publishes a high-priority message immediately. The persistent
+        connection is used when it is connected to the same broker, otherwise
+        a one-off connection is made (e.g. client not started).
 
         Args:
             topic (str): Topic for the message.
@@ -382,6 +642,12 @@ class MQTTClient:
         hostname = hostname or self.server
         port = port or self.port
 
+        same_broker = hostname == self.server and port == self.port
+        if same_broker and self.is_connected():
+            return self.publish(topic, payload)
+
+        import paho.mqtt.publish as publish_single
+
         try:
             message_info = publish_single.single(
                 topic, payload, hostname=hostname, port=port, keepalive=2
@@ -391,14 +657,20 @@ class MQTTClient:
             self.log.warning(f"Failed to publish high-priority message: {e}")
             return None
 
-    def is_connected(self):
+    def is_connected(self, topic=None):
         """
         Checks if the MQTT client is currently connected to the broker.
 
+        Args:
+            topic (str): Checks the connection publishing this topic rather
+                than the primary connection.
+
         Returns:
             bool: True if the client is connected, False otherwise.
         """
         if hasattr(self, "client"):
+            if topic is not None:
+                return self._get_publish_client(topic).is_connected()
             return self.client.is_connected()
         else:
             return False
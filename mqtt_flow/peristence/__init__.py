@@ -1,2 +1,23 @@
-from .persistence import Persistence, MockPersistence, PersistenceQueueError
-from .mqtt_persistence import MQTTPersistence
\ No newline at end of file
+import importlib
+
+# persistqueue (and sqlite3) is imported on first access only
+_LAZY_ATTRIBUTES = {
+    "Persistence": ".persistence",
+    "PersistenceQueueError": ".persistence",
+    "UploadError": ".persistence",
+    "MQTTPersistence": ".mqtt_persistence",
+    "MockPersistence": ".mock_persistence",
+}
+
+__all__ = list(_LAZY_ATTRIBUTES)
+
+
+def __getattr__(name):
+    if name not in _LAZY_ATTRIBUTES:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    value = getattr(
+        importlib.import_module(_LAZY_ATTRIBUTES[name], __name__), name
+    )
+    globals()[name] = value
+    return value
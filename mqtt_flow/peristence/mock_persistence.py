@@ -0,0 +1,20 @@
+class MockPersistence:
+    """
+    No-op persistence of the clients without persistence. Kept apart from
+    persistence.py so that persistqueue is only imported when configured.
+    """
+
+    def append_to_batch(self, data_point):
+        pass
+
+    def put_batch(self, batch):
+        pass
+
+    def put_many(self, data_points):
+        pass
+
+    def flush(self, timeout=None):
+        return True
+
+    def start(self, uploader):
+        pass
@@ -1,29 +1,49 @@
 from mqtt_flow.peristence import Persistence
-from mqtt_flow.utils.helpers import match_topic, format_topic
-import re
+from mqtt_flow.utils.helpers import compile_topic_formatters
+from mqtt_flow.utils.topic_index import TopicIndex
+import functools
+import time
 from mqtt_flow.utils.helpers import get_logger
 
 
 class MQTTPersistence(Persistence):
+    DEFAULT_REUPLOAD_TOPIC_CACHE_SIZE = 4096
 
     def __init__(self, config):
         super().__init__(config)
         self._rules = config.get("rules", [])
-        self.logger = get_logger("mqtt_persistence")
-
-    def apply_rule(self, topic):
+        self._rules_index = TopicIndex()
         for rule in self._rules:
-            topic_regex = rule.get("regex")
-            filter_topic = rule.get("topic")
-            reupload_topic_formatters = rule.get(
-                "reupload_topic_formatters", []
+            self._rules_index.add(
+                (
+                    compile_topic_formatters(
+                        rule.get("reupload_topic_formatters", [])
+                    ),
+                    rule.get("ttl"),
+                ),
+                topic=rule.get("topic"),
+                regex=rule.get("regex"),
+            )
+        self._reupload_topic = functools.lru_cache(
+            maxsize=config.get(
+                "reupload_topic_cache_size",
+                self.DEFAULT_REUPLOAD_TOPIC_CACHE_SIZE,
             )
+        )(self._resolve_reupload_topic)
+        self.logger = get_logger("mqtt_persistence")
+
+    def _resolve_reupload_topic(self, topic):
+        """Returns the reupload topic and the ttl of the topic."""
+        rule = self._rules_index.first(topic)
 
-            if match_topic(topic, topic_regex, filter_topic):
-                reupload_topic = format_topic(topic, reupload_topic_formatters)
-                return reupload_topic
+        if rule is None:
+            return None, None
 
-        return None
+        format_reupload_topic, ttl = rule
+        return format_reupload_topic(topic), ttl
+
+    def apply_rule(self, topic):
+        return self._reupload_topic(topic)[0]
 
     def format_payload(self, payload):
         return payload
@@ -32,7 +52,7 @@ class MQTTPersistence(Persistence):
         topic = data_point["topic"]
         payload = data_point["payload"]
 
-        reupload_topic = self.apply_rule(topic)
+        reupload_topic, ttl = self._reupload_topic(topic)
 
         if reupload_topic:
             reupload_payload = self.format_payload(payload)
@@ -40,8 +60,11 @@ class MQTTPersistence(Persistence):
                 "topic": reupload_topic,
                 "payload": reupload_payload,
             }
-            self.logger.info(
-                f"Adding message to persistence : {reupload_data_point['topic']}"
+            if ttl:
+                # expired data points are skipped when replayed
+                reupload_data_point["expires_at"] = time.time() + ttl
+            self.logger.debug(
+                "Adding message to persistence : %s", reupload_topic
             )
 
             super().append_to_batch(reupload_data_point)
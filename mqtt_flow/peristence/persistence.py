@@ -1,9 +1,28 @@
 import persistqueue
 from retry import retry
+from collections import deque
 import threading
 import time
 import json
+import math
 from mqtt_flow.utils.helpers import get_logger
+from mqtt_flow.peristence.mock_persistence import MockPersistence
+from mqtt_flow.utils.payload import encode_binary
+from mqtt_flow.utils.payload import decode_binary
+
+# private persistqueue internals used by the bulk writes, the claimed
+# reads and the retention, checked on open as they are not a public API
+_PQUEUE_INTERNALS = (
+    "_table_name",
+    "_key_column",
+    "_putter",
+    "_getter",
+    "_sql_insert",
+    "_serializer",
+    "tran_lock",
+    "total",
+    "put_event",
+)
 
 
 class UploadError(Exception):
@@ -14,18 +33,6 @@ class PersistenceQueueError(Exception):
     pass
 
 
-class MockPersistence:
-
-    def append_to_batch(self, data_point):
-        pass
-
-    def put_batch(self, batch):
-        pass
-
-    def start(self, uploader):
-        pass
-
-
 class Persistence:
     DEFAULT_UPLOAD_INTERVAL = 5
     DEFAULT_INIT_RETRY_CONFIG = {
@@ -43,6 +50,15 @@ class Persistence:
     }
     DEFAULT_BATCH_SIZE = 10
     DEFAULT_BATCH_UPLOAD_MIN_DELAY = 60
+    DEFAULT_WRITE_QUEUE_SIZE = 10000
+    DEFAULT_GROUP_COMMIT_MAX_BATCHES = 100
+    DEFAULT_GROUP_COMMIT_DELAY = 0
+    DEFAULT_REPLAY_LANES = 1
+    DEFAULT_REPLAY_RECENT_LANES = 0
+    DEFAULT_REPLAY_RETRIES = 5
+    QUARANTINE_QUEUE_NAME = "quarantine"
+    SPILL_QUEUE_NAME = "spill"
+    DEFAULT_RETENTION_CHECK_INTERVAL = 10
 
     def __init__(self, config):
         self.logger = get_logger("persistence")
@@ -58,10 +74,47 @@ class Persistence:
         self.upload_interval = config.get(
             "upload_interval", self.DEFAULT_UPLOAD_INTERVAL
         )
+        self.write_queue_size = config.get(
+            "write_queue_size", self.DEFAULT_WRITE_QUEUE_SIZE
+        )
+        self.group_commit_max_batches = config.get(
+            "group_commit_max_batches", self.DEFAULT_GROUP_COMMIT_MAX_BATCHES
+        )
+        self.group_commit_delay = config.get(
+            "group_commit_delay", self.DEFAULT_GROUP_COMMIT_DELAY
+        )
+        self.replay_lanes = config.get(
+            "replay_lanes", self.DEFAULT_REPLAY_LANES
+        )
+        self.replay_recent_lanes = config.get(
+            "replay_recent_lanes", self.DEFAULT_REPLAY_RECENT_LANES
+        )
+        self.replay_retries = config.get(
+            "replay_retries", self.DEFAULT_REPLAY_RETRIES
+        )
+        self.retention = config.get("retention") or {}
+        self.retention_check_interval = self.retention.get(
+            "check_interval", self.DEFAULT_RETENTION_CHECK_INTERVAL
+        )
         self.batch = []
         self._batch_lock = threading.Lock()
+        self._pending_batches = deque()
+        self._pending_condition = threading.Condition()
+        self._writing = False
+        self.write_metrics = {"batches": 0, "transactions": 0, "dropped": 0}
+        self.replay_metrics = {"uploaded": 0, "failed": 0, "quarantined": 0}
+        self.retention_metrics = {
+            "max_age": 0,
+            "max_messages": 0,
+            "max_bytes": 0,
+            "expired": 0,
+        }
+        self._next_retention_check = 0
+        self._replay_lock = threading.Lock()
         self._main_pqueue = None
         self._backup_pqueue = None
+        self._quarantine_pqueue = None
+        self._spill_pqueue = None
 
         try:
             self._main_pqueue = self._create_persistence_queue(self.main_path)
@@ -69,26 +122,85 @@ class Persistence:
             self.logger.warning(
                 f"Failed to create main persistence queue in {self.main_path}"
             )
-            if self.backup_path:
-                try:
-                    self._backup_pqueue = self._create_persistence_queue(
-                        self.backup_path
-                    )
-                except:
-                    self.logger.warning(
-                        f"Failed to create backup persistence queue in {self.backup_path}"
-                    )
+
+        # also opened when the main queue works, so that batches left in the
+        # backup queue by a previous failure are replayed
+        if self.backup_path:
+            try:
+                self._backup_pqueue = self._create_persistence_queue(
+                    self.backup_path
+                )
+            except:
+                self.logger.warning(
+                    f"Failed to create backup persistence queue in {self.backup_path}"
+                )
 
         if self._main_pqueue is None and self._backup_pqueue is None:
             raise PersistenceQueueError("Failed to create persistence queue")
 
+        try:
+            # next to the main queue when it exists, an empty queue is falsy
+            self._quarantine_pqueue = self._create_persistence_queue(
+                (
+                    self.main_path
+                    if self._main_pqueue is not None
+                    else self.backup_path
+                ),
+                self.QUARANTINE_QUEUE_NAME,
+            )
+        except:
+            self.logger.warning(
+                f"Failed to create quarantine persistence queue for {self.name}"
+            )
+
+        try:
+            self._spill_pqueue = self._create_persistence_queue(
+                (
+                    self.main_path
+                    if self._main_pqueue is not None
+                    else self.backup_path
+                ),
+                self.SPILL_QUEUE_NAME,
+            )
+        except:
+            self.logger.warning(
+                f"Failed to create spill persistence queue for {self.name}"
+            )
+
+        self._claimed_rows = {
+            id(pqueue): set()
+            for pqueue in (self._main_pqueue, self._backup_pqueue)
+            if pqueue is not None
+        }
+        # bytes of the rows per queue, for max_bytes, counted on the first
+        # check then updated on every insert and delete
+        self._stored_bytes = {}
+
+        threading.Thread(
+            target=self._write_pending_batches, daemon=True
+        ).start()
+
     @retry(exceptions=(Exception,), **DEFAULT_INIT_RETRY_CONFIG)
-    def _create_persistence_queue(self, path):
-        return persistqueue.FIFOSQLiteQueue(
+    def _create_persistence_queue(self, path, name="default"):
+        pqueue = persistqueue.FIFOSQLiteQueue(
             path=path,
+            name=name,
             auto_commit=False,
             multithreading=True,
         )
+        missing = [
+            attr for attr in _PQUEUE_INTERNALS if not hasattr(pqueue, attr)
+        ]
+        if missing:
+            self.logger.error(
+                "Unsupported persistqueue version, missing %s",
+                ", ".join(missing),
+            )
+            raise PersistenceQueueError(
+                f"Unsupported persistqueue version, missing {missing}"
+            )
+
+        return pqueue
 
     def get_main_pqueue_size(self):
         if self._main_pqueue is None:
@@ -104,31 +216,149 @@ class Persistence:
 
     def put_batch(self):
         """
-        Puts the given batch into the given persist queue to be uploaded later.
+        Puts the current batch into the persist queue to be uploaded later,
+        through the writer thread.
+        """
+        self._put(self.batch.copy())
+        self.batch = []
+
+    def put_many(self, data_points):
+        """
+        Stores data points as they are, in batches of batch_size, without
+        going through the current batch (e.g. an outage buffer spilled in
+        bulk).
 
         Args:
-            batch(list): list of data points.
+            data_points (list): list of data points, oldest first.
         """
-        batch = self.batch.copy()
+        for start in range(0, len(data_points), self.batch_size):
+            self._put(data_points[start : start + self.batch_size])
 
+    def _put(self, batch):
+        """
+        Queues a batch for the writer thread, producers never wait for the
+        disk. The oldest pending batch is dropped when write_queue_size
+        batches are already waiting.
+        """
         if isinstance(batch, list) or isinstance(batch, dict):
-            batch = json.dumps(batch)
+            # binary payloads are stored as base64
+            batch = json.dumps(batch, default=encode_binary)
+
+        with self._pending_condition:
+            if len(self._pending_batches) >= self.write_queue_size:
+                self._pending_batches.popleft()
+                self.write_metrics["dropped"] += 1
+                self.logger.warning(
+                    "Persistence write queue of %s full, oldest batch dropped",
+                    self.name,
+                )
+            self._pending_batches.append(batch)
+            self._pending_condition.notify_all()
 
+    def _take_pending_batches(self):
+        """
+        Waits for pending batches, at most retention check_interval seconds
+        when a retention is configured.
+        """
+        with self._pending_condition:
+            if not self._pending_batches:
+                self._pending_condition.wait(
+                    self.retention_check_interval if self.retention else None
+                )
+            if not self._pending_batches:
+                return []
+
+        if self.group_commit_delay:
+            # lets more batches in, to commit them together
+            time.sleep(self.group_commit_delay)
+
+        with self._pending_condition:
+            batches = []
+            while (
+                self._pending_batches
+                and len(batches) < self.group_commit_max_batches
+            ):
+                batches.append(self._pending_batches.popleft())
+            self._writing = True
+        return batches
+
+    def _write_pending_batches(self):
+        """
+        Writer thread, writes the pending batches to the persist queue in
+        group commits of up to group_commit_max_batches batches, and
+        enforces the retention.
+        """
+        while True:
+            batches = self._take_pending_batches()
+            try:
+                if batches:
+                    self._write_batches(batches)
+                self._enforce_retention()
+            finally:
+                with self._pending_condition:
+                    self._writing = False
+                    self._pending_condition.notify_all()
+
+    def _write_batches(self, batches):
         try:
-            self._main_pqueue.put_nowait(batch)
+            self._insert_batches(self._main_pqueue, batches)
         except Exception:
             self.logger.warning(
                 "Failed to put batch in main persist queue", exc_info=True
             )
             try:
-                self._backup_pqueue.put_nowait(batch)
+                self._insert_batches(self._backup_pqueue, batches)
             except Exception:
                 self.logger.warning(
                     "Failed to put batch in backup persist queue",
                     exc_info=True,
                 )
+                return
 
-        self.batch = []
+        self.write_metrics["batches"] += len(batches)
+        self.write_metrics["transactions"] += 1
+
+    def _insert_batches(self, pqueue, batches):
+        """
+        Inserts the batches in a single transaction, put_nowait commits (and
+        syncs) each batch on its own.
+        """
+        now = time.time()
+        rows = [(pqueue._serializer.dumps(batch), now) for batch in batches]
+        with pqueue.tran_lock:
+            with pqueue._putter as connection:
+                connection.executemany(pqueue._sql_insert, rows)
+            pqueue.total += len(rows)
+            if id(pqueue) in self._stored_bytes:
+                self._stored_bytes[id(pqueue)] += sum(
+                    len(row[0]) for row in rows
+                )
+        pqueue.put_event.set()
+
+    @staticmethod
+    def _fetch_one(pqueue, sql, params=()):
+        """
+        Runs a query on the reader connection, under the transaction lock
+        as it is the writer connection without multithreading.
+        """
+        with pqueue.tran_lock:
+            return pqueue._getter.execute(sql, params).fetchone()
+
+    def flush(self, timeout=None):
+        """
+        Waits until the pending batches are written.
+
+        Args:
+            timeout (float): Maximum seconds to wait, forever if None.
+
+        Returns:
+            bool: True if all the batches are written, False on timeout.
+        """
+        with self._pending_condition:
+            return self._pending_condition.wait_for(
+                lambda: not self._pending_batches and not self._writing,
+                timeout,
+            )
 
     def append_to_batch(self, data_point):
         with self._batch_lock:
@@ -144,63 +374,426 @@ class Persistence:
                 with self._batch_lock:
                     self.put_batch()
 
-    @retry(
-        exceptions=(UploadError,),
-        **DEFAULT_BATCH_RETRY_CONFIG,
-    )
-    def upload_batch(self, pqueue, uploader):
+    def _claim_batch(self, pqueue, newest=False):
         """
-        Gets batch from the persist queue of the given queue type and uploads
-        it via the given uploader.
-        Args:
-            uploader(): instance of uploader.
+        Reserves the oldest (or newest) batch of the persist queue not
+        already being uploaded by another lane.
+
+        Returns:
+            tuple: (row id, batch) or None if there is nothing to upload.
+        """
+        sql = "SELECT {key}, data FROM {table}".format(
+            key=pqueue._key_column, table=pqueue._table_name
+        )
+        order = " ORDER BY {} {} LIMIT 1".format(
+            pqueue._key_column, "DESC" if newest else "ASC"
+        )
+
+        with self._replay_lock:
+            claimed = tuple(self._claimed_rows[id(pqueue)])
+            if claimed:
+                sql += " WHERE {} NOT IN ({})".format(
+                    pqueue._key_column, ", ".join("?" * len(claimed))
+                )
+            row = self._fetch_one(pqueue, sql + order, claimed)
+            if not row or row[0] is None:
+                return None
+
+            self._claimed_rows[id(pqueue)].add(row[0])
+        return row[0], pqueue._serializer.loads(row[1])
+
+    def _delete_rows(self, pqueue, op, row_id):
+        """
+        Deletes the rows whose id compares to row_id with op (a single row
+        or a range) and returns the number of rows deleted.
+        """
+        where = "WHERE {} {} ?".format(pqueue._key_column, op)
+        with pqueue.tran_lock:
+            with pqueue._putter as connection:
+                if id(pqueue) in self._stored_bytes:
+                    # only the deleted rows are read
+                    self._stored_bytes[id(pqueue)] -= connection.execute(
+                        "SELECT COALESCE(SUM(LENGTH(data)), 0) "
+                        f"FROM {pqueue._table_name} {where}",
+                        (row_id,),
+                    ).fetchone()[0]
+                deleted = connection.execute(
+                    f"DELETE FROM {pqueue._table_name} {where}", (row_id,)
+                ).rowcount
+            pqueue.total -= deleted
+        return deleted
+
+    def _release_batch(self, pqueue, row_id, delete):
+        if delete:
+            # no row deleted if it was evicted by the retention meanwhile
+            self._delete_rows(pqueue, "=", row_id)
+
+        with self._replay_lock:
+            self._claimed_rows[id(pqueue)].discard(row_id)
+
+    def _upload(self, batch, uploader):
+        """
+        Uploads a batch via the given uploader.
+
+        Raises:
+            UploadError: If the batch could not be uploaded.
         """
+        self.logger.info(f"persist_queue_upload_try for {self.name}")
+
         try:
-            batch = pqueue.get_nowait()
-        except persistqueue.exceptions.Empty:
-            self.logger.debug(f"persist_queue_empty for {self.name}")
-        else:
-            self.logger.info(
-                f"persist_queue_upload_try for {self.name}"
-            )
+            batch_to_upload = json.loads(batch, object_hook=decode_binary)
+        except json.decoder.JSONDecodeError:
+            batch_to_upload = batch
 
-            try:
-                batch_to_upload = json.loads(batch)
-            except json.decoder.JSONDecodeError:
-                batch_to_upload = batch
+        batch_to_upload = self._drop_expired(batch_to_upload)
+        if not batch_to_upload:
+            return
+
+        try:
+            upload_response = uploader.upload_persisted_batch(batch_to_upload)
+        except Exception:
+            self.logger.exception(f"persist_queue_upload_fail for {self.name}")
+            upload_response = False
+
+        if not upload_response:
+            self.logger.info(f"persist_queue_upload_fail for {self.name}")
+            raise UploadError()
+
+        self.logger.info(f"persist_queue_upload_success for {self.name}")
+
+    def _drop_expired(self, batch):
+        """Removes the data points past their expires_at (topic ttl)."""
+        if not isinstance(batch, list):
+            return batch
+
+        now = time.time()
+        fresh_batch = [
+            data_point
+            for data_point in batch
+            if not isinstance(data_point, dict)
+            or data_point.get("expires_at") is None
+            or data_point["expires_at"] > now
+        ]
+        self.retention_metrics["expired"] += len(batch) - len(fresh_batch)
+        return fresh_batch
+
+    def _enforce_retention(self):
+        """
+        Evicts the oldest batches of the persist queues, quarantine
+        included, which are over the retention limits, at most every
+        check_interval seconds.
+
+        Retention config:
+            max_age (float): Seconds a batch is kept.
+            max_messages (int): Messages kept per queue, counted as
+                batches of batch_size messages.
+            max_bytes (int): Bytes of the batches stored per queue.
+            check_interval (float): Seconds between checks. Default: 10.
+        """
+        if not self.retention or time.monotonic() < self._next_retention_check:
+            return
+
+        self._next_retention_check = (
+            time.monotonic() + self.retention_check_interval
+        )
+        for pqueue in (
+            self._main_pqueue,
+            self._backup_pqueue,
+            self._quarantine_pqueue,
+            self._spill_pqueue,
+        ):
+            if pqueue is None:
+                continue
 
             try:
-                upload_response = uploader.upload_persisted_batch(
-                    batch_to_upload
-                )
+                self._enforce_queue_retention(pqueue)
             except Exception:
-                self.logger.exception(
-                    f"persist_queue_upload_fail for {self.name}"
+                self.logger.warning(
+                    "Failed to enforce the retention of %s",
+                    self.name,
+                    exc_info=True,
+                )
+
+    def _enforce_queue_retention(self, pqueue):
+        max_age = self.retention.get("max_age")
+        if max_age:
+            self._evict_before(
+                pqueue,
+                self._find_age_cutoff(pqueue, time.time() - max_age),
+                "max_age",
+            )
+
+        max_messages = self.retention.get("max_messages")
+        if max_messages:
+            self._evict_oldest(
+                pqueue,
+                pqueue.total - math.ceil(max_messages / self.batch_size),
+                "max_messages",
+            )
+
+        max_bytes = self.retention.get("max_bytes")
+        if max_bytes and pqueue.total:
+            # the database file is shared with the quarantine table, only
+            # the batches of this table are counted
+            used_bytes = self._get_stored_bytes(pqueue)
+            if used_bytes > max_bytes:
+                # free pages are reused, the file stops growing
+                bytes_per_row = used_bytes / pqueue.total
+                self._evict_oldest(
+                    pqueue,
+                    math.ceil((used_bytes - max_bytes) / bytes_per_row),
+                    "max_bytes",
                 )
-                upload_response = False
 
-            if not upload_response:
-                self.logger.info(f"persist_queue_upload_fail for {self.name}")
-                raise UploadError()
+    def _get_stored_bytes(self, pqueue):
+        with pqueue.tran_lock:
+            if id(pqueue) not in self._stored_bytes:
+                self._stored_bytes[id(pqueue)] = pqueue._getter.execute(
+                    "SELECT COALESCE(SUM(LENGTH(data)), 0) "
+                    f"FROM {pqueue._table_name}"
+                ).fetchone()[0]
+            return self._stored_bytes[id(pqueue)]
+
+    def _find_age_cutoff(self, pqueue, timestamp):
+        """
+        Returns a row id such that the rows before it are older than
+        timestamp and the others are not. Rows are inserted in timestamp
+        order, so the id order is bisected instead of scanning the
+        unindexed timestamp column.
+        """
+        key_column = pqueue._key_column
+        table_name = pqueue._table_name
+
+        low, high = self._fetch_one(
+            pqueue,
+            f"SELECT MIN({key_column}), MAX({key_column}) + 1 "
+            f"FROM {table_name}",
+        )
+        if low is None:
+            return None
+
+        while low < high:
+            middle = (low + high) // 2
+            row = self._fetch_one(
+                pqueue,
+                f"SELECT {key_column}, timestamp FROM {table_name} "
+                f"WHERE {key_column} >= ? ORDER BY {key_column} LIMIT 1",
+                (middle,),
+            )
+            if row[1] < timestamp:
+                low = row[0] + 1
             else:
-                self.logger.info(
-                    f"persist_queue_upload_success for {self.name}"
+                high = middle
+        return low
+
+    def _evict_oldest(self, pqueue, count, reason):
+        if count <= 0:
+            return
+
+        row = self._fetch_one(
+            pqueue,
+            f"SELECT {pqueue._key_column} FROM {pqueue._table_name} "
+            f"ORDER BY {pqueue._key_column} LIMIT 1 OFFSET ?",
+            (count,),
+        )
+        if row is None:
+            row = self._fetch_one(
+                pqueue,
+                f"SELECT MAX({pqueue._key_column}) + 1 "
+                f"FROM {pqueue._table_name}",
+            )
+        self._evict_before(pqueue, row[0], reason)
+
+    def _evict_before(self, pqueue, row_id, reason):
+        """Deletes the rows older than row_id in a single range delete."""
+        if row_id is None:
+            return
+
+        evicted = self._delete_rows(pqueue, "<", row_id)
+        if evicted:
+            self.retention_metrics[reason] += evicted
+            self.logger.warning(
+                "persist_queue_evicted %s batches of %s (%s)",
+                evicted,
+                self.name,
+                reason,
+            )
+
+    def upload_batch(self, pqueue, uploader, newest=False):
+        """
+        Gets a batch from the given persist queue and uploads it via the
+        given uploader. The batch is retried with backoff, failures while
+        the uploader is disconnected are not counted. After replay_retries
+        failures the batch is moved to the quarantine queue so that it
+        does not block the lane.
+
+        Args:
+            pqueue: persist queue to upload from.
+            uploader(): instance of uploader.
+            newest (bool): Upload the newest batch instead of the oldest.
+
+        Returns:
+            bool: False if the persist queue is empty.
+        """
+        claimed = self._claim_batch(pqueue, newest)
+        if claimed is None:
+            self.logger.debug(f"persist_queue_empty for {self.name}")
+            return False
+
+        row_id, batch = claimed
+        delay = self.DEFAULT_BATCH_RETRY_CONFIG["delay"]
+        failures = 0
+        done = False
+        try:
+            while True:
+                if uploader.is_connected():
+                    try:
+                        self._upload(batch, uploader)
+                    except UploadError:
+                        if uploader.is_connected():
+                            failures += 1
+                            self.replay_metrics["failed"] += 1
+                    else:
+                        self.replay_metrics["uploaded"] += 1
+                        done = True
+                        return True
+
+                    if failures >= self.replay_retries:
+                        done = self._quarantine(batch)
+                        return True
+
+                time.sleep(delay)
+                delay = min(
+                    delay * self.DEFAULT_BATCH_RETRY_CONFIG["backoff"],
+                    self.DEFAULT_BATCH_RETRY_CONFIG["max_delay"],
                 )
+        finally:
+            self._release_batch(pqueue, row_id, delete=done)
+
+    def _quarantine(self, batch):
+        if self._quarantine_pqueue is None:
+            return False
 
-            pqueue.task_done()
+        self.logger.warning(
+            "persist_queue_quarantine for %s, batch failed %s times",
+            self.name,
+            self.replay_retries,
+        )
+        try:
+            self._insert_batches(self._quarantine_pqueue, [batch])
+        except Exception:
+            self.logger.warning(
+                "Failed to put batch in quarantine persist queue",
+                exc_info=True,
+            )
+            return False
+
+        self.replay_metrics["quarantined"] += 1
+        return True
+
+    def get_quarantine_pqueue_size(self):
+        if self._quarantine_pqueue is None:
+            return 0
+
+        return self._quarantine_pqueue.qsize()
+
+    def put_spilled(self, messages):
+        """
+        Writes the outgoing messages of a disconnected client to the spill
+        queue, in a single transaction. They are not replayed by the lanes,
+        the client publishes them in order with get_spilled before its live
+        traffic.
+
+        Args:
+            messages (list): Outgoing messages, oldest first.
+
+        Returns:
+            bool: False if the messages could not be written.
+        """
+        if self._spill_pqueue is None:
+            return False
+
+        try:
+            self._insert_batches(
+                self._spill_pqueue,
+                [
+                    json.dumps(
+                        messages[start : start + self.batch_size],
+                        default=encode_binary,
+                    )
+                    for start in range(0, len(messages), self.batch_size)
+                ],
+            )
+        except Exception:
+            self.logger.warning(
+                "Failed to put messages in spill persist queue", exc_info=True
+            )
+            return False
+        return True
+
+    def get_spilled(self):
+        """
+        Returns:
+            tuple: (row id, messages) of the oldest spilled batch, None if
+                nothing is spilled. The batch stays stored until
+                delete_spilled is called with its row id.
+        """
+        pqueue = self._spill_pqueue
+        if pqueue is None or not pqueue.total:
+            return None
+
+        row = self._fetch_one(
+            pqueue,
+            f"SELECT {pqueue._key_column}, data FROM {pqueue._table_name} "
+            f"ORDER BY {pqueue._key_column} LIMIT 1",
+        )
+        if row is None:
+            return None
+
+        return row[0], json.loads(
+            pqueue._serializer.loads(row[1]), object_hook=decode_binary
+        )
+
+    def delete_spilled(self, row_id):
+        self._delete_rows(self._spill_pqueue, "=", row_id)
+
+    def get_spill_pqueue_size(self):
+        if self._spill_pqueue is None:
+            return 0
+
+        return self._spill_pqueue.qsize()
 
     def start(self, uploader):
-        threading.Thread(target=self.start_upload, args=(uploader,)).start()
+        for lane in range(self.replay_lanes):
+            threading.Thread(
+                target=self.start_upload, args=(uploader, lane)
+            ).start()
         threading.Thread(target=self.put_batch_regular_intervals).start()
 
-    def start_upload(self, uploader):
-        while True:
+    def start_upload(self, uploader, lane=0):
+        """
+        Replay lane. Lanes take turns over the main and backup persist
+        queues, the first replay_recent_lanes lanes upload the newest
+        batches first, the others the oldest. A lane only waits for
+        upload_interval when there is nothing to upload.
+        """
+        pqueues = [
+            pqueue
+            for pqueue in (self._main_pqueue, self._backup_pqueue)
+            if pqueue is not None
+        ]
+        newest = lane < self.replay_recent_lanes
+        turn = lane
 
+        while True:
+            uploaded = False
             if uploader.is_connected():
-                if self._main_pqueue is not None:
-                    self.upload_batch(self._main_pqueue, uploader)
-
-                if self._backup_pqueue is not None:
-                    self.upload_batch(self._backup_pqueue, uploader)
-
-            time.sleep(self.upload_interval)
+                for offset in range(len(pqueues)):
+                    pqueue = pqueues[(turn + offset) % len(pqueues)]
+                    if self.upload_batch(pqueue, uploader, newest):
+                        uploaded = True
+                        break
+                turn += 1
+
+            if not uploaded:
+                time.sleep(self.upload_interval)
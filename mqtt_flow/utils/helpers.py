@@ -1,24 +1,61 @@
+from collections.abc import Mapping
+import functools
 import logging
 import re
-from mqtt_flow.config.loader import MQTTConfigLoader
+from mqtt_flow.utils.log import install_filters
+from mqtt_flow.utils.log import start_async_logging
+from mqtt_flow.utils.log import DEFAULT_ASYNC_QUEUE_SIZE
 
 global LOGGER
 LOGGER = None
 
+DEFAULT_LOG_LEVEL = "INFO"
+
+# levels of the `logging` config section, set by MQTTConfigLoader
+_LOG_LEVELS = {"default_level": DEFAULT_LOG_LEVEL, "loggers": {}}
+
 
 def set_logger(logger):
     global LOGGER
     LOGGER = logger
 
 
+def configure_logging(logging_config):
+    """
+    Sets the log levels used by get_logger from the `logging` config section.
+
+    Args:
+        logging_config (dict): `default_level`, per logger `loggers` levels
+            and rate limits, `async_handler` to write the records from a
+            background thread.
+    """
+    _LOG_LEVELS["default_level"] = logging_config.get(
+        "default_level", DEFAULT_LOG_LEVEL
+    )
+    _LOG_LEVELS["loggers"] = logging_config.get("loggers", {})
+
+    if logging_config.get("async_handler"):
+        _basic_config()
+        start_async_logging(
+            logging_config.get("async_queue_size", DEFAULT_ASYNC_QUEUE_SIZE)
+        )
+
+
+def _basic_config():
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    )
+
+
 def get_logger(name, level=None):
     global LOGGER
 
     if LOGGER:
         return LOGGER
     else:
-        loggers = MQTTConfigLoader.loggers
-        default_log_level = MQTTConfigLoader.default_log_level
+        loggers = _LOG_LEVELS["loggers"]
+        default_log_level = _LOG_LEVELS["default_level"]
 
         if not level:
             if name in loggers and "level" in loggers[name]:
@@ -26,43 +63,276 @@ def get_logger(name, level=None):
             else:
                 level = default_log_level
 
-        logging.basicConfig(
-            level=logging.INFO,
-            format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-        )
+        _basic_config()
         logger = logging.getLogger(name)
         logger.setLevel(level)
+        install_filters(logger, loggers.get(name, {}))
         return logger
 
 
-def format_topic(topic, topic_formatters=None):
+DEFAULT_TOPIC_CACHE_SIZE = 4096
+DEFAULT_FORMATTERS_CACHE_SIZE = 256
 
-    if topic_formatters is None:
-        return topic
+# formatter key -> options read with it
+TOPIC_FORMATTER_KEYS = {
+    "prefix": (),
+    "suffix": (),
+    "remove_prefix": (),
+    "remove_suffix": (),
+    "template": (),
+    "regex": ("replace", "count"),
+    "drop_levels": (),
+    "insert_level": (),
+}
+
+
+def _check_topic_formatter(topic_formatter):
+    """Raises a ValueError for a formatter the compiler would not apply."""
+    if not isinstance(topic_formatter, Mapping):
+        raise ValueError(
+            f"topic formatter must be a mapping: {topic_formatter!r}"
+        )
+
+    known_keys = set(TOPIC_FORMATTER_KEYS).union(
+        *TOPIC_FORMATTER_KEYS.values()
+    )
+    unknown_keys = sorted(set(topic_formatter) - known_keys)
+    if unknown_keys:
+        raise ValueError(f"unknown topic formatter keys {unknown_keys}")
+
+    if not set(topic_formatter) & set(TOPIC_FORMATTER_KEYS):
+        raise ValueError(
+            f"topic formatter needs one of {list(TOPIC_FORMATTER_KEYS)}"
+        )
+
+    drop_levels = topic_formatter.get("drop_levels")
+    if drop_levels is not None and not (
+        isinstance(drop_levels, (list, tuple))
+        and all(
+            isinstance(index, int) and not isinstance(index, bool)
+            for index in drop_levels
+        )
+    ):
+        raise ValueError(
+            f"drop_levels must be a list of ints: {drop_levels!r}"
+        )
+
+    insert_level = topic_formatter.get("insert_level")
+    if insert_level is not None and not (
+        isinstance(insert_level, Mapping) and "value" in insert_level
+    ):
+        raise ValueError(
+            f"insert_level needs an index and a value: {insert_level!r}"
+        )
+
+
+def _compile_topic_formatter(topic_formatter):
+    """
+    Compiles a single topic formatter dict into a function mapping a topic
+    to the formatted topic. Only the first supported key of the formatter is
+    applied, in the same order as the original prefix/suffix handling.
+
+    Supported keys:
+        prefix (str): Prepends a level, `prefix/<topic>`.
+        suffix (str): Appends a level, `<topic>/suffix`.
+        remove_prefix (str): Removes the prefix if the topic starts with it.
+        remove_suffix (str): Removes the suffix if the topic ends with it.
+        template (str): Rebuilds the topic from its levels, e.g. `{1}/{3}`
+            (levels are 0-indexed, `{topic}` is the whole topic).
+        regex (str): Pattern substituted by `replace`, capture groups
+            can be referenced as `\\1`.
+        drop_levels (list of int): Indexes of levels to drop, negative
+            indexes count from the end, indexes out of range are ignored.
+        insert_level (dict): `index` and `value` of a level to insert.
+
+    Raises:
+        ValueError: For unknown keys or a formatter without supported key.
+    """
+    _check_topic_formatter(topic_formatter)
+
+    prefix = topic_formatter.get("prefix", None)
+    suffix = topic_formatter.get("suffix", None)
+    remove_prefix = topic_formatter.get("remove_prefix")
+    remove_suffix = topic_formatter.get("remove_suffix")
+    template = topic_formatter.get("template")
+    regex = topic_formatter.get("regex")
+    drop_levels = topic_formatter.get("drop_levels")
+    insert_level = topic_formatter.get("insert_level")
+
+    if prefix:
+        return lambda topic: f"{prefix}/{topic}"
+
+    if suffix:
+        return lambda topic: f"{topic}/{suffix}"
+
+    if remove_prefix:
+
+        def _remove_prefix(topic):
+            if topic.startswith(remove_prefix):
+                # Ensure removal only affects the start
+                return topic[len(remove_prefix) :].lstrip("/")
+            return topic
+
+        return _remove_prefix
+
+    if remove_suffix:
+
+        def _remove_suffix(topic):
+            if topic.endswith(remove_suffix):
+                # Ensure removal only affects the end
+                return topic[: -len(remove_suffix)].rstrip("/")
+            return topic
+
+        return _remove_suffix
+
+    if template:
+
+        def _template(topic):
+            try:
+                return template.format(*topic.split("/"), topic=topic)
+            except (IndexError, KeyError):
+                return topic
+
+        return _template
+
+    if regex:
+        pattern = re.compile(regex)
+        replace = topic_formatter.get("replace", "")
+        count = topic_formatter.get("count", 0)
+        return lambda topic: pattern.sub(replace, topic, count=count)
 
-    for topic_formatter in topic_formatters:
-        # use topic formatter
+    if drop_levels:
+        drop_levels = tuple(drop_levels)
 
-        remove_prefix = topic_formatter.get("remove_prefix")
-        remove_suffix = topic_formatter.get("remove_suffix")
+        def _drop_levels(topic):
+            levels = topic.split("/")
+            dropped = {
+                index % len(levels)
+                for index in drop_levels
+                if -len(levels) <= index < len(levels)
+            }
+            return "/".join(
+                level
+                for index, level in enumerate(levels)
+                if index not in dropped
+            )
 
-        if topic_formatter.get("prefix", None):
-            topic = f"{topic_formatter['prefix']}/{topic}"
+        return _drop_levels
 
-        elif topic_formatter.get("suffix", None):
-            topic = f"{topic}/{topic_formatter['suffix']}"
+    if insert_level:
+        index = insert_level.get("index", 0)
+        value = insert_level["value"]
 
-        elif remove_prefix and topic.startswith(remove_prefix):
-            # Ensure removal only affects the start
-            topic = topic[len(remove_prefix) :].lstrip("/")
+        def _insert_level(topic):
+            levels = topic.split("/")
+            levels.insert(index, value)
+            return "/".join(levels)
 
-        elif remove_suffix and topic.endswith(remove_suffix):
-            # Ensure removal only affects the end
-            topic = topic[: -len(remove_suffix)].rstrip("/")
+        return _insert_level
 
+    return None
+
+
+def compile_topic_formatters(
+    topic_formatters, cache_size=DEFAULT_TOPIC_CACHE_SIZE
+):
+    """
+    Compiles a list of topic formatters into a single callable.
+
+    Results are memoized in an LRU cache keyed on the input topic, so
+    repeated topics are formatted with a single dict lookup.
+
+    Args:
+        topic_formatters (list of dict): Topic formatters, applied in order.
+        cache_size (int): Maximum number of topics kept in the cache.
+
+    Returns:
+        function: Callable mapping a topic to the formatted topic.
+
+    Raises:
+        ValueError: For an invalid topic formatter.
+    """
+    steps = tuple(
+        step
+        for step in (
+            _compile_topic_formatter(topic_formatter)
+            for topic_formatter in topic_formatters or []
+        )
+        if step is not None
+    )
+
+    if not steps:
+        return lambda topic: topic
+
+    @functools.lru_cache(maxsize=cache_size)
+    def _format_topic(topic):
+        for step in steps:
+            topic = step(topic)
+        return topic
+
+    return _format_topic
+
+
+def _identity_topic(topic):
     return topic
 
 
+def _freeze(value):
+    """Returns a hashable copy of a config value (dicts, lists, scalars)."""
+    if isinstance(value, Mapping):
+        return tuple(
+            sorted((key, _freeze(item)) for key, item in value.items())
+        )
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+
+class _TopicFormattersKey:
+    """
+    Cache key of a topic formatters list, equal for lists with the same
+    content. The list is kept to compile it on a cache miss.
+    """
+
+    __slots__ = ("topic_formatters", "_frozen", "_hash")
+
+    def __init__(self, topic_formatters):
+        self.topic_formatters = topic_formatters
+        self._frozen = _freeze(topic_formatters)
+        self._hash = hash(self._frozen)
+
+    def __hash__(self):
+        return self._hash
+
+    def __eq__(self, other):
+        return self._frozen == other._frozen
+
+
+@functools.lru_cache(maxsize=DEFAULT_FORMATTERS_CACHE_SIZE)
+def _get_compiled_topic_formatter(key):
+    return compile_topic_formatters(key.topic_formatters)
+
+
+def get_topic_formatter(topic_formatters):
+    """
+    Returns the compiled callable for the given topic formatters list,
+    compiled once per distinct list content (bounded LRU cache).
+    """
+    # defaults such as `.get("topic_formatters", [])` are new lists per call
+    if not topic_formatters:
+        return _identity_topic
+
+    return _get_compiled_topic_formatter(_TopicFormattersKey(topic_formatters))
+
+
+def format_topic(topic, topic_formatters=None):
+
+    if topic_formatters is None:
+        return topic
+
+    return get_topic_formatter(topic_formatters)(topic)
+
+
 def match_topic(source_topic, regex=None, rule_topic=None):
 
     if regex and not re.match(regex, source_topic):
@@ -72,3 +342,24 @@ def match_topic(source_topic, regex=None, rule_topic=None):
         return False
 
     return True
+
+
+def topic_matches_filter(topic, topic_filter):
+    """
+    Checks if a topic matches an MQTT topic filter with `+` and `#`
+    wildcards.
+    """
+    topic_levels = topic.split("/")
+    filter_levels = topic_filter.split("/")
+
+    for index, filter_level in enumerate(filter_levels):
+        if filter_level == "#":
+            return True
+
+        if index >= len(topic_levels):
+            return False
+
+        if filter_level != "+" and filter_level != topic_levels[index]:
+            return False
+
+    return len(filter_levels) == len(topic_levels)
@@ -0,0 +1,156 @@
+import atexit
+import copy
+import logging
+import logging.handlers
+import queue
+import random
+import threading
+import time
+
+DEFAULT_ASYNC_QUEUE_SIZE = 10000
+
+_listener = None
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Per logger rate limiting and sampling of log records. Records above
+    `max_level` (WARNING by default) always pass.
+
+    Config (logger section of the `logging` config):
+        rate_limit (float): Records per second allowed, token bucket.
+        burst (int): Records allowed at once. Default: rate_limit.
+        sample_rate (float): Fraction of the records kept, from 0 to 1.
+        max_level (str): Highest level limited. Default: WARNING.
+
+    The number of records dropped since the last one emitted is appended to
+    the next emitted record.
+    """
+
+    def __init__(self, logger_config):
+        super().__init__()
+        self.rate_limit = logger_config.get("rate_limit")
+        self.burst = logger_config.get("burst", self.rate_limit or 1)
+        self.sample_rate = logger_config.get("sample_rate")
+        self.max_level = logging.getLevelName(
+            logger_config.get("max_level", "WARNING")
+        )
+        self.dropped = 0
+        self._tokens = self.burst
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def is_configured(cls, logger_config):
+        return bool(
+            logger_config.get("rate_limit") or logger_config.get("sample_rate")
+        )
+
+    def _take_token(self):
+        now = time.monotonic()
+        self._tokens = min(
+            self.burst,
+            self._tokens + (now - self._updated_at) * self.rate_limit,
+        )
+        self._updated_at = now
+
+        if self._tokens < 1:
+            return False
+
+        self._tokens -= 1
+        return True
+
+    def filter(self, record):
+        if record.levelno > self.max_level:
+            return True
+
+        with self._lock:
+            if (
+                self.sample_rate is not None
+                and random.random() >= self.sample_rate
+            ) or (self.rate_limit and not self._take_token()):
+                self.dropped += 1
+                return False
+
+            dropped, self.dropped = self.dropped, 0
+
+        if dropped:
+            # no % in the suffix, the message arguments are kept lazy
+            record.msg = f"{record.msg} [{dropped} records dropped]"
+        return True
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue handler never blocking the logging thread, records are dropped
+    and counted when the queue is full.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        """
+        Queues a copy of the record without formatting it, the handlers of
+        the listener thread format it. The stdlib handler formats it here,
+        on the logging thread, to make it picklable for other processes.
+        """
+        return copy.copy(record)
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def install_filters(logger, logger_config):
+    """Adds a RateLimitFilter to the logger if its config defines one."""
+    if not RateLimitFilter.is_configured(logger_config):
+        return
+
+    for log_filter in logger.filters:
+        if isinstance(log_filter, RateLimitFilter):
+            return
+
+    logger.addFilter(RateLimitFilter(logger_config))
+
+
+def start_async_logging(queue_size=DEFAULT_ASYNC_QUEUE_SIZE):
+    """
+    Moves the root handlers behind a queue emptied by a listener thread, so
+    the formatting and the I/O of the records never happen on the network
+    or consumer threads.
+
+    Args:
+        queue_size (int): Maximum number of records waiting, newer records
+            are dropped when full.
+    """
+    global _listener
+
+    if _listener is not None:
+        return
+
+    root = logging.getLogger()
+    handlers = list(root.handlers)
+    log_queue = queue.Queue(queue_size)
+
+    for handler in handlers:
+        root.removeHandler(handler)
+    root.addHandler(DroppingQueueHandler(log_queue))
+
+    _listener = logging.handlers.QueueListener(
+        log_queue, *handlers, respect_handler_level=True
+    )
+    _listener.start()
+    atexit.register(stop_async_logging)
+
+
+def stop_async_logging():
+    """Flushes the queued records and stops the listener thread."""
+    global _listener
+
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,90 @@
+import base64
+import json
+import mmap
+import tempfile
+
+BYTES_MARKER = "__bytes__"
+
+
+class SpilledPayload:
+    """
+    Large binary payload moved out of the Python heap into a memory mapped
+    temporary file, so that queued messages keep a bounded memory. The file
+    is deleted once the payload is garbage collected.
+
+    `view()` gives a zero copy memoryview, `bytes(payload)` a copy.
+    """
+
+    __slots__ = ("_mmap", "_size")
+
+    def __init__(self, data):
+        self._size = len(data)
+        with tempfile.TemporaryFile() as spill_file:
+            spill_file.write(data)
+            spill_file.flush()
+            # the mapping keeps the unlinked file alive
+            self._mmap = mmap.mmap(
+                spill_file.fileno(), self._size, access=mmap.ACCESS_READ
+            )
+
+    def __len__(self):
+        return self._size
+
+    def __bytes__(self):
+        return self._mmap[:]
+
+    def __eq__(self, other):
+        if isinstance(other, SpilledPayload):
+            other = other.view()
+        return self.view() == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f"<SpilledPayload {self._size} bytes>"
+
+    def view(self):
+        return memoryview(self._mmap)
+
+
+def spill_payload(payload, threshold):
+    """
+    Returns the payload, spilled to a memory mapped file if it is larger than
+    the threshold (bytes). Empty payloads cannot be mapped and are kept.
+    """
+    if threshold is None or len(payload) <= threshold or not payload:
+        return payload
+
+    return SpilledPayload(payload)
+
+
+def decode_payload(payload):
+    """
+    Decodes a raw MQTT payload into a JSON value, or a string if it is not
+    JSON. Same decoding as the message callback always did, binary payloads
+    should use a binary rule or task instead.
+    """
+    if isinstance(payload, SpilledPayload):
+        payload = bytes(payload)
+
+    try:
+        decoded_payload = str(payload)[2:-1]
+        return json.loads(decoded_payload.replace("'", '"'))
+    except json.decoder.JSONDecodeError:
+        return str(payload)[2:-1]
+
+
+def encode_binary(value):
+    """json.dumps default, stores bytes payloads as base64."""
+    if isinstance(value, (bytes, bytearray, memoryview, SpilledPayload)):
+        return {BYTES_MARKER: base64.b64encode(bytes(value)).decode()}
+
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def decode_binary(value):
+    """json.loads object_hook, restores the bytes stored by encode_binary."""
+    if len(value) == 1 and BYTES_MARKER in value:
+        return base64.b64decode(value[BYTES_MARKER])
+
+    return value
@@ -0,0 +1,81 @@
+from collections import deque
+import queue
+
+
+class PriorityLaneQueue(queue.Queue):
+    """
+    Drop-in replacement of `queue.Queue` with priority lanes, 0 being the
+    highest priority. Items are FIFO within a lane.
+
+    The priority of an item is its `priority` key (dict items such as
+    outgoing messages) or attribute (tasks), `default_priority` if missing.
+
+    Starvation protection: each time an item is served ahead of a waiting
+    lower priority lane, the waiting lane's skip counter is incremented.
+    Once it reaches `starvation_limit`, the next item is served from that
+    lane.
+    """
+
+    DEFAULT_PRIORITY_LEVELS = 3
+    DEFAULT_STARVATION_LIMIT = 100
+
+    def __init__(
+        self,
+        maxsize=0,
+        priority_levels=DEFAULT_PRIORITY_LEVELS,
+        default_priority=None,
+        starvation_limit=DEFAULT_STARVATION_LIMIT,
+    ):
+        self.priority_levels = priority_levels
+        self.default_priority = (
+            priority_levels - 1
+            if default_priority is None
+            else default_priority
+        )
+        self.starvation_limit = starvation_limit
+        super().__init__(maxsize)
+
+    def _get_priority(self, item):
+        if isinstance(item, dict):
+            priority = item.get("priority")
+        else:
+            priority = getattr(item, "priority", None)
+
+        if priority is None:
+            return self.default_priority
+
+        return min(max(int(priority), 0), self.priority_levels - 1)
+
+    def _init(self, maxsize):
+        self._lanes = [deque() for _ in range(self.priority_levels)]
+        self._skipped = [0] * self.priority_levels
+        self._size = 0
+
+    def _qsize(self):
+        return self._size
+
+    def _put(self, item):
+        self._lanes[self._get_priority(item)].append(item)
+        self._size += 1
+
+    def _get(self):
+        lane_index = next(
+            index for index, lane in enumerate(self._lanes) if lane
+        )
+
+        # lowest starved lane first
+        for index in range(self.priority_levels - 1, lane_index, -1):
+            if (
+                self._lanes[index]
+                and self._skipped[index] >= self.starvation_limit
+            ):
+                lane_index = index
+                break
+
+        for index in range(lane_index + 1, self.priority_levels):
+            if self._lanes[index]:
+                self._skipped[index] += 1
+
+        self._skipped[lane_index] = 0
+        self._size -= 1
+        return self._lanes[lane_index].popleft()
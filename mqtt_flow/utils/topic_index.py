@@ -0,0 +1,66 @@
+import functools
+import heapq
+import re
+
+
+class TopicIndex:
+    """
+    Index of values filtered by an exact topic and/or a regex, with the
+    same semantics as `match_topic`.
+
+    Values registered with an exact topic are found with a dict lookup,
+    only regex and catch-all values are scanned. Match results are
+    memoized in an LRU cache keyed on the topic, so bounded topic sets are
+    resolved without any regex evaluation once warmed up.
+    """
+
+    DEFAULT_CACHE_SIZE = 4096
+
+    def __init__(self, cache_size=DEFAULT_CACHE_SIZE):
+        self._exact = {}
+        self._scanned = []
+        self._size = 0
+        self.match = functools.lru_cache(maxsize=cache_size)(self._match)
+
+    def __len__(self):
+        return self._size
+
+    def add(self, value, topic=None, regex=None):
+        """
+        Adds a value to the index.
+
+        Args:
+            value: Value returned when a topic matches.
+            topic (str): Exact topic the value applies to.
+            regex (str): Regex the topic has to match (`re.match`).
+        """
+        entry = (self._size, re.compile(regex) if regex else None, value)
+        self._size += 1
+
+        if topic:
+            self._exact.setdefault(topic, []).append(entry)
+        else:
+            self._scanned.append(entry)
+
+        self.match.cache_clear()
+
+    def _match(self, topic):
+        """
+        Returns a tuple of all values matching the topic, in insertion order.
+        """
+        return tuple(
+            value
+            for _, pattern, value in heapq.merge(
+                self._exact.get(topic, ()),
+                self._scanned,
+                key=lambda entry: entry[0],
+            )
+            if pattern is None or pattern.match(topic)
+        )
+
+    def first(self, topic):
+        """
+        Returns the first value matching the topic or None.
+        """
+        matches = self.match(topic)
+        return matches[0] if matches else None
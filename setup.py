@@ -14,9 +14,13 @@ setup(
         "paho-mqtt==1.6.1",
         "PyYAML>=5.4",
         "retry",
-        "persistqueue",
+        # persistence.py relies on internals of this tested version range
+        "persistqueue>=1.1.0,<1.2",
         # Add other dependencies as needed
     ],
+    entry_points={
+        "console_scripts": ["mqtt-flow=mqtt_flow.__main__:main"],
+    },
     extras_require={
         "dev": [
             "pytest>=6.0",
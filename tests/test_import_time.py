@@ -0,0 +1,78 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+# `import mqtt_flow` takes about 30 ms locally, mostly the logging module
+DEFAULT_IMPORT_BUDGET_MS = 150
+IMPORT_BUDGET_MS = float(
+    os.environ.get("MQTT_FLOW_IMPORT_BUDGET_MS", DEFAULT_IMPORT_BUDGET_MS)
+)
+IMPORT_RUNS = 3
+
+# only loaded when a flow, a config loader or a persistence is created
+LAZY_MODULES = ("paho", "yaml", "persistqueue", "sqlite3", "unittest.mock")
+
+_IMPORT_SCRIPT = """
+import json
+import sys
+import time
+
+started = time.perf_counter()
+import mqtt_flow
+elapsed = time.perf_counter() - started
+
+print(json.dumps({"elapsed_ms": elapsed * 1000, "modules": list(sys.modules)}))
+"""
+
+
+def _import_in_subprocess():
+    """Imports mqtt_flow in a fresh interpreter, nothing is cached."""
+    env = {**os.environ, "PYTHONDONTWRITEBYTECODE": "1"}
+    repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env["PYTHONPATH"] = os.pathsep.join(
+        path for path in (repo_root, env.get("PYTHONPATH")) if path
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", _IMPORT_SCRIPT],
+        check=True,
+        capture_output=True,
+        text=True,
+        env=env,
+    ).stdout
+    return json.loads(output)
+
+
+def test_import_does_not_load_heavy_modules():
+    modules = set(_import_in_subprocess()["modules"])
+
+    loaded = [
+        name
+        for name in LAZY_MODULES
+        if any(
+            module == name or module.startswith(f"{name}.")
+            for module in modules
+        )
+    ]
+    assert not loaded, f"import mqtt_flow loaded {loaded}"
+
+
+def test_import_time_within_budget():
+    # best of a few runs, a single cold run is noisy on a busy machine
+    elapsed_ms = min(
+        _import_in_subprocess()["elapsed_ms"] for _ in range(IMPORT_RUNS)
+    )
+
+    assert elapsed_ms <= IMPORT_BUDGET_MS, (
+        f"import mqtt_flow took {elapsed_ms:.1f} ms, "
+        f"budget {IMPORT_BUDGET_MS:.0f} ms"
+    )
+
+
+@pytest.mark.parametrize("attribute", ["MQTTFlow", "MQTTConfigLoader"])
+def test_lazy_attributes_resolve(attribute):
+    import mqtt_flow
+
+    assert getattr(mqtt_flow, attribute).__name__ == attribute
@@ -0,0 +1,378 @@
+"""
+Stress tests of the flow over the in-process loopback broker: concurrent
+publishers through the rules and tasks, concurrent publishes sharing topic
+aliases, consumer groups and outages with the outgoing buffer.
+
+The clients and flows leave their worker threads running after stop, so
+each scenario runs in a spawned process which exits once it has returned
+its result.
+"""
+
+import multiprocessing
+import os
+import threading
+import time
+import traceback
+
+import pytest
+
+SCENARIO_TIMEOUT = 120
+WAIT_TIMEOUT = 30
+
+PUBLISHERS = 4
+
+
+def _run_scenario(results, scenario, args):
+    try:
+        results.put({"result": scenario(*args)})
+    except BaseException:
+        results.put({"error": traceback.format_exc()})
+    finally:
+        results.close()
+        results.join_thread()
+        os._exit(0)
+
+
+def _run_isolated(scenario, *args):
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    process = context.Process(
+        target=_run_scenario, args=(results, scenario, args)
+    )
+    process.start()
+    try:
+        outcome = results.get(timeout=SCENARIO_TIMEOUT)
+    finally:
+        process.join(5)
+        if process.is_alive():
+            process.kill()
+            process.join()
+
+    if "error" in outcome:
+        pytest.fail(outcome["error"], pytrace=False)
+    return outcome["result"]
+
+
+def _wait_until(condition, timeout=WAIT_TIMEOUT):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return condition()
+
+
+class _Collector:
+    """Loopback client recording the messages received on a topic filter."""
+
+    def __init__(self, broker, topic_filter, client_id="collector"):
+        self.messages = []
+        self._lock = threading.Lock()
+        self._client = broker.client_factory(client_id=client_id)
+        self._client.on_connect = lambda client, *args: client.subscribe(
+            topic_filter, 1
+        )
+        self._client.on_message = self._on_message
+        self._client.connect_async("loopback")
+        self._client.loop_start()
+        assert _wait_until(self._client.is_connected)
+
+    def _on_message(self, client, userdata, message):
+        with self._lock:
+            self.messages.append((message.topic, message.payload.decode()))
+
+    def wait_for(self, count):
+        return _wait_until(lambda: len(self.messages) >= count)
+
+
+def _start_publishers(broker, publish):
+    """Runs `publish(client, index)` from a client per thread."""
+    threads = []
+    for index in range(PUBLISHERS):
+        client = broker.client_factory(client_id=f"publisher_{index}")
+        client.connect_async("loopback")
+        client.loop_start()
+        assert _wait_until(client.is_connected)
+        threads.append(threading.Thread(target=publish, args=(client, index)))
+
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def _relay_config(edge_client, cloud_client, prefix="out", max_workers=4):
+    return {
+        "mqtt_clients": [
+            {"sub_topics": ["in/#"], **edge_client},
+            cloud_client,
+        ],
+        "pools": [
+            {
+                "name": "pool",
+                "type": "simple_thread",
+                "max_workers": max_workers,
+            }
+        ],
+        "tasks_queues": [{"name": "queue", "pool": "pool"}],
+        "tasks": {
+            "relay": {
+                "path": "mqtt_flow.core.task.RelayMessage",
+                "queue_name": "queue",
+                "client_to_publish": cloud_client["client_name"],
+                "client_for_userdata": edge_client["client_name"],
+                "topic_formatters": [{"prefix": prefix}],
+                "qos": 1,
+            }
+        },
+        "rules": [
+            {
+                "name": "relay_in",
+                "source_client_name": edge_client["client_name"],
+                "regex": "in/.*",
+                "task": "relay",
+            }
+        ],
+    }
+
+
+def _loopback_client(client_name, **client_config):
+    return {
+        "client_name": client_name,
+        "server": "loopback",
+        "port": 1883,
+        **client_config,
+    }
+
+
+def _relay_scenario(messages_per_publisher):
+    from mqtt_flow.core.mqtt_flow import MQTTFlow
+    from mqtt_flow.mqtt_lib.loopback import LoopbackBroker
+
+    broker = LoopbackBroker(latency=0.0005)
+    collector = _Collector(broker, "out/#")
+    flow = MQTTFlow(
+        _relay_config(_loopback_client("edge"), _loopback_client("cloud")),
+        client_factory=broker.client_factory,
+    )
+    flow.start()
+    assert flow.wait_ready(WAIT_TIMEOUT)
+
+    def publish(client, index):
+        for number in range(messages_per_publisher):
+            client.publish(f"in/{index}", f"{index}:{number}", qos=1)
+
+    _start_publishers(broker, publish)
+    collector.wait_for(PUBLISHERS * messages_per_publisher)
+    # late duplicates would show up meanwhile
+    time.sleep(0.2)
+    return collector.messages
+
+
+def test_concurrent_publishers_are_relayed_once():
+    messages_per_publisher = 500
+
+    received = _run_isolated(_relay_scenario, messages_per_publisher)
+
+    expected = [
+        (f"out/in/{index}", f"{index}:{number}")
+        for index in range(PUBLISHERS)
+        for number in range(messages_per_publisher)
+    ]
+    assert len(received) == len(expected)
+    assert sorted(received) == sorted(expected)
+
+
+def _topic_alias_scenario(threads, publishes, topics):
+    from mqtt_flow.mqtt_lib.loopback import LoopbackBroker
+    from mqtt_flow.mqtt_lib.mqtt_client import MQTTClient
+
+    broker = LoopbackBroker(latency=0.0005, topic_alias_maximum=topics)
+    collector = _Collector(broker, "t/#")
+    client = MQTTClient(
+        client_name="aliases",
+        client_id="aliases",
+        server="loopback",
+        port=1883,
+        protocol=5,
+        mqtt5_config={"topic_alias_maximum": topics},
+        client_factory=broker.client_factory,
+    )
+    client.start()
+    assert client.wait_ready(WAIT_TIMEOUT)
+
+    errors = []
+
+    def publish(index):
+        try:
+            for number in range(publishes):
+                client.publish(f"t/{number % topics}", f"{index}:{number}")
+        except Exception:
+            errors.append(traceback.format_exc())
+
+    publishers = [
+        threading.Thread(target=publish, args=(index,))
+        for index in range(threads)
+    ]
+    for publisher in publishers:
+        publisher.start()
+    for publisher in publishers:
+        publisher.join()
+
+    collector.wait_for(threads * publishes)
+    return {"errors": errors, "messages": collector.messages}
+
+
+def test_concurrent_publishes_share_topic_aliases():
+    threads, publishes, topics = 8, 200, 40
+
+    result = _run_isolated(_topic_alias_scenario, threads, publishes, topics)
+
+    # an alias used before its registering publish fails on the client
+    assert not result["errors"], result["errors"][0]
+    received = result["messages"]
+    assert len(received) == threads * publishes
+    # the alias of a message resolved to its own topic
+    for topic, payload in received:
+        number = int(payload.split(":")[1])
+        assert topic == f"t/{number % topics}"
+
+
+def _consumer_group_scenario(messages_per_publisher):
+    from mqtt_flow.core.mqtt_flow import MQTTFlow
+    from mqtt_flow.mqtt_lib.loopback import LoopbackBroker
+
+    broker = LoopbackBroker(latency=0.0005)
+    collector = _Collector(broker, "+/in/#")
+    flows = []
+    for member in range(2):
+        edge = _loopback_client(
+            "edge",
+            client_id=f"edge_{member}",
+            consumer_group={"name": "ingest", "mode": "shared"},
+        )
+        cloud = _loopback_client("cloud", client_id=f"cloud_{member}")
+        flow = MQTTFlow(
+            _relay_config(edge, cloud, prefix=f"member_{member}"),
+            client_factory=broker.client_factory,
+        )
+        flow.start()
+        flows.append(flow)
+
+    for flow in flows:
+        assert flow.wait_ready(WAIT_TIMEOUT)
+
+    def publish(client, index):
+        for number in range(messages_per_publisher):
+            client.publish(f"in/{index}", f"{index}:{number}", qos=1)
+
+    _start_publishers(broker, publish)
+    collector.wait_for(PUBLISHERS * messages_per_publisher)
+    time.sleep(0.2)
+    return collector.messages
+
+
+def test_consumer_group_members_split_the_stream():
+    messages_per_publisher = 250
+
+    received = _run_isolated(_consumer_group_scenario, messages_per_publisher)
+
+    payloads = [payload for _, payload in received]
+    expected = [
+        f"{index}:{number}"
+        for index in range(PUBLISHERS)
+        for number in range(messages_per_publisher)
+    ]
+    # each message is processed by exactly one member
+    assert sorted(payloads) == sorted(expected)
+    members = {topic.split("/")[0] for topic, _ in received}
+    assert members == {"member_0", "member_1"}
+
+
+def _outage_scenario(persistence_path, outage_messages, live_messages):
+    from mqtt_flow.core.mqtt_flow import MQTTFlow
+    from mqtt_flow.mqtt_lib.loopback import LoopbackBroker
+
+    broker = LoopbackBroker(latency=0.0005)
+    collector = _Collector(broker, "out/#")
+    cloud = _loopback_client(
+        "cloud",
+        # the backlog is partly spilled, partly in memory on reconnect
+        disconnect_policy={"buffer_size": 50},
+        persistence_config={
+            "name": "cloud",
+            "main_path": persistence_path,
+            "upload_interval": 0.2,
+        },
+    )
+    # a single worker keeps the order of the messages of each publisher
+    flow = MQTTFlow(
+        _relay_config(_loopback_client("edge"), cloud, max_workers=1),
+        client_factory=broker.client_factory,
+    )
+    flow.start()
+    assert flow.wait_ready(WAIT_TIMEOUT)
+
+    broker.refuse_connections("cloud")
+    broker.disconnect_client("cloud")
+    assert _wait_until(lambda: not flow.get_client("cloud").is_ready)
+
+    def publish_outage(client, index):
+        for number in range(outage_messages):
+            client.publish(f"in/{index}", f"{index}:{number}", qos=1)
+
+    _start_publishers(broker, publish_outage)
+    assert _wait_until(
+        lambda: flow.get_outgoing_buffers_metrics()["cloud"]["buffered"]
+        == PUBLISHERS * outage_messages
+    )
+    buffers_metrics = dict(flow.get_outgoing_buffers_metrics()["cloud"])
+
+    broker.refuse_connections("cloud", False)
+    assert flow.get_client("cloud").wait_ready(WAIT_TIMEOUT)
+
+    def publish_live(client, index):
+        for number in range(outage_messages, outage_messages + live_messages):
+            client.publish(f"in/{index}", f"{index}:{number}", qos=1)
+
+    _start_publishers(broker, publish_live)
+    collector.wait_for(PUBLISHERS * (outage_messages + live_messages))
+    return {
+        "buffers_metrics": buffers_metrics,
+        "messages": collector.messages,
+    }
+
+
+def test_outage_backlog_is_published_in_order_before_live_traffic(
+    tmp_path,
+):
+    outage_messages, live_messages = 100, 20
+
+    result = _run_isolated(
+        _outage_scenario, str(tmp_path), outage_messages, live_messages
+    )
+
+    assert result["buffers_metrics"]["spilled"] > 0
+    assert result["buffers_metrics"]["size"] > 0
+    assert result["buffers_metrics"]["dropped"] == 0
+
+    numbers = [
+        (int(index), int(number))
+        for index, number in (
+            payload.split(":") for _, payload in result["messages"]
+        )
+    ]
+    assert len(numbers) == PUBLISHERS * (outage_messages + live_messages)
+    # every message once, in the order of its publisher
+    for index in range(PUBLISHERS):
+        assert [number for sender, number in numbers if sender == index] == (
+            list(range(outage_messages + live_messages))
+        )
+    # the whole backlog before the live traffic
+    first_live = min(
+        position
+        for position, (_, number) in enumerate(numbers)
+        if number >= outage_messages
+    )
+    assert all(number < outage_messages for _, number in numbers[:first_live])
+    assert first_live == PUBLISHERS * outage_messages
@@ -0,0 +1,160 @@
+import os
+import signal
+import time
+
+import pytest
+
+from mqtt_flow.core.supervisor import FlowSupervisor
+
+pytestmark = pytest.mark.skipif(
+    not hasattr(signal, "SIGKILL"), reason="needs POSIX signals"
+)
+
+HEARTBEAT_INTERVAL = 0.2
+HEARTBEAT_TIMEOUT = 10
+# spawned workers import the flow from scratch
+START_TIMEOUT = 30
+
+# nothing listens on port 1: the clients retry in the background and the
+# workers run, forward messages and send heartbeats without a broker
+CONFIG = {
+    "mqtt_clients": [
+        {
+            "client_name": "edge",
+            "server": "127.0.0.1",
+            "port": 1,
+            "sub_topics": ["in/#"],
+            "shard": 0,
+        },
+        {
+            "client_name": "cloud",
+            "server": "127.0.0.1",
+            "port": 1,
+            "shard": 1,
+        },
+    ],
+    "pools": [{"name": "pool", "type": "simple_thread", "max_workers": 2}],
+    "tasks_queues": [{"name": "queue", "pool": "pool"}],
+    "tasks": {
+        "relay": {
+            "path": "mqtt_flow.core.task.RelayMessage",
+            "queue_name": "queue",
+            "client_to_publish": "cloud",
+            "client_for_userdata": "edge",
+            "schedule": [
+                {"interval": HEARTBEAT_INTERVAL, "args": ["out/a", 1]}
+            ],
+        }
+    },
+    "rules": [
+        {
+            "name": "relay_in",
+            "source_client_name": "edge",
+            "topic": "in/a",
+            "task": "relay",
+        }
+    ],
+    "supervisor": {
+        "workers": 2,
+        "heartbeat_interval": HEARTBEAT_INTERVAL,
+        # a slow spawn on a loaded machine must not look like a hung worker
+        "heartbeat_timeout": HEARTBEAT_TIMEOUT,
+    },
+}
+
+
+def _wait_until(condition, timeout=START_TIMEOUT):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.05)
+    return condition()
+
+
+def _heartbeats_received(supervisor):
+    workers = supervisor.get_metrics()["workers"]
+    return all(workers[index] for index in range(supervisor.workers))
+
+
+@pytest.fixture
+def supervisor():
+    supervisor = FlowSupervisor(CONFIG)
+    supervisor.start()
+    try:
+        yield supervisor
+    finally:
+        supervisor.stop()
+
+
+def test_workers_start_and_forward(supervisor):
+    assert supervisor.owners == {"edge": 0, "cloud": 1}
+    assert _wait_until(lambda: _heartbeats_received(supervisor))
+
+    health = supervisor.get_health()
+    for index, worker in health["workers"].items():
+        assert worker["alive"], f"worker {index} is not alive"
+        assert worker["restarts"] == 0
+        assert worker["heartbeat_age"] <= supervisor.heartbeat_timeout
+    assert health["workers"][0]["clients"] == ["edge"]
+    assert health["workers"][1]["clients"] == ["cloud"]
+    # no broker, the clients never connect
+    assert not health["healthy"]
+
+    # the scheduled task runs in worker 0 and publishes to worker 1's client
+    def forwarded():
+        return supervisor.get_metrics()["workers"][1]["shard"]["received"]
+
+    assert _wait_until(forwarded)
+    workers = supervisor.get_metrics()["workers"]
+    assert workers[0]["shard"]["forwarded"] > 0
+    assert workers[0]["scheduler"]["runs"] > 0
+    assert workers[1]["scheduler"]["jobs"] == 0
+
+
+def test_killed_worker_is_restarted(supervisor):
+    assert _wait_until(lambda: _heartbeats_received(supervisor))
+    killed_pid = supervisor.get_health()["workers"][1]["pid"]
+
+    os.kill(killed_pid, signal.SIGKILL)
+
+    def restarted():
+        worker = supervisor.get_health()["workers"][1]
+        return (
+            worker["restarts"] == 1
+            and worker["alive"]
+            and worker["pid"] != killed_pid
+        )
+
+    assert _wait_until(restarted)
+    # the new worker sends heartbeats again
+    restarted_at = time.time()
+    assert _wait_until(
+        lambda: supervisor._status[1]["heartbeat"] is not None
+        and supervisor._status[1]["heartbeat"] > restarted_at
+    )
+
+    health = supervisor.get_health()
+    assert health["workers"][0]["restarts"] == 0
+    assert health["workers"][1]["heartbeat_age"] <= (
+        supervisor.heartbeat_timeout
+    )
+
+
+def test_stop_shuts_down_workers():
+    supervisor = FlowSupervisor(CONFIG)
+    supervisor.start()
+    try:
+        assert _wait_until(lambda: _heartbeats_received(supervisor))
+    finally:
+        started = time.monotonic()
+        supervisor.stop()
+        elapsed = time.monotonic() - started
+
+    # the workers exit on their own, they are not terminated
+    assert [process.exitcode for process in supervisor._processes] == [0, 0]
+    assert elapsed < FlowSupervisor.STOP_TIMEOUT
+    assert not any(
+        worker["alive"]
+        for worker in supervisor.get_health()["workers"].values()
+    )